@@ -4,21 +4,33 @@ import sys
 import os
 import argparse
 import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout,
                             QLineEdit, QPushButton, QLabel, QFileDialog,
                             QDialog, QDialogButtonBox, QScrollArea, QHBoxLayout,
-                            QMessageBox)
+                            QMessageBox, QListWidget, QListWidgetItem, QCheckBox)
 from PyQt5.QtGui import QPixmap, QWheelEvent, QPainter, QPalette, QPen, QColor, QImage
-from PyQt5.QtCore import Qt, QPoint, QRect
-from picamera2 import Picamera2, Preview
-from picamera2.previews.qt import QGlPicamera2, QPicamera2
+from PyQt5.QtCore import Qt, QPoint, QRect, QTimer, pyqtSignal
+from picamera2 import Picamera2
+from picamera2.previews.qt import QGlPicamera2
+from remote_preview import RemotePreview
+from capture_writer import CaptureWriter
+from exposure_monitor import ExposureMonitor
+from capture_names import make_basename, INVALID_CHARS
+from capture_metadata import append_record
+from preview_profiles import PreviewAdapter, PROFILES, DEFAULT_PROFILE
+from stall_watchdog import StallWatchdog, STALL_THRESHOLD
 
 # You can override these here, if you wish, or on the command line.
 USER = ""
 OUTPUT_DIR = os.path.join(os.path.expanduser("~"), "awb-images")
 TMP_DIR = "/dev/shm"
 CAMERA = 0
+NUM_SLOTS = 8
+IMAGES_KEPT = 2  # Number of the latest captures whose images are kept in memory, ready to annotate
+CLIP_WARNING = 0.01  # Warn when more than this fraction of the preview is clipped
 
 class ImageLabel(QLabel):
     def __init__(self, parent=None):
@@ -257,16 +269,49 @@ class ImageDialog(QDialog):
                 self.panning = False
                 self.image_label.setCursor(Qt.ArrowCursor)
 
+class CaptureSlot:
+    # One of the places in the temporary directory where a capture waits to be annotated.
+    EMPTY, CAPTURING, CAPTURED, COMMITTING = range(4)
+
+    def __init__(self, index, tmp_dir):
+        self.index = index
+        self.jpg = os.path.join(tmp_dir, f"slot{index}.jpg")
+        self.dng = os.path.join(tmp_dir, f"slot{index}.dng")
+        self.state = CaptureSlot.EMPTY
+        self.save = None  # Future for the capture being written
+        self.image = None  # The captured RGB image as a numpy array, while it's kept in memory
+        self.rect = None
+        self.description = ""
+        self.basename = None  # What it is being renamed to
+
 class AwbOMatic(QMainWindow):
-    def __init__(self, user=USER, output_dir=OUTPUT_DIR, tmp_dir=TMP_DIR, camera=CAMERA, ssh_mode=False):
+    # Emitted from the background when a slot has been moved to the output folder (with an error message if it failed).
+    commit_done = pyqtSignal(int, str)
+
+    def __init__(self, user=USER, output_dir=OUTPUT_DIR, tmp_dir=TMP_DIR, camera=CAMERA, ssh_mode=False, preview_port=None,
+                 compress_raw=False, num_slots=NUM_SLOTS, preview_profile=DEFAULT_PROFILE, adaptive_preview=True):
         super().__init__()
 
-        self.tmp_jpg = os.path.join(tmp_dir, "tmp.jpg")
-        self.tmp_dng = os.path.join(tmp_dir, "tmp.dng")
+        # Captures go into a ring of slots, so that several scenes can be shot before annotating them.
+        self.slots = [CaptureSlot(i, tmp_dir) for i in range(num_slots)]
+        self.next_slot = 0
+        self.capturing_slot = None
+        self.kept_images = []  # slots whose images are in memory, oldest first
         self.output_dir = output_dir
         self.user = user
 
-        self.configure_camera(camera)
+        self.configure_camera(camera, preview_profile, adaptive_preview)
+
+        # Captures are written in the background, and we wait for them only when we need the files.
+        self.writer = CaptureWriter(self.picam2, compress_raw=compress_raw)
+        self.writer.saved.connect(self.save_done)
+        self.writer.failed.connect(self.save_failed)
+
+        # Moving a capture to the output folder is a full copy (from /dev/shm to the SD card), so
+        # that happens in the background too.
+        self.committer = ThreadPoolExecutor(max_workers=1)
+        self.committing = set()  # basenames of captures still being moved
+        self.commit_done.connect(self.on_commit_done)
 
         self.setWindowTitle("AWB-O-Matic")
         self.setGeometry(100, 100, 1000, 800)  # Increased main window size
@@ -319,7 +364,8 @@ class AwbOMatic(QMainWindow):
 
         bg_colour = self.palette().color(QPalette.Background).getRgb()[:3]
         if ssh_mode:
-            self.qpicamera2 = QPicamera2(self.picam2, bg_colour=bg_colour)
+            # Over ssh, use a preview that adapts to the speed of the link (or streams it as MJPEG).
+            self.qpicamera2 = RemotePreview(self.picam2, bg_colour=bg_colour, http_port=preview_port)
         else:
             self.qpicamera2 = QGlPicamera2(self.picam2, bg_colour=bg_colour)
 
@@ -328,6 +374,39 @@ class AwbOMatic(QMainWindow):
         self.qpicamera2.setFixedSize(1024, 768)
         layout.addWidget(self.qpicamera2)
 
+        # Show clipping and neutral coverage from the preview, so exposure problems are seen before capturing
+        exposure_layout = QHBoxLayout()
+        self.exposure_label = QLabel("Clipped: -  Neutral: -")
+        exposure_layout.addWidget(self.exposure_label)
+        exposure_layout.addStretch(1)
+        self.overlay_checkbox = QCheckBox("Show clipped (red) and neutral (green) areas")
+        self.overlay_checkbox.setChecked(True)
+        self.overlay_checkbox.toggled.connect(self.on_overlay_toggled)
+        exposure_layout.addWidget(self.overlay_checkbox)
+        layout.addLayout(exposure_layout)
+        self.exposure_monitor = ExposureMonitor(self.picam2)
+        self.exposure_monitor.stats.connect(self.on_exposure_stats)
+
+        # Report how long the last capture took to write, and how big it was
+        self.save_label = QLabel("No captures saved yet")
+        layout.addWidget(self.save_label)
+
+        # List the captures waiting to be annotated, so they can be done in any order
+        self.slot_list = QListWidget()
+        self.slot_list.setMaximumHeight(120)
+        self.slot_list.currentItemChanged.connect(self.on_slot_changed)
+        layout.addWidget(self.slot_list)
+
+        discard_layout = QHBoxLayout()
+        discard_button = QPushButton("Discard Capture")
+        discard_button.clicked.connect(self.discard_capture)
+        discard_layout.addWidget(discard_button)
+        self.slots_label = QLabel()
+        discard_layout.addWidget(self.slots_label)
+        discard_layout.addStretch(1)
+        layout.addLayout(discard_layout)
+        self.update_slots_label()
+
         # Display USER value
         user_label = QLabel(f"User: {user}")
         layout.addWidget(user_label)
@@ -392,30 +471,23 @@ class AwbOMatic(QMainWindow):
         rename_layout.addStretch(1)
         layout.addLayout(rename_layout)
 
-        # Store rectangle information
-        self.selected_rect = None
+        # Move to a cheaper preview if frames are being dropped (and back again when things improve).
+        self.preview_timer = QTimer(self)
+        self.preview_timer.timeout.connect(self.preview.check)
+        self.preview_timer.start(1000)
 
         self.picam2.start()
 
-    def configure_camera(self, camera):
+    def configure_camera(self, camera, preview_profile=DEFAULT_PROFILE, adaptive_preview=True):
         self.picam2 = Picamera2(camera)
         self.sensor = self.picam2.camera_properties['Model']
         if 'mono' in self.sensor.lower() or 'noir' in self.sensor.lower():
             raise ValueError("Mono/Noir cameras are not supported - please use a colour camera")
+        # Only the still configuration needs a raw stream.
         self.capture_config = self.picam2.create_still_configuration()
-        full_res = self.picam2.sensor_resolution
-        half_res = (full_res[0] // 2, full_res[1] // 2)
-        preview_res = half_res
-        while preview_res[0] > 1280:
-            preview_res = (preview_res[0] // 2, preview_res[1] // 2)
-        self.preview_res = preview_res
-        print(f"Preview resolution: {preview_res}")
-        preview_config = self.picam2.create_preview_configuration(
-            {'format': 'YUV420', 'size': preview_res},
-            raw={'format': 'SBGGR12', 'size': half_res}, # force unpacked, full FOV
-            controls={'FrameRate': 30}
-        )
-        self.picam2.configure(preview_config)
+        self.preview = PreviewAdapter(self.picam2, preview_profile, adaptive=adaptive_preview,
+                                      busy=lambda: self.capturing_slot is not None)
+        self.preview.configure()
         if 'AfMode' in self.picam2.camera_controls:
             self.picam2.set_controls({"AfMode": 2})  # Continuous AF, where available
  
@@ -429,24 +501,175 @@ class AwbOMatic(QMainWindow):
         self.picam2.set_controls({"ExposureValue": self.ev_value})
         self.ev_value_label.setText(f"EV: {self.ev_value}")
 
+    def on_exposure_stats(self, stats, overlay):
+        text = f"Clipped: {stats['clipped']:.1%}  Neutral: {stats['neutral']:.1%}"
+        if stats['grey_world']:
+            text += f"  Grey world R/G: {stats['grey_world'][0]:.2f} B/G: {stats['grey_world'][1]:.2f}"
+        if stats['clipped'] > CLIP_WARNING:
+            text += "  - consider lowering EV"
+            self.exposure_label.setStyleSheet("color: red; font-weight: bold;")
+        else:
+            self.exposure_label.setStyleSheet("")
+        self.exposure_label.setText(text)
+        if self.overlay_checkbox.isChecked():
+            self.qpicamera2.set_overlay(overlay)
+
+    def on_overlay_toggled(self, checked):
+        if not checked:
+            self.qpicamera2.set_overlay(None)
+
     def capture(self):
+        # Use the next free slot, going round the ring.
+        for i in range(len(self.slots)):
+            slot = self.slots[(self.next_slot + i) % len(self.slots)]
+            if slot.state == CaptureSlot.EMPTY:
+                break
+        else:
+            QMessageBox.warning(self, "Warning",
+                "All the capture slots are in use. Please rename or discard some captures first.")
+            return
+        self.next_slot = (slot.index + 1) % len(self.slots)
+        slot.state = CaptureSlot.CAPTURING
+        self.capturing_slot = slot
         self.capture_button.setEnabled(False)
-        print("Doing capture")
+        print("Doing capture into slot", slot.index)
         self.picam2.switch_mode_and_capture_request(
             self.capture_config, wait=False, signal_function=self.qpicamera2.signal_done)
 
     def capture_done(self, job):
         self.capture_button.setEnabled(True)
         request = job.get_result()
-        request.save('main', self.tmp_jpg)
-        request.save_dng(self.tmp_dng)
+        slot = self.capturing_slot
+        self.capturing_slot = None
+        # Keep the image, so that it can be annotated without waiting for the JPEG to be written and read back.
+        image = request.make_image('main')
+        slot.image = np.array(image)
+        self.kept_images.append(slot)
+        while len(self.kept_images) > IMAGES_KEPT:
+            self.kept_images.pop(0).image = None
+        # The metadata is logged once we know what the capture is called.
+        slot.save = self.writer.save(request, slot.jpg, slot.dng, ev=self.ev_value, log=False, image=image)
+        slot.state = CaptureSlot.CAPTURED
+        slot.rect = None
+        slot.description = f"Capture at {time.strftime('%H:%M:%S')}, EV {self.ev_value}"
         print("Capture done", request)
         request.release()
 
+        item = QListWidgetItem(slot.description)
+        item.setData(Qt.UserRole, slot.index)
+        self.slot_list.addItem(item)
+        self.slot_list.setCurrentItem(item)
+        self.update_slots_label()
+
+    def current_slot(self):
+        item = self.slot_list.currentItem()
+        return self.slots[item.data(Qt.UserRole)] if item else None
+
+    def find_slot_item(self, slot):
+        for row in range(self.slot_list.count()):
+            if self.slot_list.item(row).data(Qt.UserRole) == slot.index:
+                return row
+        return None
+
+    def update_slots_label(self):
+        free = sum(slot.state == CaptureSlot.EMPTY for slot in self.slots)
+        self.slots_label.setText(f"{free} of {len(self.slots)} capture slots free")
+
+    def on_slot_changed(self, current, previous):
+        slot = self.current_slot()
+        self.show_rectangle(slot.rect if slot else None)
+
+    def show_rectangle(self, rect):
+        if rect:
+            self.rect_value_label.setText(
+                f"x: {rect['x']}, y: {rect['y']} width: {rect['width']}, height: {rect['height']}")
+        else:
+            self.rect_value_label.setText("No rectangle selected")
+
+    def release_slot(self, slot):
+        row = self.find_slot_item(slot)
+        if row is not None:
+            self.slot_list.takeItem(row)
+        slot.state = CaptureSlot.EMPTY
+        slot.save = None
+        slot.rect = None
+        slot.image = None
+        if slot in self.kept_images:
+            self.kept_images.remove(slot)
+        self.update_slots_label()
+
+    def discard_capture(self):
+        slot = self.current_slot()
+        if slot is None:
+            return
+        self.wait_for_save(slot)
+        for filename in (slot.jpg, slot.dng):
+            if os.path.exists(filename):
+                os.remove(filename)
+        self.release_slot(slot)
+
+    def save_done(self, report):
+        raw_type = "compressed DNG" if report['compressed'] else "DNG"
+        self.save_label.setText(
+            f"Last capture: JPEG {report['jpg_bytes'] / 1e6:.1f}MB in {report['jpg_time']:.2f}s, "
+            f"{raw_type} {report['dng_bytes'] / 1e6:.1f}MB in {report['dng_time']:.2f}s")
+
+    def save_failed(self, message):
+        QMessageBox.critical(self, "Error", message)
+
+    def wait_for_save(self, slot):
+        # The capture may still be being written.
+        if slot.save is not None and not slot.save.done():
+            QApplication.setOverrideCursor(Qt.WaitCursor)
+            try:
+                slot.save.exception()
+            finally:
+                QApplication.restoreOverrideCursor()
+
+    def commit_slot(self, slot, jpg_filename, dng_filename):
+        # Runs in the background.
+        report = slot.save.result()
+        shutil.move(slot.jpg, jpg_filename)
+        try:
+            shutil.move(slot.dng, dng_filename)
+        except OSError:
+            # Put the JPEG back, so that the capture is all in its slot to try again.
+            shutil.move(jpg_filename, slot.jpg)
+            raise
+        try:
+            append_record(self.output_dir, slot.basename, report['record'])
+        except (OSError, TypeError, ValueError) as e:
+            # The files are in place, so don't fail the rename.
+            print(f"Could not log the metadata of {slot.basename}: {e}")
+
+    def on_commit_done(self, index, error):
+        slot = self.slots[index]
+        self.committing.discard(slot.basename)
+        if error:
+            # Put the capture back in the list so that the user can try again.
+            QMessageBox.critical(self, "Error", f"Failed to rename files: {error}")
+            slot.state = CaptureSlot.CAPTURED
+            item = QListWidgetItem(slot.description)
+            item.setData(Qt.UserRole, slot.index)
+            self.slot_list.addItem(item)
+        else:
+            print("Renamed capture to", slot.basename)
+            self.save_label.setText(f"Renamed capture to {slot.basename}")
+            self.release_slot(slot)
+            return
+        self.update_slots_label()
+
+    def closeEvent(self, event):
+        # Finish anything that is still being written or moved.
+        self.preview_timer.stop()
+        self.exposure_monitor.close()
+        self.preview.close()
+        self.writer.close()
+        self.committer.shutdown(wait=True)
+        super().closeEvent(event)
+
     def is_valid_filename(self, text):
-        # List of characters not allowed in filenames
-        invalid_chars = '<>:"/\\|?*,\''
-        return not any(char in invalid_chars for char in text)
+        return not any(char in INVALID_CHARS for char in text)
 
     def rename_image(self):
         scene_id = self.scene_id_input.text().strip()
@@ -458,25 +681,23 @@ class AwbOMatic(QMainWindow):
                 "Scene ID contains invalid characters. Please avoid: < > : \" / \\ | ? * , '")
             return
 
-        # Check if temporary files exist
-        if not os.path.exists(self.tmp_jpg) or not os.path.exists(self.tmp_dng):
+        slot = self.current_slot()
+        if slot is None:
             QMessageBox.warning(self, "Warning", 
                 "No captured images found. Please capture an image first.")
             return
 
-        if self.selected_rect:
-            x0 = self.selected_rect['x']
-            y0 = self.selected_rect['y']
-            x1 = x0 + self.selected_rect['width']
-            y1 = y0 + self.selected_rect['height']
-            basename = f"{self.user},{self.sensor},{scene_id},{x0},{y0},{x1},{y1}"
-        else:
-            basename = f"{self.user},{self.sensor},{scene_id}"
+        rect = None
+        if slot.rect:
+            x0 = slot.rect['x']
+            y0 = slot.rect['y']
+            rect = (x0, y0, x0 + slot.rect['width'], y0 + slot.rect['height'])
+        basename = make_basename(self.user, self.sensor, scene_id, rect)
         jpg_filename = os.path.join(self.output_dir, basename + ".jpg")
         dng_filename = os.path.join(self.output_dir, basename + ".dng")
 
-        # Check if files already exist
-        if os.path.exists(jpg_filename) or os.path.exists(dng_filename):
+        # Check if files already exist (or are about to)
+        if os.path.exists(jpg_filename) or os.path.exists(dng_filename) or basename in self.committing:
             reply = QMessageBox.warning(self, 'Warning',
                 f"Files already exist:\n\n"
                 f"{basename}.jpg\n"
@@ -498,46 +719,57 @@ class AwbOMatic(QMainWindow):
             if reply == QMessageBox.No:
                 return
 
-        try:
-            # Move the files
-            shutil.move(self.tmp_jpg, jpg_filename)
-            shutil.move(self.tmp_dng, dng_filename)
-            QMessageBox.information(self, "Success", "Files renamed successfully")
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Failed to rename files: {str(e)}")
+        # Move the files in the background, and free up the slot when that's done.
+        slot.state = CaptureSlot.COMMITTING
+        slot.basename = basename
+        self.committing.add(basename)
+        self.slot_list.takeItem(self.find_slot_item(slot))
+        future = self.committer.submit(self.commit_slot, slot, jpg_filename, dng_filename)
+        future.add_done_callback(
+            lambda f: self.commit_done.emit(slot.index, str(f.exception()) if f.exception() else ""))
 
     def clear_rectangle(self):
-        self.selected_rect = None
-        self.rect_value_label.setText("No rectangle selected")
+        slot = self.current_slot()
+        if slot:
+            slot.rect = None
+        self.show_rectangle(None)
 
     def add_rectangle(self):
+        slot = self.current_slot()
+        if slot is None:
+            QMessageBox.warning(self, "Warning", "Could not load image - please do capture first")
+            return
         try:
-            pixmap = QPixmap(self.tmp_jpg)
+            if slot.image is not None:
+                # Recent captures are still in memory.
+                array = slot.image
+                h, w = array.shape[:2]
+                pixmap = QPixmap.fromImage(QImage(array.data, w, h, array.strides[0], QImage.Format_RGB888))
+            else:
+                self.wait_for_save(slot)
+                pixmap = QPixmap(slot.jpg)
+                if not pixmap.isNull():
+                    size = pixmap.size()
+                    w = size.width()
+                    h = size.height()
+                    qimg = pixmap.toImage()
+                    qimg = qimg.convertToFormat(QImage.Format.Format_RGBA8888)
+                    bytes = qimg.bits()
+                    bytes.setsize(w * h * 4)
+                    array = np.frombuffer(bytes, dtype=np.uint8).reshape((h, w, 4))
             if not pixmap.isNull():
                 dialog = ImageDialog(self)
                 dialog.set_image(pixmap)
                 if dialog.exec_() == QDialog.Accepted:
                     if dialog.selected_rect:
-                        self.selected_rect = dialog.selected_rect
-                        rect_text = (
-                            f"x: {self.selected_rect['x']}, y: {self.selected_rect['y']} "
-                            f"width: {self.selected_rect['width']}, height: {self.selected_rect['height']}"
-                        )
-                        self.rect_value_label.setText(rect_text)
+                        slot.rect = dialog.selected_rect
+                        self.show_rectangle(slot.rect)
 
                         # Also check the saturation of the rectangle
-                        size = pixmap.size()
-                        w = size.width()
-                        h = size.height()
-                        qimg = pixmap.toImage()
-                        qimg = qimg.convertToFormat(QImage.Format.Format_RGBA8888)
-                        bytes = qimg.bits()
-                        bytes.setsize(w * h * 4)
-                        array = np.frombuffer(bytes, dtype=np.uint8).reshape((h, w, 4))
-                        x0 = self.selected_rect['x']
-                        y0 = self.selected_rect['y']
-                        x1 = x0 + self.selected_rect['width']
-                        y1 = y0 + self.selected_rect['height']
+                        x0 = slot.rect['x']
+                        y0 = slot.rect['y']
+                        x1 = x0 + slot.rect['width']
+                        y1 = y0 + slot.rect['height']
                         r_avg = array[y0:y1, x0:x1, 0].mean()
                         g_avg = array[y0:y1, x0:x1, 1].mean()
                         b_avg = array[y0:y1, x0:x1, 2].mean()
@@ -562,6 +794,20 @@ if __name__ == '__main__':
     ssh_group = parser.add_mutually_exclusive_group()
     ssh_group.add_argument('-s', '--ssh', action='store_true', help='Enable SSH mode')
     ssh_group.add_argument('--no-ssh', action='store_true', help='Disable SSH mode')
+    parser.add_argument('--slots', type=int, default=NUM_SLOTS,
+                        help=f'Number of captures that can wait to be annotated (default: {NUM_SLOTS})')
+    parser.add_argument('--compress-raw', action='store_true', help='Save DNG files with lossless compression')
+    parser.add_argument('--preview-port', type=int,
+                        help='In SSH mode, stream the preview as MJPEG on this local port instead of over X')
+    parser.add_argument('--preview-profile', choices=PROFILES, default=DEFAULT_PROFILE,
+                        help=f'How demanding a preview to start with (default: {DEFAULT_PROFILE})')
+    parser.add_argument('--fixed-preview', action='store_true',
+                        help='Keep to the preview profile even if frames are being dropped')
+    parser.add_argument('--watchdog', type=float, nargs='?', const=STALL_THRESHOLD, default=None, metavar='SECONDS',
+                        help='Report what holds up the GUI for longer than this many seconds, when it exits '
+                        f'(default: {STALL_THRESHOLD})')
+    parser.add_argument('--watchdog-report', type=str, default=None,
+                        help='Also write the --watchdog report to this file')
     args = parser.parse_args()
 
     # Override USER if command line argument is provided
@@ -585,9 +831,11 @@ if __name__ == '__main__':
         parser.error("User name must be set. Use -u/--user to specify a user name.")
 
     # Check for invalid characters in USER
-    invalid_chars = '<>:"/\\|?*,\''
-    if any(char in invalid_chars for char in USER):
-        parser.error(f"User name contains invalid characters. Please avoid: {invalid_chars}")
+    if any(char in INVALID_CHARS for char in USER):
+        parser.error(f"User name contains invalid characters. Please avoid: {INVALID_CHARS}")
+
+    if args.slots < 1:
+        parser.error("There must be at least one capture slot")
 
     # Set SSH mode based on arguments or environment
     ssh_mode = None
@@ -607,8 +855,15 @@ if __name__ == '__main__':
     print(f"Output directory: {OUTPUT_DIR}")
     print(f"Temporary directory: {TMP_DIR}")
     print(f"SSH mode: {ssh_mode}")
+    if args.preview_port and not ssh_mode:
+        parser.error("--preview-port is only available in SSH mode")
 
     app = QApplication(sys.argv)
-    window = AwbOMatic(user=USER, output_dir=OUTPUT_DIR, tmp_dir=TMP_DIR, ssh_mode=ssh_mode)
+    if args.watchdog is not None:
+        watchdog = StallWatchdog(app, args.watchdog, args.watchdog_report)
+    window = AwbOMatic(user=USER, output_dir=OUTPUT_DIR, tmp_dir=TMP_DIR, ssh_mode=ssh_mode,
+                       preview_port=args.preview_port, compress_raw=args.compress_raw,
+                       num_slots=args.slots, preview_profile=args.preview_profile,
+                       adaptive_preview=not args.fixed_preview)
     window.show()
     sys.exit(app.exec_()) 
\ No newline at end of file
@@ -0,0 +1,153 @@
+#! /usr/bin/env python3
+
+# Build colour temperature (CT) calibration curves from an annotated dataset.
+#
+# For every annotated capture we measure the raw R/G and B/G ratios of its grey rectangle in
+# the DNG, using a pool of worker processes. The results are cached alongside the dataset,
+# keyed on the files' sizes and modification times, so re-runs only process new or changed
+# captures. Points are grouped by sensor, and for each sensor we fit the locus of grey points
+# (log B/G as a quadratic in log R/G) and, where the scene ids tell us the colour temperature
+# (for example "lightbox-2850k"), a CT curve in the [ct, r, b, ...] form of the tuning files.
+
+import sys
+import os
+import re
+import argparse
+import json
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from capture_names import parse_basename
+from dataset_index import DatasetIndex
+from rawstats import read_bayer, jpeg_size
+
+# You can override these here, if you wish, or on the command line.
+INPUT_DIR = os.path.join(os.path.expanduser("~"), "awb-images")
+OUTPUT_FILE = "ct_curve.json"
+CACHE_NAME = ".calibrator-cache.json"
+MAX_CLIPPED = 0.01  # Ignore rectangles with more than this fraction of clipped pixels
+CT_PATTERN = r'(\d{4,5})[kK]\b'
+CT_KNOTS = 6
+
+def measure(paths):
+    """Measure the grey rectangle of one capture. Runs in a worker process."""
+    jpg_path, dng_path, rect = paths
+    try:
+        bayer = read_bayer(dng_path)
+        (r, g, b), clipped = bayer.rect_means(rect, jpeg_size(jpg_path))
+        if g <= 0:
+            return {'error': "green channel is black"}
+        return {'r': r / g, 'b': b / g, 'clipped': clipped}
+    except Exception as e:
+        return {'error': str(e)}
+
+def load_cache(cache_path):
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(cache_path, cache):
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, cache_path)
+
+def measure_dataset(input_dir, workers=None, progress=True):
+    """Return {basename: measurement} for every annotated capture, re-using cached results where we can."""
+    cache_path = os.path.join(input_dir, CACHE_NAME)
+    cache = load_cache(cache_path)
+    results = {}
+    todo = []
+    index = DatasetIndex(input_dir, full=True)
+    for row in index.select(annotated=True, complete=True):
+        basename = str(index.names[row])
+        key = index.key(row)
+        cached = cache.get(basename)
+        if cached and cached['key'] == key:
+            results[basename] = cached
+        else:
+            todo.append((basename, key, (index.path(row, 'jpg'), index.path(row, 'dng'), index.fields(row)['rect'])))
+
+    if progress:
+        print(f"{len(results)} captures cached, {len(todo)} to process", file=sys.stderr)
+    if todo:
+        # LibRaw uses OpenMP, which isn't safe in forked workers.
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            measurements = pool.map(measure, [paths for _, _, paths in todo], chunksize=4)
+            for i, ((basename, key, _), measurement) in enumerate(zip(todo, measurements)):
+                measurement['key'] = key
+                results[basename] = measurement
+                if 'error' in measurement:
+                    print(f"Failed to measure {basename}: {measurement['error']}", file=sys.stderr)
+                if progress and (i + 1) % 100 == 0:
+                    print(f"Processed {i + 1} of {len(todo)}", file=sys.stderr)
+        # Saving just the current results also drops entries for captures that have gone.
+        save_cache(cache_path, results)
+    return results
+
+def fit_sensor(points):
+    """Fit the grey locus and, where colour temperatures are known, the CT curve for one sensor."""
+    r = np.array([p['r'] for p in points])
+    b = np.array([p['b'] for p in points])
+    fit = {'locus': None, 'ct_curve': None}
+    if len(points) < 2:
+        return fit
+    locus = np.polyfit(np.log(r), np.log(b), min(2, len(points) - 1))
+    fit['locus'] = locus.tolist()
+
+    known = [p for p in points if p['ct']]
+    if len({p['ct'] for p in known}) >= 2:
+        # log(R/G) is close to linear in mireds, and B/G then follows from the locus.
+        mireds = np.array([1e6 / p['ct'] for p in known])
+        log_r = np.log([p['r'] for p in known])
+        slope, intercept = np.polyfit(mireds, log_r, 1)
+        cts = np.round(np.linspace(min(p['ct'] for p in known), max(p['ct'] for p in known), CT_KNOTS), -1)
+        curve_log_r = intercept + slope * 1e6 / cts
+        curve_r = np.exp(curve_log_r)
+        curve_b = np.exp(np.polyval(locus, curve_log_r))
+        fit['ct_curve'] = []
+        for ct, r, b in zip(cts, curve_r, curve_b):
+            fit['ct_curve'] += [int(ct), round(float(r), 4), round(float(b), 4)]
+    return fit
+
+def build_curves(results, ct_pattern=CT_PATTERN):
+    sensors = {}
+    ct_regex = re.compile(ct_pattern)
+    for basename, measurement in sorted(results.items()):
+        if 'error' in measurement or measurement['clipped'] > MAX_CLIPPED:
+            continue
+        fields = parse_basename(basename)
+        match = ct_regex.search(fields['scene_id'])
+        point = {'name': basename, 'r': measurement['r'], 'b': measurement['b'],
+                 'clipped': measurement['clipped'], 'ct': int(match.group(1)) if match else None}
+        sensors.setdefault(fields['sensor'], []).append(point)
+    return {sensor: {'images': len(points), **fit_sensor(points), 'points': points}
+            for sensor, points in sensors.items()}
+
+if __name__ == '__main__':
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='AWB CT curve calibrator')
+    parser.add_argument('--input-dir', type=str, default=INPUT_DIR,
+                        help=f'Directory of annotated captures (default: {INPUT_DIR})')
+    parser.add_argument('-o', '--output', type=str, default=OUTPUT_FILE,
+                        help=f'Output file for the points and curves (default: {OUTPUT_FILE})')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Number of worker processes (default: one per CPU)')
+    parser.add_argument('--ct-pattern', type=str, default=CT_PATTERN,
+                        help='Regular expression extracting a colour temperature from scene ids')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Do not report progress')
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    results = measure_dataset(args.input_dir, workers=args.workers, progress=not args.quiet)
+    curves = build_curves(results, args.ct_pattern)
+    with open(args.output, 'w') as f:
+        json.dump(curves, f, indent=2)
+    if not args.quiet:
+        for sensor, curve in curves.items():
+            print(f"{sensor}: {curve['images']} images, CT curve: {curve['ct_curve']}", file=sys.stderr)
+        print(f"Wrote {args.output} in {time.monotonic() - start:.1f}s", file=sys.stderr)
@@ -0,0 +1,96 @@
+# Reading captures straight out of a zip or tar bundle, without extracting it.
+#
+# The listing comes from the zip's central directory, or from the tar's headers (which are read
+# by seeking from one to the next, skipping over the file data). Single files are then read,
+# or copied out to a destination file, on their own. Every read opens the bundle afresh, so
+# several threads can read at once. Compressed tars (.tar.gz and so on) can't be read this
+# way, as everything before a file would have to be decompressed to get to it, so those must
+# be extracted or repacked without compression first.
+
+import os
+import shutil
+import tarfile
+import zipfile
+from capture_names import group_captures
+
+CHUNK_SIZE = 1 << 20
+
+def is_archive(path):
+    return os.path.isfile(path) and (zipfile.is_zipfile(path) or tarfile.is_tarfile(path))
+
+class CaptureArchive:
+    """The captures in a zip or uncompressed tar file. Files are named by their names without any folders."""
+
+    def __init__(self, path):
+        self.path = path
+        self.members = {}  # filename: (zip member name, or tar data offset, size)
+        if zipfile.is_zipfile(path):
+            self.zip = zipfile.ZipFile(path)
+            for info in self.zip.infolist():
+                if not info.is_dir():
+                    self.members[os.path.basename(info.filename)] = (info.filename, info.file_size)
+        else:
+            self.zip = None
+            try:
+                with tarfile.open(path, 'r:') as tar:
+                    for info in tar:
+                        if info.isfile():
+                            self.members[os.path.basename(info.name)] = (info.offset_data, info.size)
+            except tarfile.ReadError:
+                raise ValueError(f"{path} is a compressed tar file - please extract it, or repack it without "
+                                 "compression, first")
+
+    def list_captures(self):
+        """Return {basename: {'jpg': filename, 'dng': filename}}, as capture_names.list_captures does for a folder."""
+        return group_captures(self.members)
+
+    def size(self, filename):
+        return self.members[filename][1]
+
+    def open(self, filename):
+        """Return a file object for reading one file."""
+        location, size = self.members[filename]
+        if self.zip:
+            # ZipFile shares its file between readers safely.
+            return self.zip.open(location)
+        f = open(self.path, 'rb')
+        f.seek(location)
+        return TarMemberFile(f, size)
+
+    def read(self, filename):
+        with self.open(filename) as f:
+            return f.read()
+
+    def extract(self, filename, dst):
+        """Copy one file out to dst."""
+        tmp_path = dst + ".tmp"
+        with self.open(filename) as src, open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(src, f, CHUNK_SIZE)
+        os.replace(tmp_path, dst)
+
+    def close(self):
+        if self.zip:
+            self.zip.close()
+
+class TarMemberFile:
+    """Reads the data of one file in a tar, given the tar opened and positioned at its start."""
+
+    def __init__(self, f, size):
+        self.f = f
+        self.remaining = size
+
+    def read(self, n=-1):
+        if n < 0 or n > self.remaining:
+            n = self.remaining
+        data = self.f.read(n)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
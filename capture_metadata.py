@@ -0,0 +1,60 @@
+# Keeping the camera's metadata for each capture, so that it can be used without opening the images.
+#
+# When a capture is saved, the values the camera's own algorithms came up with (the AWB gains
+# and colour temperature, the lux estimate, the exposure and so on), along with the EV setting,
+# are appended as one line of JSON to a metadata.jsonl file in the capture's folder. The log is
+# only ever appended to, so writing it is cheap and safe whatever else is happening. Records
+# are looked up by the user, sensor and scene id, so that they still apply to a capture once
+# it has been annotated (which adds the rectangle to its name), and a later record for the
+# same capture replaces an earlier one.
+
+import os
+import json
+import threading
+import time
+from capture_names import parse_basename
+
+METADATA_LOG = "metadata.jsonl"
+METADATA_FIELDS = ('ColourGains', 'ColourTemperature', 'Lux', 'ExposureTime', 'AnalogueGain', 'DigitalGain',
+                   'ColourCorrectionMatrix')
+
+log_lock = threading.Lock()
+
+def capture_record(metadata, ev=None):
+    """Make a record of the interesting parts of a capture's metadata."""
+    record = {'time': round(time.time(), 3), 'ev': ev}
+    for field in METADATA_FIELDS:
+        if field in metadata:
+            record[field] = metadata[field]
+    return record
+
+def append_record(directory, basename, record):
+    """Add a capture's record to the metadata log in directory."""
+    line = json.dumps({'name': basename, **record}, separators=(',', ':')) + "\n"
+    with log_lock, open(os.path.join(directory, METADATA_LOG), 'a') as f:
+        f.write(line)
+
+def capture_key(basename):
+    fields = parse_basename(basename)
+    return (fields['user'], fields['sensor'], fields['scene_id']) if fields else None
+
+def read_metadata(lines):
+    """Return {(user, sensor, scene_id): record} from the lines of a metadata log."""
+    records = {}
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue  # a line cut short, for example by a crash
+        key = capture_key(record.get('name', ""))
+        if key:
+            records[key] = record
+    return records
+
+def load_metadata(directory):
+    """Return {(user, sensor, scene_id): record} from the metadata log in directory."""
+    try:
+        with open(os.path.join(directory, METADATA_LOG)) as f:
+            return read_metadata(f)
+    except OSError:
+        return {}
@@ -0,0 +1,47 @@
+# Helpers for the capture naming convention shared by all the tools:
+#
+#     USER,SENSOR,SCENE_ID.jpg / .dng                  (not yet annotated)
+#     USER,SENSOR,SCENE_ID,X0,Y0,X1,Y1.jpg / .dng      (annotated with a grey rectangle)
+
+import os
+
+# Characters not allowed in user names and scene ids.
+INVALID_CHARS = '<>:"/\\|?*,\''
+
+def make_basename(user, sensor, scene_id, rect=None):
+    """Make a capture basename (without extension). rect is (x0, y0, x1, y1) or None."""
+    if rect:
+        x0, y0, x1, y1 = rect
+        return f"{user},{sensor},{scene_id},{x0},{y0},{x1},{y1}"
+    return f"{user},{sensor},{scene_id}"
+
+def parse_basename(basename):
+    """Split a capture basename into its fields, returning None if it doesn't follow the convention."""
+    fields = basename.split(',')
+    if len(fields) == 3:
+        rect = None
+    elif len(fields) == 7:
+        try:
+            rect = tuple(int(v) for v in fields[3:])
+        except ValueError:
+            return None
+    else:
+        return None
+    if not all(fields[:3]):
+        return None
+    return {'user': fields[0], 'sensor': fields[1], 'scene_id': fields[2], 'rect': rect}
+
+def group_captures(filenames):
+    """Return {basename: {'jpg': filename, 'dng': filename}} for the capture files among filenames."""
+    captures = {}
+    for filename in filenames:
+        base, ext = os.path.splitext(filename)
+        ext = ext.lower()
+        if ext in ('.jpg', '.dng') and (base in captures or parse_basename(base)):
+            captures.setdefault(base, {})[ext[1:]] = filename
+    return captures
+
+def list_captures(directory):
+    """Return {basename: {'jpg': filename, 'dng': filename}} for every capture file in directory."""
+    with os.scandir(directory) as it:
+        return group_captures(entry.name for entry in it if entry.is_file())
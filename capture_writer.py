@@ -0,0 +1,85 @@
+# Writing captured JPEG and DNG files in the background.
+#
+# Everything that has to come out of the request (the main image, the raw buffer and the
+# metadata) is copied on the GUI thread, so that the request can be released immediately, and
+# the encoding and writing then happens on a worker thread. The DNG can optionally be written
+# with lossless JPEG compression (see dng_compress.py), which LibRaw based tools (including
+# rawpy, as used by the batch tools) read transparently. Once both files are written, the
+# interesting parts of the metadata are added to the folder's metadata log (capture_metadata.py).
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from PyQt5.QtCore import QObject, pyqtSignal
+from dng_compress import save_dng
+from capture_metadata import capture_record, append_record
+
+class CaptureWriter(QObject):
+    # Emitted with a dict of paths, sizes and timings once both files have been written.
+    saved = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, picam2, compress_raw=False):
+        super().__init__()
+        self.picam2 = picam2
+        self.compress_raw = compress_raw
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+        self.queued = 0
+
+    @property
+    def pending(self):
+        """Number of captures still waiting to be written."""
+        return self.queued
+
+    def save(self, request, jpg_path, dng_path, ev=None, log=True, image=None):
+        """Queue a request's JPEG and DNG to be written, returning a Future for the report.
+
+        The report includes the capture's metadata record, which is also added to the metadata log
+        of the folder the files are in, unless log is False. image is the request's main image, if
+        the caller has already made it."""
+        if image is None:
+            image = request.make_image('main')
+        raw = request.make_buffer('raw')
+        metadata = request.get_metadata()
+        raw_config = request.config['raw']
+        with self.lock:
+            self.queued += 1
+        return self.executor.submit(self.write, image, raw, metadata, raw_config, jpg_path, dng_path, ev, log)
+
+    def write(self, image, raw, metadata, raw_config, jpg_path, dng_path, ev=None, log=True):
+        try:
+            start = time.monotonic()
+            self.picam2.helpers.save(image, metadata, jpg_path)
+            jpg_done = time.monotonic()
+            save_dng(raw, metadata, raw_config, dng_path, compress=self.compress_raw)
+            dng_done = time.monotonic()
+        except Exception as e:
+            self.failed.emit(f"Failed to save {jpg_path}: {e}")
+            raise
+        finally:
+            with self.lock:
+                self.queued -= 1
+        report = {
+            'jpg': jpg_path, 'jpg_bytes': os.path.getsize(jpg_path), 'jpg_time': jpg_done - start,
+            'dng': dng_path, 'dng_bytes': os.path.getsize(dng_path), 'dng_time': dng_done - jpg_done,
+            'compressed': self.compress_raw, 'record': capture_record(metadata, ev)
+        }
+        if log:
+            try:
+                append_record(os.path.dirname(jpg_path), os.path.splitext(os.path.basename(jpg_path))[0],
+                              report['record'])
+            except (OSError, TypeError, ValueError) as e:
+                print(f"Could not log the metadata of {jpg_path}: {e}")
+        print(f"Saved {jpg_path} ({report['jpg_bytes'] / 1e6:.1f}MB in {report['jpg_time']:.2f}s)",
+              f"and {dng_path} ({report['dng_bytes'] / 1e6:.1f}MB in {report['dng_time']:.2f}s)")
+        self.saved.emit(report)
+        return report
+
+    def wait(self):
+        """Wait for all queued captures to be written."""
+        self.executor.submit(lambda: None).result()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
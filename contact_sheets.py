@@ -0,0 +1,150 @@
+#! /usr/bin/env python3
+
+# Render an annotated dataset as pages of contact sheets, for checking the annotations.
+#
+# Each image is shown corrected with the gains that make its grey rectangle grey (worked out
+# just as the Rectangulator does), with the rectangle outlined and the scene's name and gains
+# underneath, so that a reviewer can look down a page of them for any that don't look right.
+# Rectangles too bright to trust are labelled in orange. JPEGs are decoded at reduced size
+# (the decoder's "draft" mode, which skips most of the work), and whole pages are shared out
+# over a pool of worker processes. A contents.csv file lists what is on each page.
+
+import sys
+import os
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image, ImageDraw
+from dataset_index import DatasetIndex
+from gain_transform import GainTransform, grey_gains
+
+# You can override these here, if you wish, or on the command line.
+INPUT_DIR = os.path.join(os.path.expanduser("~"), "awb-images")
+OUTPUT_DIR = "contact-sheets"
+COLUMNS = 6
+ROWS = 5
+TILE_WIDTH = 320  # Tiles are 4:3, and images are fitted inside them
+LABEL_HEIGHT = 28
+JPEG_QUALITY = 85
+SATURATED = 0.85  # Rectangles whose linear means go above this are too bright, as in the Rectangulator
+BACKGROUND = (40, 40, 40)
+RECT_COLOUR = (255, 0, 0)
+LABEL_COLOUR = (255, 255, 255)
+SATURATED_COLOUR = (255, 160, 0)
+
+transform = None  # made in each worker process as it's needed
+
+def render_tile(path, rect, tile_size):
+    """Return (image, (x0, y0, x1, y1) in the image, gains (B, G, R), saturated) for one capture."""
+    global transform
+    if transform is None:
+        transform = GainTransform(workers=1)
+    with Image.open(path) as image:
+        full_width, full_height = image.size
+        # The decoded image is still at least as big as the tile.
+        image.draft('RGB', tile_size)
+        image = image.convert('RGB')
+
+    # The rectangle's means are measured before shrinking the image to fit the tile, where there are more pixels.
+    scale_x, scale_y = image.width / full_width, image.height / full_height
+    x0, y0, x1, y1 = rect
+    box = (int(x0 * scale_x), int(y0 * scale_y), max(int(x1 * scale_x), int(x0 * scale_x) + 1),
+           max(int(y1 * scale_y), int(y0 * scale_y) + 1))
+    bgrx = np.empty((image.height, image.width, 4), dtype=np.uint8)
+    bgrx[..., :3] = np.asarray(image)[..., ::-1]
+    means = transform.rect_means(bgrx, (box[0], box[1], box[2] - box[0], box[3] - box[1])) + 0.001
+    saturated = bool(np.any(means > SATURATED))
+    gains = grey_gains(means)
+
+    image.thumbnail(tile_size, Image.BILINEAR)
+    bgrx = np.empty((image.height, image.width, 4), dtype=np.uint8)
+    bgrx[..., :3] = np.asarray(image)[..., ::-1]
+    corrected = transform.apply(bgrx, gains)
+    tile = Image.fromarray(np.ascontiguousarray(corrected[..., 2::-1]))
+    scale_x, scale_y = tile.width / full_width, tile.height / full_height
+    return tile, (x0 * scale_x, y0 * scale_y, x1 * scale_x, y1 * scale_y), gains, saturated
+
+def render_page(job):
+    """Render one page of captures, returning [(name, gains or None, saturated)]. Runs in a worker process."""
+    page_path, captures, columns, rows, tile_width = job
+    tile_size = (tile_width, tile_width * 3 // 4)
+    cell_height = tile_size[1] + LABEL_HEIGHT
+    page = Image.new('RGB', (columns * tile_size[0], rows * cell_height), BACKGROUND)
+    draw = ImageDraw.Draw(page)
+    max_chars = tile_size[0] // 6  # the default font is about 6 pixels wide
+    results = []
+    for i, (name, path, rect) in enumerate(captures):
+        x, y = (i % columns) * tile_size[0], (i // columns) * cell_height
+        label = ",".join(name.split(',')[:3])
+        try:
+            tile, box, gains, saturated = render_tile(path, rect, tile_size)
+        except (OSError, ValueError) as e:
+            draw.text((x + 4, y + tile_size[1] + 2), label[:max_chars], fill=LABEL_COLOUR)
+            draw.text((x + 4, y + tile_size[1] + 14), f"Failed: {e}"[:max_chars], fill=SATURATED_COLOUR)
+            results.append((name, None, False))
+            continue
+        left, top = x + (tile_size[0] - tile.width) // 2, y + (tile_size[1] - tile.height) // 2
+        page.paste(tile, (left, top))
+        draw.rectangle((left + box[0], top + box[1], left + box[2], top + box[3]), outline=RECT_COLOUR, width=2)
+        colour = SATURATED_COLOUR if saturated else LABEL_COLOUR
+        draw.text((x + 4, y + tile_size[1] + 2), label[:max_chars], fill=colour)
+        text = f"R {gains[2]:.2f}  B {gains[0]:.2f}" + ("  too bright" if saturated else "")
+        draw.text((x + 4, y + tile_size[1] + 14), text, fill=colour)
+        results.append((name, gains, saturated))
+    page.save(page_path, quality=JPEG_QUALITY)
+    return results
+
+def render(input_dir, output_dir, columns=COLUMNS, rows=ROWS, tile_width=TILE_WIDTH, user=None, sensor=None,
+           scene=None, workers=None, progress=True):
+    """Render every annotated capture in input_dir to pages in output_dir, returning the number of pages."""
+    index = DatasetIndex(input_dir)
+    selected = [row for row in index.select(user=user, sensor=sensor, scene=scene, annotated=True)
+                if index.jpg_files[row]]
+    captures = [(str(index.names[row]), index.path(row, 'jpg'), tuple(int(v) for v in index.rects[row]))
+                for row in selected]
+    per_page = columns * rows
+    pages = [captures[i:i + per_page] for i in range(0, len(captures), per_page)]
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = [(os.path.join(output_dir, f"page-{n + 1:04d}.jpg"), page, columns, rows, tile_width)
+            for n, page in enumerate(pages)]
+    if progress:
+        print(f"Rendering {len(captures)} captures on {len(pages)} pages", file=sys.stderr)
+
+    contents_path = os.path.join(output_dir, "contents.csv")
+    with open(contents_path + ".tmp", 'w') as f, ProcessPoolExecutor(max_workers=workers) as pool:
+        f.write("page,row,column,name,gain_r,gain_b,too_bright\n")
+        for n, results in enumerate(pool.map(render_page, jobs)):
+            for i, (name, gains, saturated) in enumerate(results):
+                gain_text = f"{gains[2]:.3f},{gains[0]:.3f}" if gains else ","
+                f.write(f'{n + 1},{i // columns + 1},{i % columns + 1},"{name}",{gain_text},{int(saturated)}\n')
+            if progress and ((n + 1) % 10 == 0 or n + 1 == len(jobs)):
+                print(f"Rendered {n + 1} of {len(jobs)} pages", file=sys.stderr)
+    os.replace(contents_path + ".tmp", contents_path)
+    return len(pages)
+
+if __name__ == '__main__':
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='AWB dataset contact sheets')
+    parser.add_argument('--input-dir', type=str, default=INPUT_DIR,
+                        help=f'Directory of annotated captures (default: {INPUT_DIR})')
+    parser.add_argument('-o', '--output-dir', type=str, default=OUTPUT_DIR,
+                        help=f'Directory to write the pages to (default: {OUTPUT_DIR})')
+    parser.add_argument('--columns', type=int, default=COLUMNS, help=f'Images across each page (default: {COLUMNS})')
+    parser.add_argument('--rows', type=int, default=ROWS, help=f'Images down each page (default: {ROWS})')
+    parser.add_argument('--tile-width', type=int, default=TILE_WIDTH,
+                        help=f'Width of each image on the page, in pixels (default: {TILE_WIDTH})')
+    parser.add_argument('--user', type=str, default=None, help='Only show this user\'s captures')
+    parser.add_argument('--sensor', type=str, default=None, help='Only show captures from this sensor')
+    parser.add_argument('--scene', type=str, default=None, help='Only show scenes whose IDs contain this')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Number of worker processes (default: one per CPU)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Do not report progress')
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    pages = render(args.input_dir, args.output_dir, columns=args.columns, rows=args.rows, tile_width=args.tile_width,
+                   user=args.user, sensor=args.sensor, scene=args.scene, workers=args.workers,
+                   progress=not args.quiet)
+    if not args.quiet:
+        print(f"Wrote {pages} pages to {args.output_dir} in {time.monotonic() - start:.1f}s", file=sys.stderr)
@@ -0,0 +1,168 @@
+# A columnar index of the captures in a directory, for tools and scripts that query a dataset.
+#
+# The directory is scanned once into numpy arrays, one entry per capture (sorted by name):
+# the user, sensor, scene id and rectangle from its name, and the names, sizes and
+# modification times of its JPEG and DNG files. The index is saved in a subdirectory of the
+# captures' directory (so that saving it doesn't change the captures' directory), along with
+# the directory's own modification time, so opening an unchanged dataset only needs to load
+# one file. When files have been added, removed or renamed, only the new names need to
+# be looked at. A file rewritten in place doesn't change the directory, so tools that depend
+# on the sizes and modification times being right should refresh with full=True.
+#
+# There is no Qt dependency here, so this can be used from any script.
+
+import os
+import time
+import numpy as np
+from capture_names import parse_basename, list_captures
+
+INDEX_DIR = ".dataset-index"
+INDEX_NAME = "index.npz"
+INDEX_VERSION = 1
+RACY_TIME = 2 * 10**9  # Don't trust directory times this close to now, in ns (FAT only has 2 second times)
+
+COLUMNS = {
+    'names': str,
+    'users': str,
+    'sensors': str,
+    'scene_ids': str,
+    'rects': np.int32,  # (N, 4) x0, y0, x1, y1, or all -1 if not annotated
+    'jpg_files': str,  # the file names, or "" if missing
+    'dng_files': str,
+    'jpg_sizes': np.int64,  # -1 if missing
+    'dng_sizes': np.int64,
+    'jpg_mtimes': np.int64,  # st_mtime_ns, -1 if missing
+    'dng_mtimes': np.int64,
+}
+
+def file_stat(directory, filename):
+    if not filename:
+        return -1, -1
+    st = os.stat(os.path.join(directory, filename))
+    return st.st_size, st.st_mtime_ns
+
+class DatasetIndex:
+    """The captures in a directory. Each column in COLUMNS is an attribute holding a numpy array."""
+
+    def __init__(self, directory, full=False, save=True):
+        self.directory = directory
+        self.directory_mtime = None
+        for column, dtype in COLUMNS.items():
+            setattr(self, column, np.zeros((0, 4) if column == 'rects' else 0, dtype=dtype))
+        self.index_path = os.path.join(directory, INDEX_DIR, INDEX_NAME)
+        if save:
+            # Make this before the directory is looked at, as it changes the directory's modification time.
+            try:
+                os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            except OSError as e:
+                print(f"Could not create {os.path.dirname(self.index_path)}: {e}")
+                save = False
+        if not full:
+            self.load()
+        if self.refresh(full) and save:
+            self.save()
+
+    def __len__(self):
+        return len(self.names)
+
+    def load(self):
+        try:
+            with np.load(self.index_path) as data:
+                if data['version'] != INDEX_VERSION:
+                    return
+                for column in COLUMNS:
+                    setattr(self, column, data[column])
+                self.directory_mtime = int(data['directory_mtime'])
+                if self.directory_mtime < 0:
+                    self.directory_mtime = None  # saved too soon after a change to be trusted
+        except (OSError, KeyError, ValueError):
+            pass
+
+    def save(self):
+        # np.savez adds ".npz" to names not ending with it.
+        tmp_path = self.index_path[:-len(".npz")] + ".tmp.npz"
+        directory_mtime = -1 if self.directory_mtime is None else self.directory_mtime
+        try:
+            np.savez(tmp_path, version=INDEX_VERSION, directory_mtime=directory_mtime,
+                     **{column: getattr(self, column) for column in COLUMNS})
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            print(f"Could not save {self.index_path}: {e}")
+
+    def refresh(self, full=False):
+        """Bring the index up to date with the directory, returning True if anything was looked at again.
+
+        Normally only new names are looked at, but full=True finds the sizes and modification times of every file."""
+        # Take the directory's time first, so that anything changing during the scan is seen next time.
+        directory_mtime = os.stat(self.directory).st_mtime_ns
+        if not full and directory_mtime == self.directory_mtime:
+            return False
+        previous = {} if full else {name: (i, jpg_file, dng_file) for i, (name, jpg_file, dng_file)
+                                    in enumerate(zip(self.names.tolist(), self.jpg_files.tolist(), self.dng_files.tolist()))}
+        captures = list_captures(self.directory)
+        reused = []  # rows of the current index that are still right
+        values = {column: [] for column in COLUMNS}
+        for name, files in captures.items():
+            jpg_file, dng_file = files.get('jpg', ""), files.get('dng', "")
+            old = previous.get(name)
+            if old and old[1:] == (jpg_file, dng_file):
+                reused.append(old[0])
+                continue
+            try:
+                jpg_stat = file_stat(self.directory, jpg_file)
+                dng_stat = file_stat(self.directory, dng_file)
+            except OSError:
+                continue  # removed while we were looking
+            fields = parse_basename(name)
+            for column, value in (('names', name), ('users', fields['user']), ('sensors', fields['sensor']),
+                                  ('scene_ids', fields['scene_id']), ('rects', fields['rect'] or (-1, -1, -1, -1)),
+                                  ('jpg_files', jpg_file), ('dng_files', dng_file),
+                                  ('jpg_sizes', jpg_stat[0]), ('dng_sizes', dng_stat[0]),
+                                  ('jpg_mtimes', jpg_stat[1]), ('dng_mtimes', dng_stat[1])):
+                values[column].append(value)
+        reused = np.array(reused, dtype=np.intp)
+        columns = {}
+        for column, dtype in COLUMNS.items():
+            new = np.array(values[column], dtype=dtype)
+            columns[column] = np.concatenate([getattr(self, column)[reused],
+                                              new.reshape(-1, 4) if column == 'rects' else new])
+        order = np.argsort(columns['names'], kind='stable')
+        for column, array in columns.items():
+            setattr(self, column, array[order])
+        # A change made just after the scan, within the same tick of the directory's clock, wouldn't
+        # change its time, so a time that recent is only trusted once it's old enough.
+        self.directory_mtime = directory_mtime if time.time_ns() - directory_mtime > RACY_TIME else None
+        return True
+
+    def select(self, user=None, sensor=None, scene=None, annotated=None, complete=None):
+        """Return the rows of the captures matching all the conditions given.
+
+        user and sensor must match exactly, scene is found anywhere in the scene id, annotated says
+        whether the capture has a rectangle, and complete whether it has both its JPEG and DNG."""
+        mask = np.ones(len(self), dtype=bool)
+        if user is not None:
+            mask &= self.users == user
+        if sensor is not None:
+            mask &= self.sensors == sensor
+        if scene is not None:
+            mask &= np.char.find(self.scene_ids, scene) >= 0
+        if annotated is not None:
+            mask &= (self.rects[:, 0] >= 0) == annotated
+        if complete is not None:
+            mask &= ((self.jpg_files != "") & (self.dng_files != "")) == complete
+        return np.flatnonzero(mask)
+
+    def fields(self, row):
+        """Return the fields of a capture's name, in the same form as capture_names.parse_basename."""
+        rect = tuple(int(v) for v in self.rects[row]) if self.rects[row, 0] >= 0 else None
+        return {'user': str(self.users[row]), 'sensor': str(self.sensors[row]),
+                'scene_id': str(self.scene_ids[row]), 'rect': rect}
+
+    def path(self, row, ext):
+        """Return the path of a capture's 'jpg' or 'dng' file, or None if it doesn't have one."""
+        filename = getattr(self, ext + '_files')[row]
+        return os.path.join(self.directory, filename) if filename else None
+
+    def key(self, row):
+        """The sizes and modification times of a capture's files, for keying caches of results."""
+        return [int(self.jpg_sizes[row]), int(self.jpg_mtimes[row]), int(self.dng_sizes[row]), int(self.dng_mtimes[row])]
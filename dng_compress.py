@@ -0,0 +1,184 @@
+# Writing DNG files with lossless JPEG (LJ92) compression.
+#
+# PiDNG can write compressed DNGs, but its native encoder doesn't work on current versions of
+# Python, so we supply our own. It is vectorised with numpy and works in bands of rows to keep
+# memory use down. Each image row is coded as one row of a two component lossless JPEG, so that
+# every sample is predicted from the one two pixels to its left, which has the same colour.
+# Compressed DNGs are read by anything using LibRaw (including rawpy) or the Adobe DNG SDK.
+
+import numpy as np
+from pidng.core import PICAM2DNG
+from pidng.dng import Tag, dngIFD, dngTag, DNG
+from pidng.defs import Compression, DNGVersion
+from pidng.camdefs import Picamera2Camera
+
+BAND_SAMPLES = 1 << 20  # Roughly how many samples to code at a time
+
+# Number of bits needed to represent each difference magnitude (the "SSSS" category).
+CATEGORIES = np.array([int(i).bit_length() for i in range(1 << 16 | 1)], dtype=np.uint8)
+
+def huffman_table(freq):
+    """Make a length-limited Huffman table for the 17 categories, as in ITU T.81 Annex K.2."""
+    freq = list(freq) + [1]  # A reserved symbol makes sure no real code is all ones
+    n = len(freq)
+    codesize = [0] * n
+    others = [-1] * n
+    while True:
+        c1 = c2 = -1
+        for i in range(n):
+            if freq[i] and (c1 < 0 or freq[i] <= freq[c1]):
+                c1 = i
+        for i in range(n):
+            if freq[i] and i != c1 and (c2 < 0 or freq[i] <= freq[c2]):
+                c2 = i
+        if c2 < 0:
+            break
+        freq[c1] += freq[c2]
+        freq[c2] = 0
+        codesize[c1] += 1
+        while others[c1] >= 0:
+            c1 = others[c1]
+            codesize[c1] += 1
+        others[c1] = c2
+        codesize[c2] += 1
+        while others[c2] >= 0:
+            c2 = others[c2]
+            codesize[c2] += 1
+    bits = [0] * 33
+    for size in codesize:
+        if size:
+            bits[size] += 1
+    for i in range(32, 16, -1):
+        while bits[i] > 0:
+            j = i - 2
+            while bits[j] == 0:
+                j -= 1
+            bits[i] -= 2
+            bits[i - 1] += 1
+            bits[j + 1] += 2
+            bits[j] -= 1
+    i = 16
+    while bits[i] == 0:
+        i -= 1
+    bits[i] -= 1  # Drop the reserved symbol
+    values = [s for size in range(1, 33) for s in range(n - 1) if codesize[s] == size]
+
+    # Assign the canonical codes (Annex C).
+    codes = np.zeros(n - 1, dtype=np.uint64)
+    lengths = np.zeros(n - 1, dtype=np.uint64)
+    code = 0
+    k = 0
+    for length in range(1, 17):
+        for _ in range(bits[length]):
+            codes[values[k]] = code
+            lengths[values[k]] = length
+            code += 1
+            k += 1
+        code <<= 1
+    return bits[1:17], values, codes, lengths
+
+def encode_lj92(raw, precision):
+    """Losslessly JPEG encode a 2D uint16 Bayer image, returning the bytes."""
+    height, width = raw.shape
+    raw = raw.astype(np.int32)
+
+    # Predict each sample from the same colour two pixels to the left, or at the start of a row
+    # from the one above, or for the very first samples from the middle of the range.
+    diff = np.empty_like(raw)
+    diff[:, 2:] = raw[:, 2:] - raw[:, :-2]
+    diff[1:, :2] = raw[1:, :2] - raw[:-1, :2]
+    diff[0, :2] = raw[0, :2] - (1 << (precision - 1))
+    # Differences are modulo 2^16, with 32768 having a category but no extra bits.
+    diff &= 0xffff
+    diff[diff > 32768] -= 65536
+    category = CATEGORIES[np.abs(diff)]
+    freq = np.bincount(category.ravel(), minlength=17)
+    bits, values, codes, lengths = huffman_table(freq)
+
+    out = bytearray(b'\xff\xd8')
+    out += b'\xff\xc4' + (3 + 16 + len(values)).to_bytes(2, 'big') + b'\x00' + bytes(bits) + bytes(values)
+    out += b'\xff\xc3' + (8 + 3 * 2).to_bytes(2, 'big') + bytes([precision])
+    out += height.to_bytes(2, 'big') + (width // 2).to_bytes(2, 'big') + b'\x02\x01\x11\x00\x02\x11\x00'
+    out += b'\xff\xda' + (6 + 2 * 2).to_bytes(2, 'big') + b'\x02\x01\x00\x02\x00\x01\x00\x00'
+
+    band = max(1, BAND_SAMPLES // width)
+    bit_offset = 0
+    carry = 0
+    for row in range(0, height, band):
+        d = diff[row:row + band].ravel().astype(np.int64)
+        c = category[row:row + band].ravel()
+        extra_len = np.where(c == 16, 0, c).astype(np.uint64)
+        extra = (np.where(d < 0, d - 1, d).astype(np.uint64)) & ((np.uint64(1) << extra_len) - np.uint64(1))
+        length = lengths[c] + extra_len
+        value = (codes[c] << extra_len) | extra
+
+        # Each code is at most 31 bits, so starting anywhere in a byte it touches at most five
+        # bytes. Codes never share bits, so adding up their bytes is the same as OR-ing them.
+        end = np.cumsum(length) + np.uint64(bit_offset)
+        start = end - length
+        total_bits = int(end[-1])
+        window = value << (np.uint64(40) - length - (start & np.uint64(7)))
+        first_byte = (start >> np.uint64(3)).astype(np.int64)
+        packed = np.zeros((total_bits + 7) // 8 + 5, dtype=np.float64)
+        for k in range(5):
+            byte = (window >> np.uint64(32 - 8 * k)) & np.uint64(0xff)
+            packed += np.bincount(first_byte + k, weights=byte.astype(np.float64), minlength=len(packed))
+        packed = packed.astype(np.uint8)
+        packed[0] |= carry
+        full_bytes = total_bits // 8
+        bit_offset = total_bits % 8
+        carry = int(packed[full_bytes]) if bit_offset else 0
+        out += stuff(packed[:full_bytes])
+
+    if bit_offset:
+        # Pad the last byte with ones.
+        out += stuff(np.array([carry | (0xff >> bit_offset)], dtype=np.uint8))
+    out += b'\xff\xd9'
+    return bytes(out)
+
+def stuff(data):
+    """Insert the zero byte that must follow every 0xff in the entropy coded data."""
+    ff = np.flatnonzero(data == 0xff)
+    if len(ff):
+        data = np.insert(data, ff + 1, 0)
+    return data.tobytes()
+
+class CompressedPICAM2DNG(PICAM2DNG):
+    """PICAM2DNG that uses our own lossless JPEG encoder when asked to compress."""
+
+    def __process__(self, rawFrame, tags, compress):
+        if not compress:
+            return super().__process__(rawFrame, tags, compress)
+
+        bpp = tags.get(Tag.BitsPerSample).rawValue[0]
+        precision = bpp if int(rawFrame.max()) < (1 << bpp) else 16
+        tile = encode_lj92(rawFrame, precision)
+
+        # The rest is as PiDNG does it.
+        dng = DNG()
+        dng.ImageDataStrips.append(tile)
+        ifd = dngIFD()
+        offsets = dngTag(Tag.TileOffsets, [0])
+        ifd.tags.append(offsets)
+        ifd.tags.append(dngTag(Tag.NewSubfileType, [0]))
+        ifd.tags.append(dngTag(Tag.TileByteCounts, [len(tile)]))
+        ifd.tags.append(dngTag(Tag.Compression, [Compression.LJ92]))
+        ifd.tags.append(dngTag(Tag.Software, "PiDNG"))
+        ifd.tags.append(dngTag(Tag.DNGVersion, DNGVersion.V1_4))
+        ifd.tags.append(dngTag(Tag.DNGBackwardVersion, DNGVersion.V1_0))
+        for tag in tags.list():
+            ifd.tags.append(tag)
+        dng.IFDs.append(ifd)
+        buf = bytearray(dng.dataLen())
+        offsets.setValue([k for offset, k in dng.StripOffsets.items()])
+        dng.setBuffer(buf)
+        dng.write()
+        return buf
+
+def save_dng(raw, metadata, raw_config, filename, compress=False):
+    """Save a raw buffer (as from request.make_buffer) like Picamera2's save_dng, optionally compressed."""
+    width, height = raw_config['size']
+    raw = raw.reshape((height, raw_config['stride']))
+    dng = CompressedPICAM2DNG(Picamera2Camera(dict(raw_config), metadata))
+    dng.options(compress=compress)
+    dng.convert(raw, filename)
@@ -0,0 +1,217 @@
+#! /usr/bin/env python3
+
+# Score AWB algorithms against the grey rectangles of an annotated dataset.
+#
+# The dataset is loaded once from the .npz file written by zonestats.py, which holds each
+# image's grid of raw zone statistics and the raw means of its grey rectangle. Each estimator
+# takes the zone statistics of a whole batch of images at once and returns the illuminant
+# colour it estimates for each of them, and batches are shared out over a pool of worker
+# processes. The error of an estimate is the angle between it and the grey rectangle's colour.
+#
+# Besides the built in estimators, any function with the same signature can be evaluated by
+# giving it as "module:function". The camera's own AWB, from the gains recorded when each image
+# was captured, is scored too where they are known.
+
+import sys
+import os
+import argparse
+import importlib
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from zonestats import load_zonestats
+
+# You can override these here, if you wish, or on the command line.
+STATS_FILE = "zonestats.npz"
+CT_CURVE_FILE = "ct_curve.json"
+MAX_CLIPPED = 0.01  # Leave out images whose grey rectangle has more than this fraction of clipped pixels
+BATCH_SIZE = 256
+CT_STEPS = 64  # Number of points along the CT curve that the CT search tries
+SEARCH_SIGMA = 0.1  # How close (in log R/G, log B/G) a zone must be to a candidate to count as grey
+CAMERA = 'camera'  # The camera's own AWB
+
+def grey_world(zones, counts, sensors, curves):
+    """Assume the average colour of the scene is grey."""
+    totals = (zones * counts[..., None]).sum(axis=(1, 2))
+    return totals / np.maximum(counts.sum(axis=(1, 2)), 1)[:, None]
+
+def white_patch(zones, counts, sensors, curves):
+    """Assume the brightest (unclipped) value of each channel is white."""
+    return np.where(counts[..., None] > 0, zones, 0).max(axis=(1, 2))
+
+def sample_curve(ct_curve, steps=CT_STEPS):
+    """Return (cts, log R/G, log B/G) at evenly spaced mireds along a [ct, r, b, ...] curve."""
+    curve = np.array(ct_curve, dtype=np.float64).reshape(-1, 3)
+    curve = curve[np.argsort(curve[:, 0])]
+    cts = 1e6 / np.linspace(1e6 / curve[0, 0], 1e6 / curve[-1, 0], steps)
+    # The curve is interpolated in mireds, which R/G is close to linear in.
+    mireds = 1e6 / curve[::-1, 0]
+    log_r = np.interp(1e6 / cts, mireds, np.log(curve[::-1, 1]))
+    log_b = np.interp(1e6 / cts, mireds, np.log(curve[::-1, 2]))
+    return cts, log_r, log_b
+
+def ct_search(zones, counts, sensors, curves):
+    """Find the point on the sensor's CT curve that the most (and brightest) zones look grey under.
+
+    Images from sensors without a CT curve get NaN estimates."""
+    estimates = np.full((len(zones), 3), np.nan)
+    green = zones[..., 1]
+    valid = (counts > 0) & (green > 0) & (zones[..., 0] > 0) & (zones[..., 2] > 0)
+    safe_green = np.where(valid, green, 1)
+    log_r = np.log(np.where(valid, zones[..., 0], 1) / safe_green)
+    log_b = np.log(np.where(valid, zones[..., 2], 1) / safe_green)
+    weights = np.where(valid, counts * green, 0)
+    for sensor in np.unique(sensors):
+        curve = curves.get(str(sensor))
+        if curve is None:
+            continue
+        images = np.flatnonzero(sensors == sensor)
+        _, curve_r, curve_b = curve
+        scores = np.zeros((len(images), len(curve_r)))
+        # Going one candidate at a time keeps the temporary arrays to the size of the zone grids.
+        for k, (r, b) in enumerate(zip(curve_r, curve_b)):
+            distance = (log_r[images] - r) ** 2 + (log_b[images] - b) ** 2
+            scores[:, k] = (weights[images] * np.exp(distance / (-2 * SEARCH_SIGMA ** 2))).sum(axis=(1, 2))
+        best = scores.argmax(axis=1)
+        estimates[images] = np.stack([np.exp(curve_r[best]), np.ones(len(images)), np.exp(curve_b[best])], axis=1)
+    return estimates
+
+ESTIMATORS = {
+    'grey-world': grey_world,
+    'white-patch': white_patch,
+    'ct-search': ct_search,
+}
+
+def camera_estimates(colour_gains):
+    """The illuminant colours implied by the camera's AWB gains (NaN where they aren't known)."""
+    with np.errstate(divide='ignore'):
+        return np.stack([1 / colour_gains[:, 0], np.ones(len(colour_gains)), 1 / colour_gains[:, 1]], axis=1)
+
+def find_estimator(name):
+    """Look up a built in estimator, or import one given as "module:function"."""
+    if name in ESTIMATORS:
+        return ESTIMATORS[name]
+    if ':' not in name:
+        raise ValueError(f"unknown estimator {name}, use one of {', '.join(ESTIMATORS)} or module:function")
+    module, function = name.split(':', 1)
+    return getattr(importlib.import_module(module), function)
+
+def load_curves(path):
+    """Load the CT curves written by calibrator.py, sampled ready for the CT search."""
+    with open(path) as f:
+        calibration = json.load(f)
+    return {sensor: sample_curve(fit['ct_curve']) for sensor, fit in calibration.items() if fit.get('ct_curve')}
+
+def angular_error(estimates, truth):
+    """Angle in degrees between each estimated and true illuminant colour."""
+    dot = (estimates * truth).sum(axis=1)
+    norms = np.linalg.norm(estimates, axis=1) * np.linalg.norm(truth, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.degrees(np.arccos(np.clip(dot / norms, -1, 1)))
+
+def evaluate_batch(job):
+    """Run the estimators on one batch of images, returning {estimator: errors}. Runs in a worker process."""
+    names, zones, counts, sensors, truth, curves = job
+    return {name: angular_error(find_estimator(name)(zones, counts, sensors, curves), truth) for name in names}
+
+def evaluate(stats, estimators, curves, workers=None, batch_size=BATCH_SIZE, progress=True):
+    """Return {estimator: per-image angular errors} for every image in the loaded zonestats export."""
+    if not estimators:
+        return {}
+    n = len(stats['names'])
+    jobs = [(estimators, stats['zones'][i:i + batch_size], stats['counts'][i:i + batch_size],
+             stats['sensors'][i:i + batch_size], stats['truth'][i:i + batch_size], curves)
+            for i in range(0, n, batch_size)]
+    errors = {name: [] for name in estimators}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for i, result in enumerate(pool.map(evaluate_batch, jobs)):
+            for name in estimators:
+                errors[name].append(result[name])
+            if progress and ((i + 1) % 10 == 0 or i + 1 == len(jobs)):
+                print(f"Evaluated {min((i + 1) * batch_size, n)} of {n}", file=sys.stderr)
+    return {name: np.concatenate(errors[name]) if errors[name] else np.zeros(0) for name in estimators}
+
+def summarise(errors):
+    """Return the usual colour constancy statistics of some angular errors, leaving out NaNs."""
+    errors = np.sort(errors[~np.isnan(errors)])
+    if len(errors) == 0:
+        return None
+    q1, median, q3 = np.percentile(errors, [25, 50, 75])
+    return {'images': len(errors), 'mean': errors.mean(), 'median': median,
+            'trimean': (q1 + 2 * median + q3) / 4, 'best25': errors[:max(1, len(errors) // 4)].mean(),
+            'worst25': errors[-max(1, len(errors) // 4):].mean(), 'max': errors[-1]}
+
+def report(stats, errors):
+    columns = ('images', 'mean', 'median', 'trimean', 'best25', 'worst25', 'max')
+    print(f"{'estimator':<16}{'sensor':<12}" + "".join(f"{column:>9}" for column in columns))
+    for name, estimator_errors in errors.items():
+        groups = [('all', np.ones(len(estimator_errors), dtype=bool))]
+        groups += [(sensor, stats['sensors'] == sensor) for sensor in np.unique(stats['sensors'])]
+        for sensor, selected in groups:
+            summary = summarise(estimator_errors[selected])
+            if summary is None:
+                print(f"{name:<16}{sensor:<12}{0:>9}")
+                continue
+            print(f"{name:<16}{sensor:<12}{summary['images']:>9}" +
+                  "".join(f"{summary[column]:>9.2f}" for column in columns[1:]))
+
+def write_per_image(path, stats, errors):
+    with open(path, 'w') as f:
+        f.write(",".join(['name', 'sensor'] + list(errors)) + "\n")
+        for i, (name, sensor) in enumerate(zip(stats['names'], stats['sensors'])):
+            f.write(f'"{name}",{sensor},' + ",".join(f"{errors[e][i]:.3f}" for e in errors) + "\n")
+
+if __name__ == '__main__':
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='AWB algorithm evaluator')
+    parser.add_argument('--stats', type=str, default=STATS_FILE,
+                        help=f'Zone statistics written by zonestats.py (default: {STATS_FILE})')
+    parser.add_argument('--ct-curve', type=str, default=CT_CURVE_FILE,
+                        help=f'CT curves written by calibrator.py, for the CT search (default: {CT_CURVE_FILE})')
+    parser.add_argument('-e', '--estimator', type=str, action='append',
+                        help='Estimator to evaluate, may be given more than once: '
+                        f'{", ".join(ESTIMATORS)}, {CAMERA} or module:function (default: all the built in ones)')
+    parser.add_argument('--max-clipped', type=float, default=MAX_CLIPPED,
+                        help=f'Leave out images whose grey rectangle is more clipped than this (default: {MAX_CLIPPED})')
+    parser.add_argument('--per-image', type=str, default=None,
+                        help='Write every image\'s errors to this CSV file')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Number of worker processes (default: one per CPU)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Do not report progress')
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    estimators = args.estimator or list(ESTIMATORS)
+    try:
+        for name in estimators:
+            if name != CAMERA:
+                find_estimator(name)
+    except (ValueError, ImportError, AttributeError) as e:
+        parser.error(str(e))
+    curves = {}
+    if os.path.exists(args.ct_curve):
+        curves = load_curves(args.ct_curve)
+    elif 'ct-search' in estimators:
+        print(f"No {args.ct_curve}, so the CT search can't be evaluated", file=sys.stderr)
+
+    stats = load_zonestats(args.stats)
+    keep = stats['truth_clipped'] <= args.max_clipped
+    stats = {key: value[keep] for key, value in stats.items()}
+    if not args.quiet:
+        print(f"Loaded {len(stats['names'])} images ({np.count_nonzero(~keep)} too clipped) "
+              f"in {time.monotonic() - start:.1f}s", file=sys.stderr)
+
+    errors = {}
+    camera = CAMERA in estimators or (not args.estimator and 'colour_gains' in stats
+                                      and not np.isnan(stats['colour_gains']).all())
+    estimators = [name for name in estimators if name != CAMERA]
+    if camera:
+        gains = stats.get('colour_gains', np.full((len(stats['names']), 2), np.nan))
+        errors[CAMERA] = angular_error(camera_estimates(gains), stats['truth'])
+    errors.update(evaluate(stats, estimators, curves, workers=args.workers, progress=not args.quiet))
+    report(stats, errors)
+    if args.per_image:
+        write_per_image(args.per_image, stats, errors)
+    if not args.quiet:
+        print(f"Finished in {time.monotonic() - start:.1f}s", file=sys.stderr)
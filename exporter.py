@@ -0,0 +1,96 @@
+#! /usr/bin/env python3
+
+# Export a folder of captures as a single zip archive with an index.
+#
+# The JPEG and DNG files are stored uncompressed, and the last member of the archive is
+# index.json, listing every scene's parsed fields and rectangle along with the offset, size
+# and SHA-256 checksum of each of its files. A reader can therefore fetch any image with a
+# single seek and read. Files are streamed through in chunks so memory use doesn't depend on
+# the size of the dataset, and the archive can even be written to stdout.
+
+import sys
+import os
+import argparse
+import hashlib
+import json
+import zipfile
+import time
+from dataset_index import DatasetIndex
+
+# You can override these here, if you wish, or on the command line.
+INPUT_DIR = os.path.join(os.path.expanduser("~"), "awb-images")
+CHUNK_SIZE = 1 << 20
+INDEX_NAME = "index.json"
+INDEX_VERSION = 1
+
+def add_file(archive, path, name):
+    """Stream one file into the archive, returning its index entry."""
+    st = os.stat(path)
+    zinfo = zipfile.ZipInfo(name, date_time=time.localtime(st.st_mtime)[:6])
+    zinfo.compress_type = zipfile.ZIP_STORED
+    zinfo.file_size = st.st_size
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as src, archive.open(zinfo, 'w') as dst:
+        # The local header has just been written, so the data starts right after it.
+        offset = zinfo.header_offset + 30 + len(zinfo.filename.encode('utf-8')) + len(zinfo.extra)
+        while True:
+            chunk = src.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            dst.write(chunk)
+    return {'name': name, 'offset': offset, 'size': st.st_size, 'sha256': sha256.hexdigest()}
+
+def export(input_dir, output, progress=True):
+    """Write every JPEG/DNG pair in input_dir to the archive file object output. Returns the index."""
+    captures = DatasetIndex(input_dir)
+    scenes = []
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for row in range(len(captures)):
+            basename = str(captures.names[row])
+            if not captures.jpg_files[row] or not captures.dng_files[row]:
+                print(f"Skipping {basename}: no matching", "DNG" if captures.jpg_files[row] else "JPEG", file=sys.stderr)
+                continue
+            scene = captures.fields(row)
+            scene['rect'] = list(scene['rect']) if scene['rect'] else None
+            scene['name'] = basename
+            scene['files'] = {ext: add_file(archive, captures.path(row, ext), str(getattr(captures, ext + '_files')[row]))
+                              for ext in ('jpg', 'dng')}
+            scenes.append(scene)
+            if progress and (row + 1) % 100 == 0:
+                print(f"Exported {row + 1} of {len(captures)} scenes", file=sys.stderr)
+        index = {'version': INDEX_VERSION, 'scenes': scenes}
+        archive.writestr(INDEX_NAME, json.dumps(index, separators=(',', ':')))
+    return index
+
+def load_index(archive_path):
+    """Read the index from an exported archive (only the end of the file is read)."""
+    with zipfile.ZipFile(archive_path) as archive:
+        return json.loads(archive.read(INDEX_NAME))
+
+def read_scene_file(f, entry, verify=False):
+    """Read one file of a scene, given its index entry, from an open archive file."""
+    f.seek(entry['offset'])
+    data = f.read(entry['size'])
+    if verify and hashlib.sha256(data).hexdigest() != entry['sha256']:
+        raise ValueError(f"Checksum mismatch for {entry['name']}")
+    return data
+
+if __name__ == '__main__':
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='AWB dataset exporter')
+    parser.add_argument('--input-dir', type=str, default=INPUT_DIR,
+                        help=f'Directory of captures to export (default: {INPUT_DIR})')
+    parser.add_argument('-o', '--output', type=str, required=True,
+                        help='Output archive, or - to write to stdout')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Do not report progress')
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    if args.output == '-':
+        index = export(args.input_dir, sys.stdout.buffer, progress=not args.quiet)
+    else:
+        with open(args.output, 'wb') as f:
+            index = export(args.input_dir, f, progress=not args.quiet)
+    if not args.quiet:
+        print(f"Exported {len(index['scenes'])} scenes in {time.monotonic() - start:.1f}s", file=sys.stderr)
@@ -0,0 +1,91 @@
+# Live exposure statistics for the capture preview.
+#
+# A few times a second a small, subsampled copy of a preview frame is taken in the camera's
+# pre-callback (which is all the camera thread has to do, so the preview doesn't drop frames),
+# and a worker thread then measures how much of the image is clipped, how much of it is close
+# to neutral, and its grey world colour balance. The results come back as a signal, along
+# with an RGBA overlay marking the clipped and neutral pixels, which can be given straight to
+# the preview widget's set_overlay.
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PyQt5.QtCore import QObject, pyqtSignal
+from remote_preview import request_to_rgb
+
+# Pixels with any channel at or above this level count as clipped.
+CLIP_LEVEL = 250
+# Pixels darker than this (on the green channel) are too noisy to call neutral.
+DARK_LEVEL = 24
+# Unclipped pixels whose R/G and B/G are within this of 1 count as neutral.
+NEUTRAL_TOLERANCE = 0.08
+CLIP_COLOUR = (255, 0, 0, 160)
+NEUTRAL_COLOUR = (0, 255, 0, 80)
+
+def exposure_stats(rgb):
+    """Return the statistics dict and RGBA overlay for a uint8 RGB image."""
+    clipped = (rgb >= CLIP_LEVEL).any(axis=2)
+    rgb = rgb.astype(np.float32)
+    g = np.maximum(rgb[..., 1], 1)
+    r_g = rgb[..., 0] / g
+    b_g = rgb[..., 2] / g
+    neutral = ~clipped & (rgb[..., 1] >= DARK_LEVEL) & \
+        (np.abs(r_g - 1) < NEUTRAL_TOLERANCE) & (np.abs(b_g - 1) < NEUTRAL_TOLERANCE)
+
+    # Grey world uses only the unclipped pixels, as clipped ones have lost their colour.
+    means = rgb[~clipped].mean(axis=0) if not clipped.all() else np.full(3, np.nan)
+    stats = {
+        'clipped': float(clipped.mean()),
+        'neutral': float(neutral.mean()),
+        'grey_world': (float(means[0] / means[1]), float(means[2] / means[1])) if means[1] > 0 else None
+    }
+
+    overlay = np.zeros(rgb.shape[:2] + (4,), dtype=np.uint8)
+    overlay[neutral] = NEUTRAL_COLOUR
+    overlay[clipped] = CLIP_COLOUR
+    return stats, overlay
+
+class ExposureMonitor(QObject):
+    # Emitted with the statistics dict and the overlay for each frame sampled.
+    stats = pyqtSignal(object, object)
+
+    def __init__(self, picam2, stream='main', interval=0.25, max_size=(160, 120)):
+        super().__init__()
+        self.picam2 = picam2
+        self.stream = stream
+        self.interval = interval
+        self.max_size = max_size
+        self.size = None
+        self.last_time = 0
+        self.busy = False
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # Pass frames on to anything that was already looking at them.
+        self.chained = picam2.pre_callback
+        self.picam2.pre_callback = self.on_request
+
+    def on_request(self, request):
+        # Called in the camera thread for every frame, so must return quickly when no frame is wanted.
+        if self.chained:
+            self.chained(request)
+        now = time.monotonic()
+        if self.busy or now - self.last_time < self.interval:
+            return
+        config = request.config[self.stream]
+        if self.size is None:
+            self.size = config['size']
+        elif config['size'] != self.size:
+            return  # not a preview frame (for example, a still capture)
+        self.last_time = now
+        self.busy = True
+        rgb = request_to_rgb(request, self.stream, self.max_size)
+        self.executor.submit(self.measure, rgb)
+
+    def measure(self, rgb):
+        try:
+            self.stats.emit(*exposure_stats(rgb))
+        finally:
+            self.busy = False
+
+    def close(self):
+        self.picam2.pre_callback = self.chained
+        self.executor.shutdown(wait=True)
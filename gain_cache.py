@@ -0,0 +1,106 @@
+# Remembering the gains found for a grey rectangle, and the image corrected with them.
+#
+# Results are keyed by the image file (its name, size and modification time) and the
+# rectangle, so going back to an image that has already been annotated shows it corrected
+# straight away. They are kept in memory up to a budget, forgetting the least recently used
+# first, and can also be saved in a folder: the rectangle's means and gains as JSON, and the
+# corrected image as a high quality JPEG. Saving is done in the background so that it doesn't
+# hold up moving on to the next image.
+
+import os
+import json
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PyQt5.QtGui import QImage
+
+CACHE_MEMORY = 512 << 20  # Most memory, in bytes, for remembered corrected images
+JPEG_QUALITY = 95
+
+def image_bytes(image):
+    return image.bytesPerLine() * image.height()
+
+class GainCache:
+    """Results are dicts of 'means' and 'gains' (both B, G, R) and the corrected 'image', a QImage in Format_RGB32.
+
+    A result's image may share its memory with a numpy array, in which case that should be kept
+    in the result too, as 'buffer'."""
+
+    def __init__(self, max_bytes=CACHE_MEMORY, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = OrderedDict()  # key: result, least recently used first
+        self.bytes = 0
+        self.writer = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.writer = ThreadPoolExecutor(max_workers=1)
+
+    def get(self, key):
+        """Return the result for a key (a JSON-able value), or None."""
+        result = self.entries.get(key)
+        if result is not None:
+            self.entries.move_to_end(key)
+        elif self.directory:
+            result = self.load(key)
+            if result is not None:
+                self.remember(key, result)
+        return result
+
+    def put(self, key, result):
+        kept = self.remember(key, result)
+        if self.writer:
+            if not kept:
+                # The caller may re-use the image's memory before it has been saved.
+                result = {**result, 'image': result['image'].copy(), 'buffer': None}
+            self.writer.submit(self.save, key, result)
+
+    def remember(self, key, result):
+        size = image_bytes(result['image'])
+        if size > self.max_bytes:
+            return False
+        if key in self.entries:
+            self.bytes -= image_bytes(self.entries.pop(key)['image'])
+        self.entries[key] = result
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= image_bytes(evicted['image'])
+        return True
+
+    def paths(self, key):
+        name = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+        return os.path.join(self.directory, name + ".json"), os.path.join(self.directory, name + ".jpg")
+
+    def load(self, key):
+        json_path, jpg_path = self.paths(key)
+        try:
+            with open(json_path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if saved.get('key') != json.loads(json.dumps(key)):
+            return None
+        image = QImage(jpg_path)
+        if image.isNull():
+            return None
+        return {'means': saved['means'], 'gains': saved['gains'],
+                'image': image.convertToFormat(QImage.Format_RGB32), 'buffer': None}
+
+    def save(self, key, result):
+        # Runs in the writer thread. The JSON is written last, so that it's only there once the image is.
+        json_path, jpg_path = self.paths(key)
+        try:
+            if not result['image'].save(jpg_path + ".tmp", "JPG", JPEG_QUALITY):
+                raise OSError("could not write the image")
+            os.replace(jpg_path + ".tmp", jpg_path)
+            with open(json_path + ".tmp", 'w') as f:
+                json.dump({'key': key, 'means': [float(v) for v in result['means']],
+                           'gains': [float(v) for v in result['gains']]}, f)
+            os.replace(json_path + ".tmp", json_path)
+        except OSError as e:
+            print(f"Could not save {jpg_path}: {e}")
+
+    def close(self):
+        if self.writer:
+            self.writer.shutdown(wait=True)
@@ -0,0 +1,80 @@
+# Previewing an image with white balance gains applied, as the Rectangulator does when a grey
+# rectangle is chosen.
+#
+# The pixels are "linearised" by squaring them (a kind of fake gamma), taken back through a
+# generic colour correction matrix (CCM), have the gains applied, and then go forward through
+# the CCM and the gamma again. Rather than do all that on full frame float arrays, which for
+# a big sensor take hundreds of MB each, the image is done in bands of rows on a pool of
+# threads (numpy releases the GIL), with the bands sized to keep the scratch memory within a
+# budget, and the results are written straight into one output buffer.
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+MEMORY_BUDGET = 64 << 20  # Most scratch memory, in bytes, for all the threads together
+SCRATCH_BYTES_PER_PIXEL = 32  # Two float32 RGB arrays plus some slack
+
+# Use a middle-of-the-road generic colour correction matrix.
+CCM = np.transpose(np.array([[1.8, -0.8, 0], [-0.4, 1.8, -0.4], [0, -0.8, 1.8]])).astype(np.float32)
+INV_CCM = np.linalg.inv(CCM).astype(np.float32)
+# Square the pixel values as a kind of fake gamma correction
+LINEARISE = (np.arange(256, dtype=np.float32) / 255) ** 2
+
+def grey_gains(means):
+    """Return the (B, G, R) gains that make linear (B, G, R) means grey, scaled so that the smallest is 1."""
+    gain_r = means[1] / means[2]  # Green/Red
+    gain_b = means[1] / means[0]  # Green/Blue
+    gain_g = 1.0
+    min_gain = min(gain_r, gain_b, gain_g)
+    return gain_b / min_gain, gain_g / min_gain, gain_r / min_gain
+
+class GainTransform:
+    def __init__(self, workers=None, budget=MEMORY_BUDGET):
+        self.workers = workers or os.cpu_count() or 1
+        self.budget = budget
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    @staticmethod
+    def linear(pixels):
+        """Take uint8 BGR pixels back to linear values before the CCM."""
+        linear = LINEARISE[pixels] @ INV_CCM
+        return np.clip(linear, 0, 1, out=linear)
+
+    def rect_means(self, image, rect):
+        """Return the linear (B, G, R) means of a rectangle (x, y, width, height) of a BGRX image."""
+        x, y, w, h = rect
+        return self.linear(image[y:y + h, x:x + w, :3]).mean(axis=(0, 1))
+
+    def band_rows(self, width):
+        return max(1, self.budget // (self.workers * width * SCRATCH_BYTES_PER_PIXEL))
+
+    def apply(self, image, gains, out=None):
+        """Apply (B, G, R) gains to an (h, w, 4) uint8 BGRX image, returning the result in the same format.
+
+        out, if given, is the (h, w, 4) uint8 array to write the result into."""
+        height, width = image.shape[:2]
+        if out is None:
+            out = np.empty_like(image)
+        out[..., 3] = 255
+        gains = np.asarray(gains, dtype=np.float32)
+        rows = self.band_rows(width)
+        # Only one band per thread is in progress at a time, which keeps to the memory budget.
+        bands = [(y, min(y + rows, height)) for y in range(0, height, rows)]
+        for _ in self.executor.map(lambda band: self.apply_band(image, gains, out, *band), bands):
+            pass
+        return out
+
+    def apply_band(self, image, gains, out, y0, y1):
+        pixels = self.linear(image[y0:y1, :, :3])
+        pixels *= gains
+        np.clip(pixels, 0, 1, out=pixels)
+        corrected = pixels @ CCM
+        np.clip(corrected, 0, 1, out=corrected)
+        # Square root the pixel values to undo the gamma correction
+        np.sqrt(corrected, out=corrected)
+        corrected *= 255
+        out[y0:y1, :, :3] = corrected
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,69 @@
+# Scheduling captures at fixed intervals, for light box sweeps and timelapses.
+#
+# Shot k is due at start + k * interval on the monotonic clock, so lateness never accumulates
+# however long each capture takes. When the camera or the file writer is falling behind,
+# the shot is either skipped or delayed until it can be taken, but a shot that is a whole
+# interval late is always skipped, so shots never bunch up and nothing queues up without
+# limit. The timing error of every shot is logged.
+
+import time
+
+BACKLOG_POLICIES = ("skip", "delay")
+POLL_INTERVAL = 0.02  # How often to look again while a shot is being delayed
+
+class IntervalSchedule:
+    def __init__(self, interval, count=None, on_backlog="skip"):
+        self.interval = interval
+        self.count = count  # Number of shots (including skipped ones), or None to carry on forever
+        self.on_backlog = on_backlog
+        self.start = None
+        self.slot = 0
+        self.taken = 0
+        self.skipped = 0
+        self.jitters = []
+
+    def begin(self, now=None):
+        self.start = time.monotonic() if now is None else now
+
+    @property
+    def done(self):
+        return self.count is not None and self.slot >= self.count
+
+    def next_time(self):
+        return self.start + self.slot * self.interval
+
+    def wait_time(self, now):
+        """How long to wait before calling poll again."""
+        if now < self.next_time():
+            return self.next_time() - now
+        return POLL_INTERVAL
+
+    def poll(self, now, busy):
+        """Return the scheduled time of a shot to take now, or None. busy says if captures are backed up."""
+        # Shots a whole interval late are missed.
+        while not self.done and now >= self.next_time() + self.interval:
+            self.skip("too late")
+        if self.done or now < self.next_time():
+            return None
+        if busy:
+            if self.on_backlog == "skip":
+                self.skip("captures backed up")
+            return None
+        scheduled = self.next_time()
+        self.slot += 1
+        self.taken += 1
+        self.jitters.append(now - scheduled)
+        print(f"Shot {self.slot}: due at +{scheduled - self.start:.3f}s, started {(now - scheduled) * 1000:.1f}ms late")
+        return scheduled
+
+    def skip(self, reason):
+        self.slot += 1
+        self.skipped += 1
+        print(f"Shot {self.slot}: skipped ({reason})")
+
+    def summary(self):
+        text = f"Took {self.taken} shots, skipped {self.skipped}"
+        if self.jitters:
+            mean = sum(self.jitters) / len(self.jitters)
+            text += f", started on average {mean * 1000:.1f}ms late (worst {max(self.jitters) * 1000:.1f}ms)"
+        return text
@@ -0,0 +1,160 @@
+# Choosing how the camera's preview is configured, to suit what the Pi can keep up with.
+#
+# The still capture configuration has its own raw stream, so the preview doesn't need one,
+# and on a Pi 3 or Zero 2 an unpacked raw stream at 30fps costs enough memory bandwidth and
+# CMA to make frames drop. The preview profiles run from the most demanding (the unpacked raw
+# stream that the tools used to ask for) to the least, and all keep the full field of view.
+# The PreviewAdapter counts dropped frames from the sensor timestamps and measures the CPU
+# load, stepping down to a cheaper profile when either is too high, and back up (never above
+# the profile it started with) once things have been comfortable for a while.
+
+import threading
+import time
+
+# name: (raw stream format, or None for no raw stream, frame rate)
+PROFILES = {
+    'raw': ('SBGGR12', 30),  # force unpacked
+    'packed-raw': ('SBGGR12_CSI2P', 30),
+    'standard': (None, 30),
+    'low-fps': (None, 15),
+}
+DEFAULT_PROFILE = 'standard'
+MAX_PREVIEW_WIDTH = 1280
+
+CHECK_PERIOD = 5.0  # Seconds of frames to look at before deciding anything
+MAX_DROP_RATE = 0.05  # Step down when more than this fraction of frames are dropped...
+MAX_CPU = 0.9  # ...or the CPUs are busier than this
+CALM_DROP_RATE = 0.01  # Step back up after a while with fewer drops than this...
+CALM_CPU = 0.6  # ...and the CPUs less busy than this
+CALM_CHECKS = 6  # Number of calm checks in a row before stepping back up
+MAX_FAILURES = 2  # Stop going back up to a profile once we've had to leave it this many times
+
+def preview_size(picam2):
+    full_res = picam2.sensor_resolution
+    size = (full_res[0] // 2, full_res[1] // 2)
+    while size[0] > MAX_PREVIEW_WIDTH:
+        size = (size[0] // 2, size[1] // 2)
+    return size
+
+def preview_config(picam2, profile):
+    """Create the preview configuration for the given profile."""
+    raw_format, fps = PROFILES[profile]
+    full_res = picam2.sensor_resolution
+    half_res = (full_res[0] // 2, full_res[1] // 2)
+    main = {'format': 'YUV420', 'size': preview_size(picam2)}
+    if raw_format:
+        return picam2.create_preview_configuration(main, raw={'format': raw_format, 'size': half_res},
+                                                   controls={'FrameRate': fps})
+    # Choose the same (full FOV) sensor mode as the raw stream would have done, but without the buffers.
+    return picam2.create_preview_configuration(main, raw=None, sensor={'output_size': half_res},
+                                               controls={'FrameRate': fps})
+
+def cpu_times():
+    """Return the (busy, total) CPU time so far from /proc/stat, or None where that isn't available."""
+    try:
+        with open('/proc/stat') as f:
+            values = [int(v) for v in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    idle = values[3] + (values[4] if len(values) > 4 else 0)  # idle + iowait
+    return sum(values) - idle, sum(values)
+
+class PreviewAdapter:
+    """Configures the preview with a profile, and changes profile when frames are dropped or the CPUs are overloaded.
+
+    check should be called regularly from the thread that owns the camera, and busy, if given, should
+    return True while a still capture is in progress (when the camera mustn't be reconfigured)."""
+
+    def __init__(self, picam2, profile=DEFAULT_PROFILE, adaptive=True, busy=None):
+        self.picam2 = picam2
+        self.profile = profile
+        self.best = list(PROFILES).index(profile)  # never step up past the profile we were asked for
+        self.adaptive = adaptive
+        self.busy = busy or (lambda: False)
+        self.failures = {}  # number of times we've had to step down from each profile
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.drops = 0
+        self.last_timestamp = None
+        self.calm_checks = 0
+        self.start_check()
+        # Frames are counted in the camera thread, passing them on to anything else that wants them.
+        self.chained = picam2.pre_callback
+        picam2.pre_callback = self.on_request
+
+    def configure(self):
+        print(f"Preview resolution: {preview_size(self.picam2)}, profile: {self.profile}")
+        self.picam2.configure(preview_config(self.picam2, self.profile))
+
+    def start_check(self):
+        with self.lock:
+            self.frames = 0
+            self.drops = 0
+            self.last_timestamp = None
+        self.check_start = time.monotonic()
+        self.check_cpu = cpu_times()
+
+    def on_request(self, request):
+        metadata = request.get_metadata()
+        timestamp = metadata.get('SensorTimestamp')
+        frame_duration = metadata.get('FrameDuration')
+        with self.lock:
+            if self.busy():
+                # Still captures switch the camera mode, which would look like dropped frames.
+                timestamp = None
+            elif self.last_timestamp is not None and timestamp is not None and frame_duration:
+                # Timestamps are in ns, frame durations in us.
+                gap = round((timestamp - self.last_timestamp) / (frame_duration * 1000))
+                self.drops += max(0, gap - 1)
+                self.frames += 1
+            self.last_timestamp = timestamp
+        if self.chained:
+            self.chained(request)
+
+    def check(self):
+        """Change profile if need be, returning the new profile or None."""
+        if not self.adaptive or time.monotonic() - self.check_start < CHECK_PERIOD:
+            return None
+        if self.busy():
+            # Still captures switch the camera mode, which looks like dropped frames.
+            self.start_check()
+            return None
+        with self.lock:
+            frames, drops = self.frames, self.drops
+        cpu = None
+        now_cpu = cpu_times()
+        if now_cpu and self.check_cpu and now_cpu[1] > self.check_cpu[1]:
+            cpu = (now_cpu[0] - self.check_cpu[0]) / (now_cpu[1] - self.check_cpu[1])
+        drop_rate = drops / (frames + drops) if frames + drops else 0
+        self.start_check()
+
+        profiles = list(PROFILES)
+        index = profiles.index(self.profile)
+        new_profile = None
+        if drop_rate > MAX_DROP_RATE or (cpu is not None and cpu > MAX_CPU):
+            self.calm_checks = 0
+            if index + 1 < len(profiles):
+                self.failures[self.profile] = self.failures.get(self.profile, 0) + 1
+                new_profile = profiles[index + 1]
+        elif drop_rate < CALM_DROP_RATE and (cpu is None or cpu < CALM_CPU):
+            self.calm_checks += 1
+            if self.calm_checks >= CALM_CHECKS and index > self.best and \
+               self.failures.get(profiles[index - 1], 0) < MAX_FAILURES:
+                new_profile = profiles[index - 1]
+        else:
+            self.calm_checks = 0
+        if new_profile is None:
+            return None
+
+        cpu_text = f"{cpu:.0%}" if cpu is not None else "unknown"
+        print(f"Preview: {drop_rate:.1%} of frames dropped, CPU load {cpu_text} - switching to the {new_profile} profile")
+        self.calm_checks = 0
+        self.profile = new_profile
+        self.picam2.stop()
+        self.configure()
+        self.picam2.start()
+        self.start_check()
+        return new_profile
+
+    def close(self):
+        self.picam2.pre_callback = self.chained
@@ -0,0 +1,106 @@
+# Reading raw Bayer data and grey rectangle statistics from captures, for the batch tools.
+#
+# Rectangles in the capture filenames are in JPEG pixel coordinates, so they are scaled to the
+# DNG's raw resolution here. All the statistics are computed on the four half-resolution
+# Bayer planes with the black level removed.
+
+import numpy as np
+import rawpy
+
+# Pixels within this fraction of the white level count as clipped.
+CLIP_THRESHOLD = 0.95
+
+class BayerImage:
+    def __init__(self, planes, channels, white):
+        self.planes = planes  # float32 array (4, h, w), black level removed
+        self.channels = channels  # e.g. "RGGB", the colour of each plane
+        self.white = white  # float32 array (4,), saturation level of each plane after black removal
+
+    @property
+    def size(self):
+        """Full raw resolution, as (width, height)."""
+        return (self.planes.shape[2] * 2, self.planes.shape[1] * 2)
+
+    def channel_indices(self, colour):
+        return [i for i, c in enumerate(self.channels) if c == colour]
+
+    def rect_means(self, rect, jpeg_size):
+        """Return the (R, G, B) means and the clipped fraction of a rectangle given in JPEG coordinates."""
+        x0, y0, x1, y1 = scale_rect(rect, jpeg_size, self.size)
+        crop = self.planes[:, y0:y1, x0:x1]
+        if crop.size == 0:
+            raise ValueError(f"Rectangle {rect} is empty at raw resolution")
+        clipped = np.any(crop >= self.white[:, None, None] * CLIP_THRESHOLD, axis=0).mean()
+        means = crop.mean(axis=(1, 2))
+        rgb = [means[self.channel_indices(c)].mean() for c in "RGB"]
+        return tuple(float(v) for v in rgb), float(clipped)
+
+    def zone_stats(self, grid=(32, 32)):
+        """Return per-zone (R, G, B) means, shape (rows, cols, 3), and counts of unclipped pixels, shape (rows, cols).
+
+        As in the ISP's AWB statistics, a Bayer quad only counts if none of its pixels is clipped.
+        Any rows and columns left over at the right and bottom edges are ignored."""
+        rows, cols = grid
+        c, h, w = self.planes.shape
+        zh, zw = h // rows, w // cols
+        planes = self.planes[:, :zh * rows, :zw * cols]
+        valid = ~np.any(planes >= self.white[:, None, None] * CLIP_THRESHOLD, axis=0)
+        counts = valid.reshape(rows, zh, cols, zw).sum(axis=(1, 3))
+        sums = (planes * valid).reshape(c, rows, zh, cols, zw).sum(axis=(2, 4))
+        means = sums / np.maximum(counts, 1)
+        rgb = np.stack([means[self.channel_indices(colour)].mean(axis=0) for colour in "RGB"], axis=-1)
+        return rgb.astype(np.float32), counts
+
+def scale_rect(rect, jpeg_size, raw_size):
+    """Map a JPEG-coordinate rectangle onto the half-resolution Bayer planes."""
+    sx = raw_size[0] / jpeg_size[0] / 2
+    sy = raw_size[1] / jpeg_size[1] / 2
+    x0, y0, x1, y1 = rect
+    return (int(round(x0 * sx)), int(round(y0 * sy)), int(round(x1 * sx)), int(round(y1 * sy)))
+
+def read_bayer(path):
+    """Read a DNG into a BayerImage. Compressed DNGs are handled transparently by LibRaw."""
+    with rawpy.imread(path) as raw:
+        image = raw.raw_image_visible
+        pattern = raw.raw_pattern
+        desc = raw.color_desc.decode()
+        black = raw.black_level_per_channel
+        h, w = image.shape[0] // 2, image.shape[1] // 2
+        planes = np.empty((4, h, w), dtype=np.float32)
+        channels = ""
+        white = np.empty(4, dtype=np.float32)
+        for i, (dy, dx) in enumerate(((0, 0), (0, 1), (1, 0), (1, 1))):
+            colour_index = pattern[dy, dx]
+            planes[i] = image[dy:2 * h:2, dx:2 * w:2]
+            planes[i] -= black[colour_index]
+            white[i] = raw.white_level - black[colour_index]
+            channels += desc[colour_index]
+    return BayerImage(planes, channels, white)
+
+def jpeg_size(path):
+    """Return a JPEG's (width, height) from its frame header, without decoding it."""
+    with open(path, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            raise ValueError(f"{path} is not a JPEG file")
+        while True:
+            byte = f.read(1)
+            if not byte:
+                break
+            if byte != b'\xff':
+                continue
+            marker = f.read(1)
+            while marker == b'\xff':
+                marker = f.read(1)
+            if not marker:
+                break
+            m = marker[0]
+            if m == 0xd8 or m == 0x01 or 0xd0 <= m <= 0xd7:
+                continue
+            if m == 0xd9 or m == 0xda:
+                break
+            length = int.from_bytes(f.read(2), 'big')
+            if 0xc0 <= m <= 0xcf and m not in (0xc4, 0xc8, 0xcc):
+                header = f.read(5)
+                return (int.from_bytes(header[3:5], 'big'), int.from_bytes(header[1:3], 'big'))
+            f.seek(length - 2, 1)
+    raise ValueError(f"{path} has no JPEG frame header")
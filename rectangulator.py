@@ -4,17 +4,71 @@ import sys
 import os
 import argparse
 import shutil
+import errno
+import json
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout,
                             QLineEdit, QPushButton, QLabel, QFileDialog,
                             QDialog, QDialogButtonBox, QScrollArea, QHBoxLayout,
-                            QMessageBox, QListWidget, QSplitter, QSizePolicy, QListWidgetItem)
-from PyQt5.QtGui import QPixmap, QWheelEvent, QPainter, QPalette, QPen, QColor, QImage
-from PyQt5.QtCore import Qt, QPoint, QRect
+                            QMessageBox, QListView, QSplitter, QSizePolicy, QComboBox,
+                            QShortcut)
+from PyQt5.QtGui import QPixmap, QWheelEvent, QPainter, QPalette, QPen, QColor, QImage, QKeySequence
+from PyQt5.QtCore import Qt, QPoint, QRect, pyqtSignal, QAbstractListModel, QModelIndex
+from capture_names import parse_basename, make_basename
+from dataset_index import DatasetIndex
+from capture_metadata import load_metadata, read_metadata, append_record, capture_key, METADATA_LOG
+from capture_archive import CaptureArchive, is_archive
+from gain_transform import GainTransform, grey_gains, MEMORY_BUDGET
+from gain_cache import GainCache, CACHE_MEMORY
+from scene_hashes import update_hashes, group_duplicates, MAX_DISTANCE
+from stall_watchdog import StallWatchdog, STALL_THRESHOLD
 
 # You can override these here, if you wish, or on the command line.
 OUTPUT_DIR = os.path.join(os.path.expanduser("~"), "awb-images")
 INPUT_DIR = os.path.join(os.path.expanduser("~"), "awb-captures")
+OUTPUT_MODE = "copy"
+DUPLICATE_DISTANCE = MAX_DISTANCE  # Images whose hashes differ in at most this many bits are grouped together
+DUPLICATE_COLOUR = "#4A4A6A"  # Background of grouped near-duplicates in the file list
+
+# How accepted images are put into the output folder.
+OUTPUT_MODES = ("copy", "hardlink", "reflink", "sidecar")
+FICLONE = 0x40049409  # Linux ioctl to make a copy-on-write clone of a file
+
+def reflink(src, dst):
+    import fcntl  # Linux only
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+
+def output_file(src, dst, mode):
+    """Put src into the output folder as dst, returning how it was done."""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if mode == "reflink":
+        try:
+            reflink(src, dst)
+            return "reflinked"
+        except (ImportError, OSError) as e:
+            # Filesystems without clone support get a hard link instead, and across
+            # filesystems we have to copy.
+            if getattr(e, 'errno', None) == errno.EXDEV:
+                mode = "copy"
+            else:
+                mode = "hardlink"
+    if mode == "hardlink":
+        try:
+            os.link(src, dst)
+            return "hard linked"
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+    shutil.copy(src, dst)
+    return "copied"
 
 class ImageLabel(QLabel):
     def __init__(self, parent=None):
@@ -31,12 +85,45 @@ class ImageLabel(QLabel):
             rect = QRect(self.selection_start, self.selection_end).normalized()
             painter.drawRect(rect)
 
-class ImageDialog(QDialog):
-    def __init__(self, parent=None):
+class ImageLoader:
+    """Decodes images in the background, so that the next one is ready before it's wanted."""
+
+    def __init__(self, workers=2, read=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures = {}
+        self.read = read  # function returning a file's contents, for images that aren't just files
+
+    def decode(self, path):
+        image = QImage.fromData(self.read(path)) if self.read else QImage(path)
+        if not image.isNull():
+            image = image.convertToFormat(QImage.Format_RGB32)
+        return image
+
+    def get(self, path):
+        """Return a Future for the decoded QImage."""
+        if path not in self.futures:
+            self.futures[path] = self.executor.submit(self.decode, path)
+        return self.futures[path]
+
+    def keep(self, paths):
+        """Forget all but the given images."""
+        for path in list(self.futures):
+            if path not in paths:
+                self.futures.pop(path).cancel()
+
+class AnnotationView(QWidget):
+    # The view stays in the main window, and images are swapped into it one after another.
+    accepted = pyqtSignal()
+    skipped = pyqtSignal()
+    previous = pyqtSignal()
+
+    def __init__(self, parent=None, transform=None, cache=None):
         super().__init__(parent)
-        self.setWindowTitle("Select Rectangle")
-        self.setModal(True)
-        self.setGeometry(50, 50, 1200, 900)  # Increased dialog size
+        self.setFocusPolicy(Qt.StrongFocus)
+        self.transform = transform or GainTransform()
+        self.cache = cache or GainCache()
+        self.image_key = None  # identifies the image file, for the cache
+        self.preview_buffer = None
 
         # Add property to store the selected rectangle
         self.selected_rect = None
@@ -57,21 +144,25 @@ class ImageDialog(QDialog):
         self.scroll_area.setWidget(self.image_label)
 
         # Add instructions
-        instructions = QLabel("Click and drag to pan. Mouse wheel to zoom. Ctrl+Click and drag to set grey rectangle. Click the Accept button to finish.")
+        instructions = QLabel("Click and drag to pan. Mouse wheel to zoom. Ctrl+Click and drag to set grey rectangle.\n"
+                              "Enter to accept and go to the next image, Right or Space to skip, Left to go back.")
         instructions.setAlignment(Qt.AlignCenter)
         layout.addWidget(instructions)
 
-        # Add Done button in a centered layout
+        # Add the buttons in a centered layout
         button_layout = QHBoxLayout()
         button_layout.setContentsMargins(10, 10, 10, 10)  # Add some margin around the button
         button_layout.addStretch(1)
-        button_box = QDialogButtonBox()
-        self.accept_button = button_box.addButton("Accept", QDialogButtonBox.AcceptRole)
-        self.accept_button.clicked.connect(self.accept)
+        previous_button = QPushButton("Previous")
+        previous_button.clicked.connect(self.previous)
+        button_layout.addWidget(previous_button)
+        skip_button = QPushButton("Skip")
+        skip_button.clicked.connect(self.skipped)
+        button_layout.addWidget(skip_button)
+        self.accept_button = QPushButton("Accept")
+        self.accept_button.clicked.connect(self.accepted)
         self.accept_button.setEnabled(False)  # Initially disabled
-        cancel_button = button_box.addButton("Cancel", QDialogButtonBox.RejectRole)
-        cancel_button.clicked.connect(self.on_cancel)
-        button_layout.addWidget(button_box)
+        button_layout.addWidget(self.accept_button)
         button_layout.addStretch(1)
         layout.addLayout(button_layout)
 
@@ -81,7 +172,7 @@ class ImageDialog(QDialog):
         self.pan_start = QPoint()
         self.panning = False
         self.original_pixmap = None
-        self.backup_pixmap = None
+        self.source_image = None
 
         # Initialize selection rectangle variables
         self.is_selecting = False
@@ -111,11 +202,42 @@ class ImageDialog(QDialog):
             # Don't clear the selection when Ctrl is released
         super().keyReleaseEvent(event)
 
-    def set_image(self, pixmap):
-        self.original_pixmap = pixmap
-        # Create a backup copy of the original pixmap
-        self.backup_pixmap = QPixmap(pixmap)
-        # We'll calculate the zoom factor in showEvent
+    def set_image(self, image, key=None, rect=None):
+        """Show a new image (a QImage in Format_RGB32), discarding any selection.
+
+        key identifies the image file, so that gains can be remembered, and rect, if given, is
+        selected straight away (for an image that was annotated before)."""
+        # The source image is kept to compute the gain preview from.
+        self.source_image = image
+        self.image_key = key
+        self.original_pixmap = QPixmap.fromImage(image)
+        self.clear_selection()
+        if rect:
+            self.select_rect(rect)
+        if self.isVisible():
+            self.update_min_zoom_factor()
+            self.zoom_factor = self.min_zoom_factor
+            self.update_image()
+            self.show_selection()
+            self.scroll_area.horizontalScrollBar().setValue(0)
+            self.scroll_area.verticalScrollBar().setValue(0)
+        # Otherwise we'll calculate the zoom factor in showEvent
+
+    def show_selection(self):
+        """Draw the selected rectangle, when it wasn't just drawn with the mouse."""
+        if self.selected_rect:
+            x, y = self.selected_rect['x'], self.selected_rect['y']
+            w, h = self.selected_rect['width'], self.selected_rect['height']
+            self.image_label.selection_start = QPoint(int(x * self.zoom_factor), int(y * self.zoom_factor))
+            self.image_label.selection_end = QPoint(int((x + w) * self.zoom_factor), int((y + h) * self.zoom_factor))
+            self.image_label.update()
+
+    def clear_selection(self):
+        self.image_label.selection_start = None
+        self.image_label.selection_end = None
+        self.image_label.update()
+        self.selected_rect = None
+        self.accept_button.setEnabled(False)
 
     def showEvent(self, event):
         super().showEvent(event)
@@ -123,6 +245,7 @@ class ImageDialog(QDialog):
             self.update_min_zoom_factor()
             self.zoom_factor = self.min_zoom_factor
             self.update_image()
+            self.show_selection()
 
     def resizeEvent(self, event):
         super().resizeEvent(event)
@@ -154,6 +277,60 @@ class ImageDialog(QDialog):
         self.image_label.setPixmap(scaled_pixmap)
         self.image_label.adjustSize()
 
+    def select_rect(self, rect):
+        """Select a rectangle, in image coordinates, and show the image with its gains applied.
+
+        Returns False, leaving the selection alone, if the rectangle is too saturated to use."""
+        key = (self.image_key, (rect['x'], rect['y'], rect['width'], rect['height'])) if self.image_key else None
+        result = self.cache.get(key) if key else None
+        if result is None:
+            result = self.compute_gains(rect)
+            if result is None:
+                return False
+            if key:
+                self.cache.put(key, result)
+        else:
+            print("Using the remembered gains")
+        print(f"Gain values: R={result['gains'][2]:.3f}, B={result['gains'][0]:.3f}, G={result['gains'][1]:.3f}")
+        self.selected_rect = rect
+        self.accept_button.setEnabled(True)  # Enable Accept button when valid selection is made
+        self.original_pixmap = QPixmap.fromImage(result['image'])
+        self.update_image()
+        return True
+
+    def compute_gains(self, rect):
+        """Work out the gains that make a rectangle grey, and apply them to the image. Returns None if it's too saturated."""
+        # Look at the source image as a numpy array (it's B, G, R, X in memory)
+        image = self.source_image
+        width = image.width()
+        height = image.height()
+        ptr = image.constBits()
+        ptr.setsize(height * image.bytesPerLine())
+        arr = np.frombuffer(ptr, np.uint8).reshape((height, image.bytesPerLine() // 4, 4))[:, :width]
+
+        # Calculate average RGB values for the selected rectangle
+        avg_rgb = self.transform.rect_means(arr, (rect['x'], rect['y'], rect['width'], rect['height'])) + 0.001  # Add 0.001 to avoid division by zero
+        print(f"Average RGB values: R={avg_rgb[2]:.3f}, G={avg_rgb[1]:.3f}, B={avg_rgb[0]:.3f}")
+
+        # Check for saturation
+        if np.any(avg_rgb > 0.85):
+            return None
+
+        # Calculate gains relative to green channel
+        gain_b, gain_g, gain_r = grey_gains(avg_rgb)
+
+        # Apply gains to the image. Remembered results each need their own buffer, but otherwise
+        # we re-use the output buffer from last time where we can.
+        if self.cache.max_bytes:
+            buffer = np.empty((height, width, 4), dtype=np.uint8)
+        else:
+            if self.preview_buffer is None or self.preview_buffer.shape[:2] != (height, width):
+                self.preview_buffer = np.empty((height, width, 4), dtype=np.uint8)
+            buffer = self.preview_buffer
+        self.transform.apply(arr, (gain_b, gain_g, gain_r), out=buffer)
+        q_img = QImage(buffer.data, width, height, 4 * width, QImage.Format_RGB32)
+        return {'means': avg_rgb, 'gains': (gain_b, gain_g, gain_r), 'image': q_img, 'buffer': buffer}
+
     def wheelEvent(self, event: QWheelEvent):
         # Clear rectangle when zooming
         self.image_label.selection_start = None
@@ -208,7 +385,11 @@ class ImageDialog(QDialog):
         v_scroll_bar.setValue(new_v_scroll)
 
     def mousePressEvent(self, event):
+        if self.original_pixmap is None:
+            return
         if event.button() == Qt.LeftButton:
+            # We may not have seen the Ctrl key go down if we didn't have the focus.
+            self.ctrl_pressed = bool(event.modifiers() & Qt.ControlModifier)
             if self.ctrl_pressed:
                 self.is_selecting = True
                 self.image_label.selection_start = event.pos()
@@ -260,84 +441,16 @@ class ImageDialog(QDialog):
                     # Only accept selection if it's large enough
                     if rect.width() >= self.MIN_SIZE and rect.height() >= self.MIN_SIZE:
                         # Store the rectangle in original image coordinates
-                        self.selected_rect = {
+                        selected_rect = {
                             'x': rect.x(),
                             'y': rect.y(),
                             'width': rect.width(),
                             'height': rect.height()
                         }
-                        print(f"Selected rectangle:", self.selected_rect)
-                        self.accept_button.setEnabled(True)  # Enable Accept button when valid selection is made
-
-                        # Convert backup pixmap to numpy array
-                        image = self.backup_pixmap.toImage()
-                        width = image.width()
-                        height = image.height()
-                        ptr = image.bits()
-                        ptr.setsize(height * width * 4)  # 4 bytes per pixel (RGBA)
-                        arr = np.frombuffer(ptr, np.uint8).reshape((height, width, 4))
-                        # Convert RGBA to RGB
-                        rgb_arr = arr[:, :, :3]
-
-                         # Square the pixel values as a kind of fake gamma correction
-                        rgb_float = rgb_arr.astype(np.float32) / 255
-                        rgb_float *= rgb_float
-
-                        # Use a middle-of-the-road generic colour correction matrix.
-                        ccm = np.transpose(np.array([[1.8, -0.8, 0], [-0.4, 1.8, -0.4], [0, -0.8, 1.8]]))
-                        inv_ccm = np.linalg.inv(ccm)
-                        rgb_float = rgb_float @ inv_ccm
-                        rgb_float = np.clip(rgb_float, 0, 1)
-
-                       # Calculate average RGB values for the selected rectangle
-                        x, y = self.selected_rect['x'], self.selected_rect['y']
-                        w, h = self.selected_rect['width'], self.selected_rect['height']
-                        rect_pixels = rgb_float[y:y+h, x:x+w]
-                        avg_rgb = np.mean(rect_pixels, axis=(0, 1)) + 0.001 # Add 0.001 to avoid division by zero
-                        print(f"Average RGB values: R={avg_rgb[2]:.3f}, G={avg_rgb[1]:.3f}, B={avg_rgb[0]:.3f}")
-
-                        # Check for saturation
-                        if np.any(avg_rgb > 0.85):
+                        print(f"Selected rectangle:", selected_rect)
+                        if not self.select_rect(selected_rect):
                             QMessageBox.warning(self, "Warning", "Rectangle too saturated - choose another")
-                            self.image_label.selection_start = None
-                            self.image_label.selection_end = None
-                            self.image_label.update()
-                            self.accept_button.setEnabled(False)
-                            return
-
-                        # Calculate gains relative to green channel
-                        gain_r = avg_rgb[1] / avg_rgb[2]  # Green/Red
-                        gain_b = avg_rgb[1] / avg_rgb[0]  # Green/Blue
-                        gain_g = 1.0
-                        min_gain = min(gain_r, gain_b, gain_g)
-                        gain_r = gain_r / min_gain
-                        gain_b = gain_b / min_gain
-                        gain_g = gain_g / min_gain
-                        print(f"Gain values: R={gain_r:.3f}, B={gain_b:.3f}, G={gain_g:.3f}")
-
-                        # Apply gains to the image
-                        rgb_float[:, :, 2] = np.clip(rgb_float[:, :, 2] * gain_r, 0, 1)  # Red channel
-                        rgb_float[:, :, 0] = np.clip(rgb_float[:, :, 0] * gain_b, 0, 1)  # Blue channel
-                        rgb_float[:, :, 1] = np.clip(rgb_float[:, :, 1] * gain_g, 0, 1)  # Green channel
-
-                        rgb_float = rgb_float @ ccm
-                        rgb_float = np.clip(rgb_float, 0, 1)
-                        # Square root the pixel values to undo the gamma correction
-                        rgb_float = np.sqrt(rgb_float)
-
-                        # Convert back to uint8 and scale to 0-255
-                        rgb_arr = (rgb_float * 255).astype(np.uint8)
-
-                        # Convert back to QPixmap
-                        height, width = rgb_arr.shape[:2]
-                        bytes_per_line = 3 * width
-                        # Convert numpy array to bytes and swap red and blue channels
-                        rgb_arr = rgb_arr.astype(np.uint8)
-                        # Swap red and blue channels to match RGB888 format
-                        rgb_arr = rgb_arr[:, :, ::-1]  # Reverse the channel order
-                        q_img = QImage(rgb_arr.tobytes(), width, height, bytes_per_line, QImage.Format_RGB888)
-                        self.original_pixmap = QPixmap.fromImage(q_img)
-                        self.update_image()
+                            self.clear_selection()
                     else:
                         # Clear the selection if it's too small
                         self.image_label.selection_start = None
@@ -348,17 +461,124 @@ class ImageDialog(QDialog):
                 self.panning = False
                 self.image_label.setCursor(Qt.ArrowCursor)
 
-    def on_cancel(self):
-        """Handle cancel button click by clearing selection and closing dialog"""
-        self.image_label.selection_start = None
-        self.image_label.selection_end = None
-        self.image_label.update()
-        self.selected_rect = None
-        self.accept_button.setEnabled(False)  # Disable Accept button when canceling
-        self.reject()
+class CaptureListModel(QAbstractListModel):
+    """The input files, with their parsed names, processed state and near-duplicate groups.
+
+    Only the rows that pass the filter are shown, and the text for a row is only made when the
+    view asks for it, so very large folders are cheap to list and filter."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.filenames = []
+        self.fields = []  # parsed names, with empty fields for names that don't follow the convention
+        self.processed = set()
+        self.duplicate_of = {}
+        self.duplicate_groups = set()
+        self.rows = []  # indices into filenames of the rows that pass the filter
+        self.row_of = {}
+        self.filter_terms = []
+        self.filter_state = None
+
+    def set_files(self, filenames, fields=None):
+        """Set the list of files, with their (user, sensor, scene_id) fields in lower case if they are known."""
+        self.beginResetModel()
+        self.filenames = list(filenames)
+        if fields is not None:
+            self.fields = list(fields)
+        else:
+            self.fields = []
+            for filename in self.filenames:
+                parsed = parse_basename(os.path.splitext(filename)[0]) or {'user': "", 'sensor': "", 'scene_id': ""}
+                self.fields.append((parsed['user'].lower(), parsed['sensor'].lower(), parsed['scene_id'].lower()))
+        self.update_rows()
+        self.endResetModel()
+
+    def set_duplicates(self, groups):
+        """Reorder the files so that each group of near-duplicates follows its first member."""
+        group_of = {filename: group for group in groups for filename in group}
+        present = set(self.filenames)
+        order = []
+        listed = set()
+        for filename in self.filenames:
+            if filename not in listed:
+                group = [member for member in group_of.get(filename, [filename]) if member in present]
+                order += group
+                listed.update(group)
+        index = {filename: i for i, filename in enumerate(self.filenames)}
+        self.beginResetModel()
+        self.fields = [self.fields[index[filename]] for filename in order]
+        self.filenames = order
+        self.duplicate_of = {member: group[0] for group in groups for member in group[1:]}
+        self.duplicate_groups = {member for group in groups for member in group}
+        self.update_rows()
+        self.endResetModel()
+
+    def set_filter(self, text, state=None):
+        """Show only files matching every term of text, and with the given processed state (True, False or None for any).
+
+        Terms can be restricted to one field with "user:", "sensor:" or "scene:"."""
+        self.beginResetModel()
+        self.filter_terms = []
+        for term in text.lower().split():
+            field, _, value = term.rpartition(':')
+            self.filter_terms.append(({'user': 0, 'sensor': 1, 'scene': 2}.get(field), value))
+        self.filter_state = state
+        self.update_rows()
+        self.endResetModel()
+
+    def update_rows(self):
+        rows = range(len(self.filenames))
+        for field, value in self.filter_terms:
+            if field is None:
+                rows = [i for i in rows if any(value in f for f in self.fields[i])]
+            else:
+                rows = [i for i in rows if value in self.fields[i][field]]
+        if self.filter_state is not None:
+            rows = [i for i in rows if (self.filenames[i] in self.processed) == self.filter_state]
+        self.rows = list(rows)
+        self.row_of = {self.filenames[i]: row for row, i in enumerate(self.rows)}
+
+    def set_processed(self, filename):
+        self.processed.add(filename)
+        row = self.row_of.get(filename)
+        if row is not None:
+            index = self.index(row)
+            self.dataChanged.emit(index, index)
+
+    def filename(self, row):
+        return self.filenames[self.rows[row]]
+
+    def find(self, filename):
+        """Return the row showing filename, or -1."""
+        return self.row_of.get(filename, -1)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        filename = self.filenames[self.rows[index.row()]]
+        if role == Qt.DisplayRole:
+            text = f"≈ {filename}" if filename in self.duplicate_of else filename
+            # Add checkmark if file has been processed
+            return f"✓ {text}" if filename in self.processed else text
+        if role == Qt.UserRole:
+            return filename
+        if role == Qt.ToolTipRole and filename in self.duplicate_of:
+            return f"Near-duplicate of {self.duplicate_of[filename]}"
+        if role == Qt.BackgroundRole and filename in self.duplicate_groups:
+            return QColor(DUPLICATE_COLOUR)
+        return None
 
 class Rectangulator(QMainWindow):
-    def __init__(self, input_dir=INPUT_DIR, output_dir=OUTPUT_DIR):
+    # Near-duplicate images are found in the background, and these report how it's going.
+    hash_progress = pyqtSignal(int, int)
+    duplicates_found = pyqtSignal(object)
+
+    def __init__(self, input_dir=INPUT_DIR, output_dir=OUTPUT_DIR, output_mode=OUTPUT_MODE,
+                 duplicate_distance=DUPLICATE_DISTANCE, threads=None, memory_budget=MEMORY_BUDGET,
+                 cache_memory=CACHE_MEMORY, cache_dir=None):
         super().__init__()
         self.setWindowTitle("AWB Rectangulator")
         self.setGeometry(100, 100, 1200, 900)
@@ -366,13 +586,12 @@ class Rectangulator(QMainWindow):
         # Store directories
         self.input_dir = input_dir
         self.output_dir = output_dir
+        self.output_mode = output_mode
+        self.duplicate_distance = duplicate_distance
 
         # Create output directory if it doesn't exist
         os.makedirs(self.output_dir, exist_ok=True)
 
-        # Track processed files
-        self.processed_files = set()
-
         # Create main widget and layout
         self.central_widget = QWidget()
         self.setCentralWidget(self.central_widget)
@@ -382,7 +601,7 @@ class Rectangulator(QMainWindow):
         dir_layout = QHBoxLayout()
         dir_layout.setContentsMargins(5, 2, 5, 2)  # Minimize vertical margins
         input_label = QLabel(f"Input: {self.input_dir}")
-        output_label = QLabel(f"Output: {self.output_dir}")
+        output_label = QLabel(f"Output: {self.output_dir} ({self.output_mode})")
         input_label.setStyleSheet("color: #666666; font-weight: bold;")
         output_label.setStyleSheet("color: #666666; font-weight: bold;")
         # Set size policies to prevent vertical expansion
@@ -394,7 +613,7 @@ class Rectangulator(QMainWindow):
         self.main_layout.addLayout(dir_layout)
 
         # Add instruction label
-        instruction_label = QLabel("Double-click a file to select a grey rectangle and copy to output folder")
+        instruction_label = QLabel("Select a file to annotate it with a grey rectangle, and accept it to copy it to the output folder")
         instruction_label.setStyleSheet("color: #666666; font-style: italic;")
         instruction_label.setSizePolicy(QSizePolicy.Preferred, QSizePolicy.Fixed)
         instruction_label.setAlignment(Qt.AlignLeft | Qt.AlignVCenter)
@@ -404,100 +623,344 @@ class Rectangulator(QMainWindow):
         self.splitter = QSplitter(Qt.Horizontal)
         self.main_layout.addWidget(self.splitter)
 
-        # Create file list widget
-        self.file_list = QListWidget()
+        # Create the file list, with a filter above it
+        list_area = QWidget()
+        list_layout = QVBoxLayout(list_area)
+        list_layout.setContentsMargins(0, 0, 0, 0)
+        filter_layout = QHBoxLayout()
+        self.filter_input = QLineEdit()
+        self.filter_input.setPlaceholderText("Filter, e.g. bob or sensor:imx708 scene:kitchen")
+        self.filter_input.textChanged.connect(self.apply_filter)
+        self.filter_input.returnPressed.connect(self.file_list_focus)
+        filter_layout.addWidget(self.filter_input)
+        self.state_filter = QComboBox()
+        self.state_filter.addItems(["All", "To do", "Done"])
+        self.state_filter.currentIndexChanged.connect(self.apply_filter)
+        filter_layout.addWidget(self.state_filter)
+        list_layout.addLayout(filter_layout)
+
+        self.file_model = CaptureListModel(self)
+        self.dng_files = {}  # the DNG file for each JPEG
+        self.metadata = {}  # the camera's metadata for each capture, from the input folder's log
+        self.archive = None  # the CaptureArchive, when the input is a zip or tar file
+        self.rects = {}  # the rectangles of the files that have been annotated
+        self.file_list = QListView()
+        self.file_list.setUniformItemSizes(True)  # So that only the visible rows are ever looked at
+        self.file_list.setModel(self.file_model)
         self.file_list.setMinimumWidth(200)
-        self.file_list.itemDoubleClicked.connect(self.on_file_double_clicked)
+        self.file_list.selectionModel().currentRowChanged.connect(lambda current, previous: self.show_file(current.row()))
+        self.file_list.doubleClicked.connect(self.on_file_double_clicked)
         # Set a brighter background color
         self.file_list.setStyleSheet("background-color: #3D3D3D; color: #FFFFFF;")
-        self.splitter.addWidget(self.file_list)
+        list_layout.addWidget(self.file_list)
+        self.splitter.addWidget(list_area)
 
-        # Create main content area
+        # Create main content area, holding the one annotation view that all the images are shown in
         self.content_area = QWidget()
         self.content_layout = QVBoxLayout(self.content_area)
+        self.content_layout.setContentsMargins(0, 0, 0, 0)
+        self.annotation_view = AnnotationView(transform=GainTransform(threads, memory_budget),
+                                              cache=GainCache(cache_memory, cache_dir))
+        self.annotation_view.accepted.connect(self.accept_and_next)
+        self.annotation_view.skipped.connect(self.next_file)
+        self.annotation_view.previous.connect(self.previous_file)
+        self.content_layout.addWidget(self.annotation_view)
         self.splitter.addWidget(self.content_area)
+        self.splitter.setStretchFactor(1, 1)
+        self.loader = ImageLoader()
+        self.shown_path = None
+
+        # Keyboard shortcuts work wherever the focus is
+        for keys, slot in (((Qt.Key_Return, Qt.Key_Enter), self.accept_and_next),
+                           ((Qt.Key_Right, Qt.Key_Space, Qt.Key_N), self.next_file),
+                           ((Qt.Key_Left, Qt.Key_Backspace, Qt.Key_P), self.previous_file)):
+            for key in keys:
+                QShortcut(QKeySequence(key), self, activated=slot)
 
         # Load files
         self.load_files()
+        self.set_current_row(0)
+
+        # Hash the images in the background, then group any near-duplicates together in the list
+        self.hasher = ThreadPoolExecutor(max_workers=1)
+        self.hash_progress.connect(self.on_hash_progress)
+        self.duplicates_found.connect(self.on_duplicates_found)
+        if self.duplicate_distance is not None:
+            self.hasher.submit(self.find_duplicates, list(self.file_model.filenames))
 
     def load_files(self):
-        """Load JPG files from input directory into the list widget"""
-        self.file_list.clear()
+        """Load JPG files from input directory into the file list"""
         try:
-            files = [f for f in os.listdir(self.input_dir) if f.lower().endswith('.jpg')]
-            files.sort()
-            for file in files:
-                # Remove any existing checkmark from the filename
-                display_name = file.replace("✓ ", "")
-                item = QListWidgetItem(display_name)
-                # Add checkmark if file has been processed
-                if file in self.processed_files:
-                    item.setText(f"✓ {display_name}")
-                self.file_list.addItem(item)
+            if is_archive(self.input_dir):
+                self.load_archive()
+                return
+            index = DatasetIndex(self.input_dir)
+            rows = np.flatnonzero(index.jpg_files != "")
+            files = index.jpg_files[rows].tolist()
+            self.dng_files = dict(zip(files, index.dng_files[rows].tolist()))
+            fields = zip(*(np.char.lower(column[rows]).tolist() for column in (index.users, index.sensors, index.scene_ids)))
+            self.load_done(files)
+            self.file_model.set_files(files, fields)
+            self.metadata = load_metadata(self.input_dir)
         except Exception as e:
             QMessageBox.warning(self, "Error", f"Failed to load files: {str(e)}")
 
-    def on_file_double_clicked(self, item):
+    def load_archive(self):
+        """List the JPG files in a zip or tar input, which are then read straight out of it."""
+        self.archive = CaptureArchive(self.input_dir)
+        captures = self.archive.list_captures()
+        basenames = sorted(basename for basename, files in captures.items() if 'jpg' in files)
+        files = [captures[basename]['jpg'] for basename in basenames]
+        self.dng_files = {captures[basename]['jpg']: captures[basename].get('dng', "") for basename in basenames}
+        fields = []
+        for basename in basenames:
+            parsed = parse_basename(basename)
+            fields.append((parsed['user'].lower(), parsed['sensor'].lower(), parsed['scene_id'].lower()))
+        self.load_done(files)
+        self.file_model.set_files(files, fields)
+        if METADATA_LOG in self.archive.members:
+            self.metadata = read_metadata(self.archive.read(METADATA_LOG).decode().splitlines())
+        self.loader.read = lambda path: self.archive.read(os.path.basename(path))
+
+    def load_done(self, files):
+        """Find the rectangles of any of the files already in the output folder, so that they can be shown again."""
+        keys = {capture_key(os.path.splitext(filename)[0]): filename for filename in files}
+        with os.scandir(self.output_dir) as it:
+            for entry in it:
+                base, ext = os.path.splitext(entry.name)
+                fields = parse_basename(base) if ext.lower() in ('.jpg', '.json') else None
+                filename = keys.get(capture_key(base)) if fields and fields['rect'] else None
+                if filename and self.same_capture(filename, entry):
+                    x0, y0, x1, y1 = fields['rect']
+                    self.rects[filename] = {'x': x0, 'y': y0, 'width': x1 - x0, 'height': y1 - y0}
+        self.file_model.processed.update(self.rects)
+
+    def same_capture(self, filename, entry):
+        """Check that an output file really came from this input file, and not just one with the same user, sensor
+        and scene ID (scene IDs start again in a new folder)."""
+        try:
+            if entry.name.lower().endswith('.json'):
+                with open(entry.path) as f:
+                    sidecar = json.load(f)
+                if self.archive:
+                    return sidecar.get('archive') == os.path.abspath(self.input_dir) and sidecar.get('jpg') == filename
+                return sidecar.get('jpg') == os.path.abspath(os.path.join(self.input_dir, filename))
+            if self.archive:
+                return entry.stat().st_size == self.archive.size(filename)
+            st = os.stat(os.path.join(self.input_dir, filename))
+            return os.path.samestat(entry.stat(), st) or entry.stat().st_size == st.st_size
+        except (OSError, ValueError, AttributeError, KeyError):
+            return False
+
+    def file_key(self, filename):
+        """Identify an input file by its name, size and modification time."""
+        if self.archive:
+            return (filename, self.archive.size(filename), os.stat(self.input_dir).st_mtime_ns)
+        st = os.stat(os.path.join(self.input_dir, filename))
+        return (filename, st.st_size, st.st_mtime_ns)
+
+    def current_row(self):
+        return self.file_list.currentIndex().row()
+
+    def set_current_row(self, row):
+        if 0 <= row < self.file_model.rowCount():
+            self.file_list.setCurrentIndex(self.file_model.index(row))
+
+    def keep_current(self, change):
+        """Make a change to the model, keeping the current file selected if it's still listed."""
+        current = self.current_row()
+        current = self.file_model.filename(current) if current >= 0 else None
+        change()
+        row = self.file_model.find(current)
+        self.set_current_row(row if row >= 0 else 0)
+        self.file_list.scrollTo(self.file_list.currentIndex())
+
+    def apply_filter(self):
+        state = {1: False, 2: True}.get(self.state_filter.currentIndex())
+        self.keep_current(lambda: self.file_model.set_filter(self.filter_input.text(), state))
+
+    def find_duplicates(self, filenames):
+        # Runs in the background.
+        try:
+            hashes = update_hashes(self.input_dir, filenames, progress=self.hash_progress.emit, archive=self.archive)
+            self.duplicates_found.emit(group_duplicates(hashes, self.duplicate_distance))
+        except Exception as e:
+            print(f"Failed to find near-duplicates: {e}")
+
+    def on_hash_progress(self, done, total):
+        self.statusBar().showMessage(f"Looking for near-duplicates: {done} of {total} images hashed")
+
+    def on_duplicates_found(self, groups):
+        if not groups:
+            self.statusBar().showMessage("No near-duplicate images found")
+            return
+        self.statusBar().showMessage(f"Found {len(groups)} groups of near-duplicates "
+                                     f"({sum(len(group) for group in groups)} images), listed together")
+
+        # List each group after its first image, keeping the current image selected.
+        self.keep_current(lambda: self.file_model.set_duplicates(groups))
+
+    def closeEvent(self, event):
+        self.hasher.shutdown(wait=False, cancel_futures=True)
+        self.annotation_view.transform.close()
+        self.annotation_view.cache.close()
+        if self.archive:
+            self.archive.close()
+        super().closeEvent(event)
+
+    def on_file_double_clicked(self, index):
         """Handle double-click on a file in the list"""
-        filename = item.text()
-        self.process_file(filename)
-
-    def process_file(self, filename):
-        """Process the selected file by loading and displaying it in ImageDialog"""
+        self.annotation_view.setFocus()
+
+    def file_path(self, row):
+        return os.path.join(self.input_dir, self.file_model.filename(row))
+
+    def show_file(self, row):
+        """Swap the image in the annotation view for the one in the given row"""
+        if row < 0:
+            return
+        image_path = self.file_path(row)
+        if image_path == self.shown_path:
+            return
+        image = self.loader.get(image_path).result()
+        if image.isNull():
+            QMessageBox.warning(self, "Error", f"Failed to load image: {os.path.basename(image_path)}")
+            return
+        filename = self.file_model.filename(row)
         try:
-            # Remove any checkmark from the filename
-            clean_filename = filename.replace("✓ ", "")
+            key = self.file_key(filename)
+        except OSError:
+            key = None
+        self.annotation_view.set_image(image, key, self.rects.get(filename))
+        self.shown_path = image_path
+
+        # Start decoding the images either side, so that they're ready when we move on.
+        neighbours = [self.file_path(r) for r in (row - 1, row + 1) if 0 <= r < self.file_model.rowCount()]
+        self.loader.keep(neighbours + [image_path])
+        for path in neighbours[::-1]:
+            self.loader.get(path)
+
+    def next_file(self):
+        self.set_current_row(self.current_row() + 1)
+
+    def previous_file(self):
+        self.set_current_row(self.current_row() - 1)
+
+    def file_list_focus(self):
+        self.file_list.setFocus()
+
+    def accept_and_next(self):
+        if self.filter_input.hasFocus():
+            # Return in the filter box only finishes typing the filter.
+            self.file_list_focus()
+            return
+        row = self.current_row()
+        rect = self.annotation_view.selected_rect
+        # Accept is only enabled for a rectangle that isn't too saturated to use.
+        if row < 0 or rect is None or not self.annotation_view.accept_button.isEnabled():
+            return
+        filename = self.file_model.filename(row)
+        if self.process_file(filename, rect):
+            if self.file_model.filter_state is False:
+                # The file drops out of the "To do" list, and the next one takes its row.
+                self.file_model.set_filter(self.filter_input.text(), False)
+                self.set_current_row(min(row, self.file_model.rowCount() - 1))
+            else:
+                self.next_file()
 
+    def process_file(self, filename, selected_rect):
+        """Copy the file and its DNG to the output folder, named with the selected rectangle"""
+        try:
             # Construct full path to the image
-            image_path = os.path.join(self.input_dir, clean_filename)
+            image_path = os.path.join(self.input_dir, filename)
 
-            # Load the image
-            pixmap = QPixmap(image_path)
-            if pixmap.isNull():
-                QMessageBox.warning(self, "Error", f"Failed to load image: {clean_filename}")
-                return
+            if selected_rect:
+                print(f"Selected rectangle for {filename}: {selected_rect}")
 
-            # Create and show the image dialog
-            dialog = ImageDialog(self)
-            dialog.set_image(pixmap)
-            result = dialog.exec_()
-
-            # After dialog is closed, check if it was accepted
-            if result == QDialog.Accepted and dialog.selected_rect:
-                print(f"Selected rectangle for {clean_filename}: {dialog.selected_rect}")
-                # Add file to processed set
-                self.processed_files.add(clean_filename)
-
-                x0, y0, w, h = dialog.selected_rect['x'], dialog.selected_rect['y'], dialog.selected_rect['width'], dialog.selected_rect['height']
+                x0, y0, w, h = selected_rect['x'], selected_rect['y'], selected_rect['width'], selected_rect['height']
                 x1, y1 = x0 + w, y0 + h
 
-                new_filename = clean_filename.replace(".jpg", f",{x0},{y0},{x1},{y1}.jpg")
-                new_image_path = os.path.join(self.output_dir, new_filename)
-                shutil.copy(image_path, new_image_path)
-                print(f"Copied {image_path} to {new_image_path}")
-
-                dng_path = image_path.replace(".jpg", ".dng")
-                new_dng_path = new_image_path.replace(".jpg", ".dng")
-                shutil.copy(dng_path, new_dng_path)
-                print(f"Copied {dng_path} to {new_dng_path}")
-
-                self.load_files()
+                if not self.dng_files.get(filename):
+                    raise ValueError("there is no matching DNG file")
+                fields = parse_basename(os.path.splitext(filename)[0])
+                new_basename = make_basename(fields['user'], fields['sensor'], fields['scene_id'], (x0, y0, x1, y1))
+                new_image_path = os.path.join(self.output_dir, new_basename + ".jpg")
+                dng_path = os.path.join(self.input_dir, self.dng_files[filename])
+                new_dng_path = os.path.join(self.output_dir, new_basename + ".dng")
+
+                if self.output_mode == "sidecar":
+                    # Just record the rectangle, leaving the images where they are.
+                    sidecar_path = os.path.join(self.output_dir, new_basename + ".json")
+                    if self.archive:
+                        sidecar = {'archive': os.path.abspath(self.input_dir), 'jpg': filename,
+                                   'dng': self.dng_files[filename]}
+                    else:
+                        sidecar = {'jpg': os.path.abspath(image_path), 'dng': os.path.abspath(dng_path)}
+                    with open(sidecar_path, 'w') as f:
+                        json.dump({**sidecar, 'rect': [x0, y0, x1, y1]}, f, indent=2)
+                    print(f"Wrote {sidecar_path}")
+                elif self.archive:
+                    # Only the accepted images ever come out of the archive.
+                    self.archive.extract(self.dng_files[filename], new_dng_path)
+                    print(f"Extracted {self.dng_files[filename]} to {new_dng_path}")
+                    self.archive.extract(filename, new_image_path)
+                    print(f"Extracted {filename} to {new_image_path}")
+                else:
+                    # Do the DNG first, as it's the one most likely to fail.
+                    how = output_file(dng_path, new_dng_path, self.output_mode)
+                    print(f"{how.capitalize()} {dng_path} to {new_dng_path}")
+                    how = output_file(image_path, new_image_path, self.output_mode)
+                    print(f"{how.capitalize()} {image_path} to {new_image_path}")
+                # Take the camera's metadata along to the output folder's log.
+                record = self.metadata.get(capture_key(new_basename))
+                if record:
+                    append_record(self.output_dir, new_basename, {k: v for k, v in record.items() if k != 'name'})
+
+                self.rects[filename] = dict(selected_rect)
+                self.file_model.set_processed(filename)
+                return True
             else:
-                print(f"No rectangle selected for {clean_filename}")
+                print(f"No rectangle selected for {filename}")
 
         except Exception as e:
-            QMessageBox.warning(self, "Error", f"Error processing file {clean_filename}: {str(e)}")
+            QMessageBox.warning(self, "Error", f"Error processing file {filename}: {str(e)}")
+        return False
 
 if __name__ == '__main__':
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='AWB-O-Matic Tool')
     parser.add_argument('--input-dir', type=str, default=INPUT_DIR,
-                      help=f'Input directory containing images (default: {INPUT_DIR})')
+                      help=f'Input directory containing images, or a zip or tar file of them (default: {INPUT_DIR})')
     parser.add_argument('--output-dir', type=str, default=OUTPUT_DIR,
                       help=f'Output directory for processed images (default: {OUTPUT_DIR})')
+    parser.add_argument('--output-mode', choices=OUTPUT_MODES, default=OUTPUT_MODE,
+                      help=f'How to put accepted images in the output directory (default: {OUTPUT_MODE})')
+    parser.add_argument('--duplicate-distance', type=int, default=DUPLICATE_DISTANCE,
+                      help=f'Group images whose hashes differ by at most this many bits (default: {DUPLICATE_DISTANCE})')
+    parser.add_argument('--no-duplicates', action='store_true', help='Do not look for near-duplicate images')
+    parser.add_argument('--threads', type=int, default=None,
+                      help='Number of threads for the gain preview (default: one per CPU)')
+    parser.add_argument('--memory-budget', type=int, default=MEMORY_BUDGET >> 20,
+                      help=f'Most scratch memory in MB for the gain preview (default: {MEMORY_BUDGET >> 20})')
+    parser.add_argument('--cache-memory', type=int, default=CACHE_MEMORY >> 20,
+                      help=f'Most memory in MB for remembering corrected images (default: {CACHE_MEMORY >> 20})')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                      help='Also save the gains and corrected images in this directory, to use in later sessions')
+    parser.add_argument('--watchdog', type=float, nargs='?', const=STALL_THRESHOLD, default=None, metavar='SECONDS',
+                      help='Report what holds up the GUI for longer than this many seconds, when it exits '
+                      f'(default: {STALL_THRESHOLD})')
+    parser.add_argument('--watchdog-report', type=str, default=None,
+                      help='Also write the --watchdog report to this file')
     args = parser.parse_args()
+    if not 0 <= args.duplicate_distance < 64:
+        parser.error("--duplicate-distance must be from 0 to 63")
 
     app = QApplication(sys.argv)
-    window = Rectangulator(input_dir=args.input_dir, output_dir=args.output_dir)
+    if args.watchdog is not None:
+        watchdog = StallWatchdog(app, args.watchdog, args.watchdog_report)
+    window = Rectangulator(input_dir=args.input_dir, output_dir=args.output_dir, output_mode=args.output_mode,
+                           duplicate_distance=None if args.no_duplicates else args.duplicate_distance,
+                           threads=args.threads, memory_budget=args.memory_budget << 20,
+                           cache_memory=args.cache_memory << 20, cache_dir=args.cache_dir)
     window.show()
     sys.exit(app.exec_())
@@ -0,0 +1,265 @@
+#! /usr/bin/env python3
+
+# Low-bandwidth camera preview for when the capture tools are run over ssh.
+#
+# QPicamera2 paints every frame it gets (up to 30fps, at the size of the widget) and over
+# X forwarding that quickly saturates a slow link. RemotePreview only takes a new frame once
+# the previous one has actually been painted, and adapts both the frame interval and the
+# frame size to how long that took. Alternatively, frames can be served as a compressed
+# MJPEG stream on a local port, which can be forwarded with "ssh -L" and viewed in a browser.
+
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+from PyQt5.QtWidgets import QWidget
+from PyQt5.QtGui import QPainter, QImage, QColor
+from PyQt5.QtCore import Qt, QRect, pyqtSignal
+from picamera2 import Preview
+
+class PreviewThrottle:
+    """Decides when the next preview frame is wanted, and at what size, from measured delivery times."""
+
+    # Fractions of the full preview size that we step between.
+    SCALES = (1.0, 0.75, 0.5, 0.35, 0.25)
+
+    def __init__(self, min_interval=1 / 15, max_interval=2.0, duty=0.5, slow_time=0.1):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.duty = duty  # Fraction of the time we're willing to spend delivering frames
+        self.slow_time = slow_time  # Delivery times above this make us shrink the frames
+        self.lock = threading.Lock()
+        self.scale_index = 2
+        self.delivery_time = None
+        self.next_due = 0.0
+        self.busy = False
+        self.fast_count = 0
+
+    @property
+    def scale(self):
+        return self.SCALES[self.scale_index]
+
+    @property
+    def fps(self):
+        if self.delivery_time is None:
+            return 0.0
+        return 1.0 / max(self.min_interval, min(self.max_interval, self.delivery_time / self.duty))
+
+    def ready(self, now):
+        # Only one frame is ever in flight, so a slow link can't build up a backlog.
+        with self.lock:
+            if self.busy or now < self.next_due:
+                return False
+            self.busy = True
+            return True
+
+    def cancel(self):
+        with self.lock:
+            self.busy = False
+
+    def delivered(self, started, finished):
+        with self.lock:
+            self.busy = False
+            elapsed = finished - started
+            if self.delivery_time is None:
+                self.delivery_time = elapsed
+            else:
+                self.delivery_time = 0.7 * self.delivery_time + 0.3 * elapsed
+            interval = max(self.min_interval, min(self.max_interval, self.delivery_time / self.duty))
+            self.next_due = started + interval
+
+            # Shrink the frames as soon as delivery is slow, but only grow them again once
+            # it has been comfortably fast for a while.
+            if self.delivery_time > self.slow_time and self.scale_index < len(self.SCALES) - 1:
+                self.scale_index += 1
+                self.fast_count = 0
+                self.delivery_time = None
+            elif self.delivery_time < self.slow_time / 4 and self.scale_index > 0:
+                self.fast_count += 1
+                if self.fast_count >= 10:
+                    self.scale_index -= 1
+                    self.fast_count = 0
+                    self.delivery_time = None
+            else:
+                self.fast_count = 0
+
+def request_to_rgb(request, stream, max_size):
+    """Make a small RGB array from a request's stream, subsampling so that it fits within max_size."""
+    config = request.config[stream]
+    width, height = config['size']
+    step = 1
+    while width // step > max_size[0] or height // step > max_size[1]:
+        step *= 2
+    array = request.make_array(stream)
+    if config['format'] == 'YUV420':
+        # The U and V planes follow the Y plane, each half the width and half the height.
+        stride = config['stride']
+        step = max(step, 2)
+        uv_step = step // 2
+        y = array[:height:step, :width:step].astype(np.float32)
+        u = array[height:height + height // 4].reshape(height // 2, stride // 2)[::uv_step, :width // 2:uv_step]
+        v = array[height + height // 4:height + height // 2].reshape(height // 2, stride // 2)[::uv_step, :width // 2:uv_step]
+        h = min(y.shape[0], u.shape[0])
+        w = min(y.shape[1], u.shape[1])
+        y = y[:h, :w]
+        u = u[:h, :w].astype(np.float32) - 128
+        v = v[:h, :w].astype(np.float32) - 128
+        rgb = np.empty((h, w, 3), dtype=np.float32)
+        rgb[..., 0] = y + 1.402 * v
+        rgb[..., 1] = y - 0.344136 * u - 0.714136 * v
+        rgb[..., 2] = y + 1.772 * u
+        return np.clip(rgb, 0, 255).astype(np.uint8)
+    rgb = array[::step, ::step, :3]
+    if config['format'] in ('XRGB8888', 'RGB888'):
+        # These formats are B, G, R in memory.
+        rgb = rgb[..., ::-1]
+    return np.ascontiguousarray(rgb)
+
+class MjpegStreamer:
+    """Serves the most recent preview frame as an MJPEG stream over http."""
+
+    def __init__(self, port, quality=70):
+        import simplejpeg  # Only needed when streaming, and installed alongside picamera2
+
+        self.encode = simplejpeg.encode_jpeg
+        self.quality = quality
+        self.throttle = PreviewThrottle(min_interval=1 / 30)
+        self.condition = threading.Condition()
+        self.frame = None
+        self.frame_count = 0
+
+        streamer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
+                self.end_headers()
+                streamer.stream_to(self.wfile)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('localhost', port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        print(f"Preview stream at http://localhost:{port}/")
+
+    def want_frame(self, now):
+        return self.throttle.ready(now)
+
+    def put_frame(self, rgb, started):
+        with self.condition:
+            self.frame = (rgb, started)
+            self.frame_count += 1
+            self.condition.notify_all()
+
+    def stream_to(self, wfile):
+        last_count = 0
+        try:
+            while True:
+                with self.condition:
+                    self.condition.wait_for(lambda: self.frame_count != last_count)
+                    rgb, started = self.frame
+                    last_count = self.frame_count
+                # Encode here, rather than in the camera thread, and include the encode in the
+                # delivery time so that a slow Pi backs off just like a slow link does.
+                jpeg = self.encode(rgb, quality=self.quality, colorspace='RGB')
+                wfile.write(b'--FRAME\r\nContent-Type: image/jpeg\r\n')
+                wfile.write(f"Content-Length: {len(jpeg)}\r\n\r\n".encode())
+                wfile.write(jpeg)
+                wfile.write(b'\r\n')
+                wfile.flush()
+                self.throttle.delivered(started, time.monotonic())
+        except OSError:
+            pass  # the client has gone away, however the socket said so
+        finally:
+            # Whatever stopped the stream, the frame in flight isn't coming back.
+            self.throttle.cancel()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class RemotePreview(QWidget):
+    """A drop-in replacement for QPicamera2 that adapts to a slow X connection."""
+
+    done_signal = pyqtSignal(object)
+    frame_signal = pyqtSignal(QImage, float)
+
+    def __init__(self, picam2, bg_colour=(20, 20, 20), stream='main', http_port=None, jpeg_quality=70):
+        super().__init__()
+        self.picam2 = picam2
+        self.stream = stream
+        self.bg_colour = QColor(*bg_colour)
+        self.image = None
+        self.image_rect = QRect()
+        self.overlay = None
+        self.throttle = PreviewThrottle()
+        self.streamer = MjpegStreamer(http_port, jpeg_quality) if http_port else None
+        self.message = f"Preview streaming at http://localhost:{http_port}/" if http_port else None
+        self.frame_signal.connect(self.show_frame)
+
+        # Without a Qt preview, something else must run the camera's event loop.
+        self.picam2.start_preview(Preview.NULL)
+        self.picam2.post_callback = self.on_request
+
+    def signal_done(self, job):
+        self.done_signal.emit(job)
+
+    def set_overlay(self, overlay):
+        """Draw an RGBA array over the frames, scaled to fit them, as QPicamera2 does. None removes it."""
+        if overlay is None:
+            self.overlay = None
+        else:
+            h, w = overlay.shape[:2]
+            self.overlay = QImage(np.ascontiguousarray(overlay).data, w, h, 4 * w, QImage.Format_RGBA8888).copy()
+        self.update(self.image_rect)
+
+    def on_request(self, request):
+        # Called in the camera thread for every frame, so must return quickly when no frame is wanted.
+        now = time.monotonic()
+        if self.streamer:
+            if self.streamer.want_frame(now):
+                size = request.config[self.stream]['size']
+                scale = self.streamer.throttle.scale
+                max_size = (int(size[0] * scale), int(size[1] * scale))
+                self.streamer.put_frame(request_to_rgb(request, self.stream, max_size), now)
+            return
+        if not self.throttle.ready(now):
+            return
+        scale = self.throttle.scale
+        max_size = (max(1, int(self.width() * scale)), max(1, int(self.height() * scale)))
+        rgb = request_to_rgb(request, self.stream, max_size)
+        h, w = rgb.shape[:2]
+        qimg = QImage(rgb.data, w, h, 3 * w, QImage.Format_RGB888).copy()
+        self.frame_signal.emit(qimg, now)
+
+    def show_frame(self, qimg, started):
+        # Frames are painted at their own size rather than scaled up, as scaling up here would
+        # only send the same number of pixels over the link as a full size frame.
+        old_rect = self.image_rect
+        self.image = qimg
+        self.image_rect = QRect(0, 0, qimg.width(), qimg.height())
+        self.image_rect.moveCenter(self.rect().center())
+        self.repaint(self.image_rect.united(old_rect))
+        self.throttle.delivered(started, time.monotonic())
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(event.rect(), self.bg_colour)
+        if self.message:
+            painter.setPen(QColor(255, 255, 255))
+            painter.drawText(self.rect(), Qt.AlignCenter, self.message)
+        elif self.image is not None:
+            painter.drawImage(self.image_rect, self.image)
+            if self.overlay is not None:
+                painter.drawImage(self.image_rect, self.overlay)
+
+    def closeEvent(self, event):
+        self.picam2.post_callback = None
+        if self.streamer:
+            self.streamer.close()
+        super().closeEvent(event)
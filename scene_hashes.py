@@ -0,0 +1,152 @@
+# Finding near-duplicate captures with perceptual hashes.
+#
+# Each JPEG gets a 64 bit difference hash (dHash) of a tiny greyscale thumbnail. The JPEG
+# decoder is asked for a reduced size image ("draft" mode), so this is mostly just reading
+# the file. Hashes are kept in an index alongside the images, keyed on each file's size and
+# modification time, so that only new or changed files are hashed again. Images in a zip or tar
+# bundle (see capture_archive.py) have their index alongside the bundle.
+#
+# Two captures are near-duplicates when their hashes differ in at most a few bits. Rather than
+# compare every pair, the hashes are split into more bands than the number of bits allowed to
+# differ, so any near-duplicate pair must match exactly in at least one band, and only hashes
+# that do are compared.
+
+import os
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+INDEX_NAME = ".scene-hashes.json"
+HASH_SIZE = 8  # The hash has HASH_SIZE * HASH_SIZE bits
+MAX_DISTANCE = 6  # Hashes differing in at most this many bits are near-duplicates
+COMPARE_CHUNK = 1 << 20  # Most pairs of hashes compared at once
+
+def scene_hash(path):
+    """Return the difference hash of an image (a path or file object) as an int."""
+    with Image.open(path) as image:
+        image.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+        small = image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int(np.packbits(bits).view('>u8')[0])
+
+def file_key(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+def load_index(index_path):
+    try:
+        with open(index_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_index(index_path, index):
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+    os.replace(tmp_path, index_path)
+
+def update_hashes(directory, names, workers=None, progress=None, archive=None):
+    """Return {name: hash} for the given JPEG files, only hashing the ones not already in the index.
+
+    progress, if given, is called with (done, total) as files are hashed. If archive is given, the
+    files are read from that CaptureArchive rather than from directory."""
+    if archive:
+        index_path = archive.path + INDEX_NAME
+        archive_mtime = os.stat(archive.path).st_mtime_ns
+        key_of = lambda name: [archive.size(name), archive_mtime]
+        hash_of = lambda name: scene_hash(io.BytesIO(archive.read(name)))
+    else:
+        index_path = os.path.join(directory, INDEX_NAME)
+        key_of = lambda name: file_key(os.path.join(directory, name))
+        hash_of = lambda name: scene_hash(os.path.join(directory, name))
+    index = load_index(index_path)
+    entries = {}
+    todo = []
+    for name in names:
+        try:
+            key = key_of(name)
+        except (OSError, KeyError):
+            continue
+        entry = index.get(name)
+        if entry and entry[:2] == key:
+            entries[name] = entry
+        else:
+            todo.append((name, key))
+
+    def try_hash(name):
+        try:
+            return hash_of(name)
+        except (OSError, ValueError) as e:
+            # Truncated or half-written files get no hash, and aren't tried again until they change.
+            print(f"Could not hash {name}: {e}")
+            return None
+
+    if todo:
+        try:
+            # The JPEG decoder releases the GIL, so threads are enough here.
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                hashes = pool.map(lambda item: try_hash(item[0]), todo)
+                for i, ((name, key), value) in enumerate(zip(todo, hashes)):
+                    entries[name] = key + [None if value is None else f"{value:016x}"]
+                    if progress and ((i + 1) % 100 == 0 or i + 1 == len(todo)):
+                        progress(i + 1, len(todo))
+        finally:
+            # Keep whatever was hashed, even if something went wrong.
+            try:
+                save_index(index_path, entries)
+            except OSError as e:
+                print(f"Could not save {index_path}: {e}")
+    return {name: int(entry[2], 16) for name, entry in entries.items() if entry[2] is not None}
+
+def popcount(values):
+    """Count the set bits of each element of a uint64 array."""
+    values = values - ((values >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    values = (values & np.uint64(0x3333333333333333)) + ((values >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    values = (values + (values >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return (values * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+def group_duplicates(hashes, max_distance=MAX_DISTANCE):
+    """Group near-duplicate names, returning a list of sorted groups with more than one member."""
+    if not 0 <= max_distance < HASH_SIZE * HASH_SIZE:
+        raise ValueError(f"max_distance must be from 0 to {HASH_SIZE * HASH_SIZE - 1}")
+    names = sorted(hashes)
+    values = np.array([hashes[name] for name in names], dtype=np.uint64)
+    # Captures with identical hashes are duplicates anyway, so only the distinct hashes are compared.
+    unique, inverse = np.unique(values, return_inverse=True)
+    parent = list(range(len(unique)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    bands = max_distance + 1
+    for band in range(bands):
+        lo = band * 64 // bands
+        hi = (band + 1) * 64 // bands
+        keys = (unique >> np.uint64(lo)) & np.uint64((1 << (hi - lo)) - 1)
+        order = np.argsort(keys, kind='stable')
+        boundaries = np.flatnonzero(np.diff(keys[order])) + 1
+        for members in np.split(order, boundaries):
+            if len(members) < 2:
+                continue
+            v = unique[members]
+            # Compare each hash only with those after it, a few rows at a time so that big buckets don't need n * n memory.
+            step = max(1, COMPARE_CHUNK // len(members))
+            for first in range(0, len(members) - 1, step):
+                rows = v[first:first + step]
+                close = popcount(rows[:, None] ^ v[None, first + 1:]) <= max_distance
+                i, j = np.nonzero(close)
+                pairs = j >= i
+                for a, b in zip(members[first + i[pairs]], members[first + 1 + j[pairs]]):
+                    parent[find(a)] = find(b)
+
+    groups = {}
+    for name, i in zip(names, inverse):
+        groups.setdefault(find(i), []).append(name)
+    return [group for group in groups.values() if len(group) > 1]
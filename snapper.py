@@ -4,6 +4,12 @@ import sys
 import os
 import argparse
 import shutil
+import json
+import queue
+import signal
+import socket
+import threading
+import time
 import numpy as np
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout,
                             QLineEdit, QPushButton, QLabel, QFileDialog,
@@ -11,23 +17,57 @@ from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout,
                             QMessageBox)
 from PyQt5.QtGui import QPixmap, QWheelEvent, QPainter, QPalette, QPen, QColor, QImage
 from PyQt5.QtCore import Qt, QPoint, QRect, QTimer
-from picamera2 import Picamera2, Preview
-from picamera2.previews.qt import QGlPicamera2, QPicamera2
+from picamera2 import Picamera2
+from picamera2.previews.qt import QGlPicamera2
+from remote_preview import RemotePreview
+from capture_writer import CaptureWriter
+from interval_capture import IntervalSchedule, BACKLOG_POLICIES
+from capture_names import make_basename, INVALID_CHARS
+from preview_profiles import PreviewAdapter, PROFILES, DEFAULT_PROFILE
+from stall_watchdog import StallWatchdog, STALL_THRESHOLD
 
 # You can override these here, if you wish, or on the command line.
 USER = ""
 OUTPUT_DIR = os.path.join(os.path.expanduser("~"), "awb-captures")
 CAMERA = 0
+MAX_PENDING = 16  # Most commands that can wait in the headless mode before clients are held up
+MAX_PENDING_WRITES = 2  # Interval shots are skipped or delayed while more captures than this wait to be written
+
+def open_camera(camera, preview_profile=DEFAULT_PROFILE, adaptive_preview=True, busy=None):
+    """Open and configure the camera for previewing, returning it with its sensor name, still configuration
+    and the PreviewAdapter managing the preview."""
+    picam2 = Picamera2(camera)
+    sensor = picam2.camera_properties['Model']
+    if 'mono' in sensor.lower() or 'noir' in sensor.lower():
+        raise ValueError("Mono/Noir cameras are not supported - please use a colour camera")
+    # Only the still configuration needs a raw stream.
+    capture_config = picam2.create_still_configuration()
+    preview = PreviewAdapter(picam2, preview_profile, adaptive=adaptive_preview, busy=busy)
+    preview.configure()
+    if 'AfMode' in picam2.camera_controls:
+        picam2.set_controls({"AfMode": 2})  # Continuous AF, where available
+    return picam2, sensor, capture_config, preview
+
+def is_valid_filename(text):
+    return not any(char in INVALID_CHARS for char in text)
 
 class Snapper(QMainWindow):
-    def __init__(self, user=USER, output_dir=OUTPUT_DIR, camera=CAMERA, ssh_mode=False, initial_scene_id=0):
+    def __init__(self, user=USER, output_dir=OUTPUT_DIR, camera=CAMERA, ssh_mode=False, initial_scene_id=0, preview_port=None,
+                 compress_raw=False, interval=None, count=None, on_backlog="skip", preview_profile=DEFAULT_PROFILE,
+                 adaptive_preview=True):
         super().__init__()
 
+        self.capturing = False
         self.output_dir = output_dir
         self.user = user
         self.scene_id = initial_scene_id  # Initialize scene ID counter with provided value
 
-        self.configure_camera(camera)
+        self.configure_camera(camera, preview_profile, adaptive_preview)
+
+        # Files are written in the background so that we can carry on capturing.
+        self.writer = CaptureWriter(self.picam2, compress_raw=compress_raw)
+        self.writer.saved.connect(self.save_done)
+        self.writer.failed.connect(self.save_failed)
 
         self.setWindowTitle("AWB Snapper")
         self.setGeometry(50, 50, 1000, 800)  # Increased main window size
@@ -76,6 +116,20 @@ class Snapper(QMainWindow):
         self.ev_value_label = QLabel(f"EV: {self.ev_value}")
         ev_button_layout.addWidget(self.ev_value_label)
 
+        # Captures at fixed intervals, if asked for
+        self.interval = interval
+        self.count = count
+        self.on_backlog = on_backlog
+        self.schedule = None
+        self.interval_timer = QTimer(self)
+        self.interval_timer.setSingleShot(True)
+        self.interval_timer.setTimerType(Qt.PreciseTimer)
+        self.interval_timer.timeout.connect(self.on_interval_timer)
+        if interval:
+            self.interval_button = QPushButton(f"Start Capturing Every {interval:g}s")
+            self.interval_button.clicked.connect(self.toggle_intervals)
+            ev_button_layout.addWidget(self.interval_button)
+
         layout.addLayout(ev_button_layout)
 
         hbox_layout = QHBoxLayout()
@@ -98,9 +152,14 @@ class Snapper(QMainWindow):
 
         layout.addLayout(hbox_layout)
 
+        # Report how long the last capture took to write, and how big it was
+        self.save_label = QLabel("No captures saved yet")
+        layout.addWidget(self.save_label)
+
         bg_colour = self.palette().color(QPalette.Background).getRgb()[:3]
         if ssh_mode:
-            self.qpicamera2 = QPicamera2(self.picam2, bg_colour=bg_colour)
+            # Over ssh, use a preview that adapts to the speed of the link (or streams it as MJPEG).
+            self.qpicamera2 = RemotePreview(self.picam2, bg_colour=bg_colour, http_port=preview_port)
         else:
             self.qpicamera2 = QGlPicamera2(self.picam2, bg_colour=bg_colour)
 
@@ -109,30 +168,17 @@ class Snapper(QMainWindow):
         self.qpicamera2.setFixedSize(768, 512)
         layout.addWidget(self.qpicamera2)
 
+        # Move to a cheaper preview if frames are being dropped (and back again when things improve).
+        self.preview_timer = QTimer(self)
+        self.preview_timer.timeout.connect(self.preview.check)
+        self.preview_timer.start(1000)
+
         self.picam2.start()
         self.showMaximized()
 
-    def configure_camera(self, camera):
-        self.picam2 = Picamera2(camera)
-        self.sensor = self.picam2.camera_properties['Model']
-        if 'mono' in self.sensor.lower() or 'noir' in self.sensor.lower():
-            raise ValueError("Mono/Noir cameras are not supported - please use a colour camera")
-        self.capture_config = self.picam2.create_still_configuration()
-        full_res = self.picam2.sensor_resolution
-        half_res = (full_res[0] // 2, full_res[1] // 2)
-        preview_res = half_res
-        while preview_res[0] > 1280:
-            preview_res = (preview_res[0] // 2, preview_res[1] // 2)
-        self.preview_res = preview_res
-        print(f"Preview resolution: {preview_res}")
-        preview_config = self.picam2.create_preview_configuration(
-            {'format': 'YUV420', 'size': preview_res},
-            raw={'format': 'SBGGR12', 'size': half_res}, # force unpacked, full FOV
-            controls={'FrameRate': 30}
-        )
-        self.picam2.configure(preview_config)
-        if 'AfMode' in self.picam2.camera_controls:
-            self.picam2.set_controls({"AfMode": 2})  # Continuous AF, where available
+    def configure_camera(self, camera, preview_profile=DEFAULT_PROFILE, adaptive_preview=True):
+        self.picam2, self.sensor, self.capture_config, self.preview = open_camera(
+            camera, preview_profile, adaptive_preview, busy=lambda: self.capturing)
 
     def ev_up(self):
         self.ev_value += 0.125
@@ -144,35 +190,272 @@ class Snapper(QMainWindow):
         self.picam2.set_controls({"ExposureValue": self.ev_value})
         self.ev_value_label.setText(f"EV: {self.ev_value}")
 
+    def toggle_intervals(self):
+        if self.schedule:
+            self.stop_intervals()
+            return
+        self.schedule = IntervalSchedule(self.interval, self.count, self.on_backlog)
+        self.schedule.begin()
+        self.interval_button.setText("Stop Interval Capture")
+        self.on_interval_timer()
+
+    def stop_intervals(self):
+        self.interval_timer.stop()
+        summary = self.schedule.summary()
+        print(summary)
+        self.save_label.setText(summary)
+        self.schedule = None
+        self.interval_button.setText(f"Start Capturing Every {self.interval:g}s")
+
+    def on_interval_timer(self):
+        now = time.monotonic()
+        busy = self.capturing or self.writer.pending >= MAX_PENDING_WRITES
+        if self.schedule.poll(now, busy) is not None:
+            self.capture()
+        if self.schedule.done:
+            self.stop_intervals()
+        else:
+            # Round up, so as not to wake up just before the shot is due.
+            self.interval_timer.start(int(self.schedule.wait_time(time.monotonic()) * 1000) + 1)
+
     def capture(self):
+        if self.capturing:
+            return
+        self.capturing = True
         self.capture_button.setEnabled(False)
         print("Doing capture")
         self.picam2.switch_mode_and_capture_request(
             self.capture_config, wait=False, signal_function=self.qpicamera2.signal_done)
 
     def capture_done(self, job):
+        self.capturing = False
         self.capture_button.setEnabled(True)
         request = job.get_result()
         while True:
-            filename = os.path.join(self.output_dir, f"{self.user},{self.sensor},{self.scene_id:05d}")
+            filename = os.path.join(self.output_dir, make_basename(self.user, self.sensor, f"{self.scene_id:05d}"))
             if not os.path.exists(filename + ".jpg"):
                 break
             self.scene_id += 1
             self.scene_id_label.setText(f"Scene Id: {self.scene_id:05d}")
-        request.save('main', filename + ".jpg")
-        request.save_dng(filename + ".dng")
+        self.writer.save(request, filename + ".jpg", filename + ".dng", ev=self.ev_value)
         print("Capture done", request)
         request.release()
-        print("Files saved as", filename + ".jpg and", filename + ".dng")
 
         # Increment scene ID and update display
         self.scene_id += 1
         self.scene_id_label.setText(f"Scene Id: {self.scene_id:05d}")
 
+    def save_done(self, report):
+        raw_type = "compressed DNG" if report['compressed'] else "DNG"
+        self.save_label.setText(
+            f"Saved {os.path.basename(report['jpg'])}: JPEG {report['jpg_bytes'] / 1e6:.1f}MB in {report['jpg_time']:.2f}s, "
+            f"{raw_type} {report['dng_bytes'] / 1e6:.1f}MB in {report['dng_time']:.2f}s")
+
+    def save_failed(self, message):
+        QMessageBox.critical(self, "Error", message)
+
+    def closeEvent(self, event):
+        # Make sure nothing is lost that is still waiting to be written.
+        self.preview_timer.stop()
+        self.preview.close()
+        self.writer.close()
+        super().closeEvent(event)
+
     def is_valid_filename(self, text):
-        # List of characters not allowed in filenames
-        invalid_chars = '<>:"/\\|?*,\''
-        return not any(char in invalid_chars for char in text)
+        return is_valid_filename(text)
+
+class SnapperDaemon:
+    """Runs the camera without a window, taking commands from a Unix domain socket.
+
+    Commands are JSON objects, one per line, and each gets a one line JSON reply with "ok" set
+    to true or false (and an "error" message if false). Any "id" in a command is copied into
+    its reply. Commands are run in the order they arrive, and clients may send several before
+    reading the replies, so that captures follow each other as fast as the camera allows.
+
+        {"cmd": "capture"}                      capture the next scene, or
+        {"cmd": "capture", "scene_id": "name"}  capture a scene with the given id
+        {"cmd": "ev", "value": -0.5}            set the exposure value
+        {"cmd": "scene", "value": 100}          set the next scene number
+        {"cmd": "status"}                       report the settings and number of captures
+
+    Capture replies are sent once the files have been written, and give their paths, sizes
+    and how long everything took."""
+
+    def __init__(self, socket_path, user=USER, output_dir=OUTPUT_DIR, camera=CAMERA, initial_scene_id=0,
+                 compress_raw=False, interval=None, count=None, on_backlog="skip", preview_profile=DEFAULT_PROFILE,
+                 adaptive_preview=True):
+        self.socket_path = socket_path
+        self.user = user
+        self.output_dir = output_dir
+        self.scene_id = initial_scene_id
+        self.ev_value = 0
+        self.captures = 0
+        self.capturing = False
+        self.writing = set()  # basenames of captures still waiting to be written
+        self.picam2, self.sensor, self.capture_config, self.preview = open_camera(
+            camera, preview_profile, adaptive_preview, busy=lambda: self.capturing)
+        self.writer = CaptureWriter(self.picam2, compress_raw=compress_raw)
+        # A full queue holds up the connections' reader threads, and so the clients.
+        self.commands = queue.Queue(maxsize=MAX_PENDING)
+        self.running = True
+        self.stopped = threading.Event()
+        self.schedule = IntervalSchedule(interval, count, on_backlog) if interval else None
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(socket_path)
+        self.server.listen()
+        threading.Thread(target=self.accept_connections, daemon=True).start()
+
+    def accept_connections(self):
+        while self.running:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.read_commands, args=(conn,), daemon=True).start()
+
+    def read_commands(self, conn):
+        lock = threading.Lock()  # Replies may come from the capture writer's thread too
+
+        def reply(command, response):
+            if isinstance(command, dict) and 'id' in command:
+                response['id'] = command['id']
+            with lock:
+                try:
+                    conn.sendall(json.dumps(response).encode() + b'\n')
+                except OSError:
+                    pass  # The client has gone away
+
+        with conn, conn.makefile('rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    command = json.loads(line)
+                except ValueError as e:
+                    reply(None, {'ok': False, 'error': f"Bad command: {e}"})
+                    continue
+                self.commands.put((command, reply, time.monotonic()))
+            # Wait for our replies to be sent before the connection is closed.
+            done = threading.Event()
+            self.commands.put((None, lambda command, response: done.set(), time.monotonic()))
+            done.wait()
+            self.writer.wait()
+
+    def run_schedule(self):
+        # Interval shots go through the command queue like any others.
+        self.schedule.begin()
+        while not self.schedule.done and not self.stopped.is_set():
+            busy = self.capturing or not self.commands.empty() or self.writer.pending >= MAX_PENDING_WRITES
+            scheduled = self.schedule.poll(time.monotonic(), busy)
+            if scheduled is not None:
+                self.commands.put(({'cmd': 'capture', 'id': f"interval-{self.schedule.slot}"}, self.log_reply, scheduled))
+            self.stopped.wait(self.schedule.wait_time(time.monotonic()))
+        print(self.schedule.summary())
+
+    def log_reply(self, command, response):
+        if response.get('ok'):
+            print(f"{command['id']}: {os.path.basename(response['jpg'])} captured in {response['capture_time']:.2f}s")
+        else:
+            print(f"{command['id']}: failed: {response.get('error')}")
+
+    def run(self):
+        self.picam2.start()
+        print(f"Listening on {self.socket_path}")
+        if self.schedule:
+            threading.Thread(target=self.run_schedule, daemon=True).start()
+        while self.running:
+            # The camera is only reconfigured from here, between captures.
+            self.preview.check()
+            try:
+                command, reply, received = self.commands.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if command is None:
+                reply(None, {})
+                continue
+            try:
+                cmd = command.get('cmd') if isinstance(command, dict) else None
+                if cmd == 'capture':
+                    self.capture(command, reply, received)
+                elif cmd == 'ev':
+                    self.ev_value = float(command['value'])
+                    self.picam2.set_controls({"ExposureValue": self.ev_value})
+                    reply(command, {'ok': True, 'ev': self.ev_value})
+                elif cmd == 'scene':
+                    self.scene_id = int(command['value'])
+                    reply(command, {'ok': True, 'scene_id': self.scene_id})
+                elif cmd == 'status':
+                    reply(command, {'ok': True, 'user': self.user, 'sensor': self.sensor, 'output_dir': self.output_dir,
+                                    'scene_id': self.scene_id, 'ev': self.ev_value, 'captures': self.captures,
+                                    'pending': self.commands.qsize()})
+                else:
+                    reply(command, {'ok': False, 'error': f"Unknown command {cmd!r}"})
+            except Exception as e:
+                reply(command, {'ok': False, 'error': str(e)})
+
+    def next_filename(self):
+        while True:
+            filename = os.path.join(self.output_dir, make_basename(self.user, self.sensor, f"{self.scene_id:05d}"))
+            self.scene_id += 1
+            if not self.taken(filename):
+                return filename
+
+    def taken(self, filename):
+        # A capture that is still being written isn't on disk yet.
+        return filename in self.writing or os.path.exists(filename + ".jpg")
+
+    def capture(self, command, reply, received):
+        scene_id = command.get('scene_id')
+        if scene_id is not None:
+            scene_id = str(scene_id)
+            if not scene_id or not is_valid_filename(scene_id):
+                raise ValueError(f"Invalid scene id {scene_id!r}")
+            filename = os.path.join(self.output_dir, make_basename(self.user, self.sensor, scene_id))
+            if self.taken(filename):
+                raise ValueError(f"{filename}.jpg already exists")
+        else:
+            filename = self.next_filename()
+
+        start = time.monotonic()
+        self.capturing = True
+        try:
+            request = self.picam2.switch_mode_and_capture_request(self.capture_config)
+        finally:
+            self.capturing = False
+        captured = time.monotonic()
+        self.writing.add(filename)
+        try:
+            future = self.writer.save(request, filename + ".jpg", filename + ".dng", ev=self.ev_value)
+        except Exception:
+            self.writing.discard(filename)
+            raise
+        finally:
+            request.release()
+        self.captures += 1
+
+        def done(future):
+            self.writing.discard(filename)
+            try:
+                report = future.result()
+            except Exception as e:
+                reply(command, {'ok': False, 'error': str(e)})
+                return
+            reply(command, {'ok': True, **report, 'wait_time': start - received,
+                            'capture_time': captured - start, 'total_time': time.monotonic() - received})
+        future.add_done_callback(done)
+
+    def close(self):
+        self.running = False
+        self.stopped.set()
+        self.server.close()
+        self.writer.close()
+        self.preview.close()
+        self.picam2.stop()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
 
 
 if __name__ == '__main__':
@@ -184,6 +467,24 @@ if __name__ == '__main__':
     ssh_group = parser.add_mutually_exclusive_group()
     ssh_group.add_argument('-s', '--ssh', action='store_true', help='Enable SSH mode')
     ssh_group.add_argument('--no-ssh', action='store_true', help='Disable SSH mode')
+    parser.add_argument('--compress-raw', action='store_true', help='Save DNG files with lossless compression')
+    parser.add_argument('--preview-port', type=int,
+                        help='In SSH mode, stream the preview as MJPEG on this local port instead of over X')
+    parser.add_argument('--socket', type=str,
+                        help='Run without a window, taking commands from a Unix domain socket at this path')
+    parser.add_argument('--interval', type=float, help='Capture every this many seconds')
+    parser.add_argument('--count', type=int, help='Number of interval captures to take (default: no limit)')
+    parser.add_argument('--on-backlog', choices=BACKLOG_POLICIES, default="skip",
+                        help='Whether to skip or delay interval captures when writing falls behind (default: skip)')
+    parser.add_argument('--preview-profile', choices=PROFILES, default=DEFAULT_PROFILE,
+                        help=f'How demanding a preview to start with (default: {DEFAULT_PROFILE})')
+    parser.add_argument('--fixed-preview', action='store_true',
+                        help='Keep to the preview profile even if frames are being dropped')
+    parser.add_argument('--watchdog', type=float, nargs='?', const=STALL_THRESHOLD, default=None, metavar='SECONDS',
+                        help='Report what holds up the GUI for longer than this many seconds, when it exits '
+                        f'(default: {STALL_THRESHOLD})')
+    parser.add_argument('--watchdog-report', type=str, default=None,
+                        help='Also write the --watchdog report to this file')
     args = parser.parse_args()
 
     # Override USER if command line argument is provided
@@ -194,6 +495,13 @@ if __name__ == '__main__':
     if args.output:
         OUTPUT_DIR = args.output
 
+    if args.interval is not None and args.interval <= 0:
+        parser.error("The interval must be greater than zero")
+    if args.count is not None and args.interval is None:
+        parser.error("--count needs --interval")
+    if args.count is not None and args.count <= 0:
+        parser.error("The count must be greater than zero")
+
     # Create directories if they don't exist
     os.makedirs(OUTPUT_DIR, exist_ok=True)
 
@@ -202,9 +510,8 @@ if __name__ == '__main__':
         parser.error("User name must be set. Use -u/--user to specify a user name.")
 
     # Check for invalid characters in USER
-    invalid_chars = '<>:"/\\|?*,\''
-    if any(char in invalid_chars for char in USER):
-        parser.error(f"User name contains invalid characters. Please avoid: {invalid_chars}")
+    if any(char in INVALID_CHARS for char in USER):
+        parser.error(f"User name contains invalid characters. Please avoid: {INVALID_CHARS}")
 
     # Set SSH mode based on arguments or environment
     ssh_mode = None
@@ -222,9 +529,31 @@ if __name__ == '__main__':
 
     print(f"User: {USER}")
     print(f"Output directory: {OUTPUT_DIR}")
+
+    if args.socket:
+        daemon = SnapperDaemon(args.socket, user=USER, output_dir=OUTPUT_DIR, initial_scene_id=args.initial_scene_id,
+                               compress_raw=args.compress_raw, interval=args.interval, count=args.count,
+                               on_backlog=args.on_backlog, preview_profile=args.preview_profile,
+                               adaptive_preview=not args.fixed_preview)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            daemon.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            daemon.close()
+        sys.exit(0)
+
     print(f"SSH mode: {ssh_mode}")
+    if args.preview_port and not ssh_mode:
+        parser.error("--preview-port is only available in SSH mode")
 
     app = QApplication(sys.argv)
-    window = Snapper(user=USER, output_dir=OUTPUT_DIR, ssh_mode=ssh_mode, initial_scene_id=args.initial_scene_id)
+    if args.watchdog is not None:
+        watchdog = StallWatchdog(app, args.watchdog, args.watchdog_report)
+    window = Snapper(user=USER, output_dir=OUTPUT_DIR, ssh_mode=ssh_mode, initial_scene_id=args.initial_scene_id,
+                     preview_port=args.preview_port, compress_raw=args.compress_raw, interval=args.interval,
+                     count=args.count, on_backlog=args.on_backlog, preview_profile=args.preview_profile,
+                     adaptive_preview=not args.fixed_preview)
     window.show()
     sys.exit(app.exec_())
@@ -0,0 +1,121 @@
+# Finding what holds up the Qt event loop, to track down why the GUI tools feel slow.
+#
+# A timer on the GUI thread records a heartbeat every few tens of milliseconds. A watchdog
+# thread keeps an eye on it, and whenever it has stopped for longer than the threshold (the
+# event loop is stuck in some handler) samples the GUI thread's Python stack. When the stall
+# ends, its length is shared out between the places the samples were taken, which are the
+# innermost frames of the tools' own code (so time spent in numpy, shutil or Qt is put down
+# to whichever line of ours called it). When the application quits, the places that held up
+# the event loop for longest are reported, along with the stack of the worst stall at each.
+
+import os
+import sys
+import threading
+import time
+import traceback
+from PyQt5.QtCore import QTimer
+
+STALL_THRESHOLD = 0.2  # Report the event loop being held up for longer than this, in seconds
+HEARTBEAT_INTERVAL = 0.02
+TOP_OFFENDERS = 10
+THIS_FILE = os.path.abspath(__file__)
+SOURCE_DIR = os.path.dirname(THIS_FILE)
+
+def locate(stack):
+    """Return where in the tools' own code a stack is, as "file:line in function"."""
+    for frame in reversed(stack):
+        if os.path.dirname(os.path.abspath(frame.filename)) == SOURCE_DIR and os.path.abspath(frame.filename) != THIS_FILE:
+            return f"{os.path.basename(frame.filename)}:{frame.lineno} in {frame.name}"
+    frame = stack[-1]
+    return f"{os.path.basename(frame.filename)}:{frame.lineno} in {frame.name}"
+
+class StallWatchdog:
+    """Watches the event loop of a QApplication, reporting the worst stalls when it quits. Make this on the GUI thread."""
+
+    def __init__(self, app, threshold=STALL_THRESHOLD, report_path=None):
+        self.threshold = threshold
+        self.report_path = report_path
+        self.gui_thread = threading.get_ident()
+        self.lock = threading.Lock()
+        self.last_beat = time.monotonic()
+        self.started = self.last_beat
+        self.samples = []  # stacks sampled during the stall in progress
+        self.offenders = {}  # location: {'total', 'stalls', 'longest', 'stack'}
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.beat)
+        self.timer.start(int(HEARTBEAT_INTERVAL * 1000))
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.watch, daemon=True)
+        self.thread.start()
+        app.aboutToQuit.connect(self.stop)
+
+    def beat(self):
+        # Runs on the GUI thread whenever the event loop gets round to it.
+        now = time.monotonic()
+        with self.lock:
+            samples, self.samples = self.samples, []
+            duration = now - self.last_beat - HEARTBEAT_INTERVAL
+            self.last_beat = now
+        if samples:
+            self.record(duration, samples)
+
+    def watch(self):
+        # Sample a few times per threshold, so that even the shortest stalls are seen.
+        while not self.stopping.wait(self.threshold / 4):
+            with self.lock:
+                if time.monotonic() - self.last_beat < self.threshold:
+                    continue
+            frame = sys._current_frames().get(self.gui_thread)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            del frame
+            with self.lock:
+                # The stall may have ended while we were looking.
+                if time.monotonic() - self.last_beat >= self.threshold:
+                    self.samples.append(stack)
+
+    def record(self, duration, samples):
+        self.stalls += 1
+        self.stall_time += duration
+        locations = [locate(stack) for stack in samples]
+        print(f"Stall: the event loop was held up for {duration:.2f}s in {max(locations, key=locations.count)}")
+        for location in locations:
+            offender = self.offenders.setdefault(location, {'total': 0.0, 'stalls': 0, 'longest': 0.0, 'stack': None})
+            offender['total'] += duration / len(samples)
+        for location in set(locations):
+            offender = self.offenders[location]
+            offender['stalls'] += 1
+            if duration > offender['longest']:
+                offender['longest'] = duration
+                offender['stack'] = samples[locations.index(location)]
+
+    def report(self):
+        """Return the report of the worst offenders as text."""
+        lines = [f"Event loop stalls of over {self.threshold:.2f}s: {self.stalls}, {self.stall_time:.1f}s in all, "
+                 f"in {time.monotonic() - self.started:.0f}s of running"]
+        ranked = sorted(self.offenders.items(), key=lambda item: item[1]['total'], reverse=True)[:TOP_OFFENDERS]
+        if not ranked:
+            return lines[0] + "\n"
+        lines.append(f"{'':>4}{'total(s)':>10}{'stalls':>8}{'longest(s)':>12}  where")
+        for rank, (location, offender) in enumerate(ranked, 1):
+            lines.append(f"{rank:>4}{offender['total']:>10.2f}{offender['stalls']:>8}{offender['longest']:>12.2f}  {location}")
+        for rank, (location, offender) in enumerate(ranked, 1):
+            lines.append("")
+            lines.append(f"{rank}. {location}, longest stall {offender['longest']:.2f}s:")
+            lines += [line.rstrip('\n') for line in traceback.format_list(offender['stack'])]
+        return "\n".join(lines) + "\n"
+
+    def stop(self):
+        self.stopping.set()
+        self.timer.stop()
+        report = self.report()
+        print(report)
+        if self.report_path:
+            try:
+                with open(self.report_path, 'w') as f:
+                    f.write(report)
+            except OSError as e:
+                print(f"Could not write {self.report_path}: {e}")
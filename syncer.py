@@ -0,0 +1,350 @@
+#! /usr/bin/env python3
+
+# Copy new and changed captures from one folder to another, for example off the Pi.
+#
+# Both sides list their captures with the size and modification time of every file. Files
+# that are missing, or a different size, are fetched, and where only the modification time
+# differs (or with --checksum) the files' SHA-256 checksums are compared first, using the
+# verifier's cache so that unchanged files aren't read again. All the JPEGs are fetched
+# before any DNGs, so annotation can start while the DNGs are still coming. Each file is
+# written to a hidden .part file, whose name records the size and modification time of the
+# original, and renamed once its checksum has been checked, so an interrupted sync carries on
+# from where it stopped. The metadata.jsonl log is fetched too.
+#
+# The source can be a folder, or a syncer running with --serve on the Pi. This only listens
+# on localhost, so run it over "ssh -L" just as the preview stream is.
+
+import sys
+import os
+import argparse
+import hashlib
+import json
+import socket
+import socketserver
+import time
+from concurrent.futures import ThreadPoolExecutor
+from capture_metadata import METADATA_LOG
+from dataset_index import DatasetIndex
+from verifier import CACHE_NAME, load_cache, save_cache, verify_file
+
+# You can override these here, if you wish, or on the command line.
+INPUT_DIR = os.path.join(os.path.expanduser("~"), "awb-captures")
+OUTPUT_DIR = os.path.join(os.path.expanduser("~"), "awb-captures")
+PORT = 8766
+CHUNK_SIZE = 1 << 20
+
+def list_files(directory):
+    """Return {filename: (size, mtime_ns)} for the capture files and metadata log in directory."""
+    files = {}
+    index = DatasetIndex(directory, full=True)
+    for row in range(len(index)):
+        for ext in ('jpg', 'dng'):
+            filename = str(getattr(index, ext + '_files')[row])
+            if filename:
+                files[filename] = (int(getattr(index, ext + '_sizes')[row]), int(getattr(index, ext + '_mtimes')[row]))
+    try:
+        st = os.stat(os.path.join(directory, METADATA_LOG))
+        files[METADATA_LOG] = (st.st_size, st.st_mtime_ns)
+    except OSError:
+        pass
+    return files
+
+def file_checksums(directory, filenames, workers=None):
+    """Return {filename: sha256}, using and updating the verifier's cache."""
+    cache_path = os.path.join(directory, CACHE_NAME)
+    cache = load_cache(cache_path)
+    checksums = {}
+    todo = []
+    for filename in filenames:
+        try:
+            st = os.stat(os.path.join(directory, filename))
+        except OSError:
+            continue
+        cached = cache.get(filename)
+        if cached and cached['key'] == [st.st_size, st.st_mtime_ns] and cached['sha256']:
+            checksums[filename] = cached['sha256']
+        else:
+            todo.append(filename)
+    if todo:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for filename, result in zip(todo, pool.map(verify_file, [os.path.join(directory, f) for f in todo])):
+                if result['sha256']:
+                    checksums[filename] = result['sha256']
+                if filename != METADATA_LOG:  # the verifier only knows about capture files
+                    cache[filename] = result
+        try:
+            save_cache(cache_path, cache)
+        except OSError as e:
+            print(f"Could not save {cache_path}: {e}", file=sys.stderr)
+    return checksums
+
+def send_file(path, offset, write):
+    """Pass a file's data from offset on to write, returning (size, mtime_ns, sha256 of the whole file)."""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if offset > st.st_size:
+            raise ValueError("file is shorter than the part already copied")
+        remaining = offset
+        while remaining > 0:
+            # The part of the file the destination already has is still needed for the checksum.
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            sha256.update(chunk)
+            remaining -= len(chunk)
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            write(chunk)
+    return st.st_size, st.st_mtime_ns, sha256.hexdigest()
+
+class LocalSource:
+    """Captures in a folder on this machine."""
+
+    def __init__(self, directory, workers=None):
+        self.directory = directory
+        self.workers = workers
+
+    def list_files(self):
+        return list_files(self.directory)
+
+    def checksums(self, filenames):
+        return file_checksums(self.directory, filenames, self.workers)
+
+    def fetch(self, filename, offset, write):
+        return send_file(os.path.join(self.directory, filename), offset, write)
+
+    def close(self):
+        pass
+
+class RemoteSource:
+    """Captures served by "syncer.py --serve". Each request is a line of JSON, answered by another."""
+
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port))
+        self.rfile = self.sock.makefile('rb')
+        self.wfile = self.sock.makefile('wb')
+
+    def request(self, **request):
+        self.wfile.write(json.dumps(request).encode() + b"\n")
+        self.wfile.flush()
+        return self.reply()
+
+    def reply(self):
+        line = self.rfile.readline()
+        if not line:
+            raise ConnectionError("the server closed the connection")
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise ValueError(reply['error'])
+        return reply
+
+    def list_files(self):
+        return {filename: tuple(value) for filename, value in self.request(op='list')['files'].items()}
+
+    def checksums(self, filenames):
+        return self.request(op='checksums', filenames=list(filenames))['checksums']
+
+    def fetch(self, filename, offset, write):
+        # The data comes in chunks, each preceded by its length, ending with a zero length and then the file's details.
+        self.wfile.write(json.dumps({'op': 'fetch', 'filename': filename, 'offset': offset}).encode() + b"\n")
+        self.wfile.flush()
+        while True:
+            length = int.from_bytes(self.rfile.read(4), 'big')
+            if length == 0:
+                break
+            chunk = self.rfile.read(length)
+            if len(chunk) < length:
+                raise ConnectionError("the server closed the connection")
+            write(chunk)
+        reply = self.reply()
+        return reply['size'], reply['mtime'], reply['sha256']
+
+    def close(self):
+        self.sock.close()
+
+def serve(directory, port, workers=None):
+    """Serve the captures in directory to syncers elsewhere, until interrupted."""
+
+    class Handler(socketserver.StreamRequestHandler):
+        def send(self, **reply):
+            self.wfile.write(json.dumps(reply, separators=(',', ':')).encode() + b"\n")
+
+        def send_chunk(self, chunk):
+            self.wfile.write(len(chunk).to_bytes(4, 'big') + chunk)
+
+        def handle(self):
+            files = {}
+            for line in self.rfile:
+                request = json.loads(line)
+                op = request.get('op')
+                if op == 'list':
+                    files = list_files(directory)
+                    self.send(files=files)
+                elif op == 'checksums':
+                    self.send(checksums=file_checksums(directory, [f for f in request['filenames'] if f in files],
+                                                       workers))
+                elif op == 'fetch':
+                    try:
+                        # Only listed files are served, so nothing else on the Pi can be asked for.
+                        if request.get('filename') not in files:
+                            raise ValueError("not a capture file")
+                        size, mtime, sha256 = send_file(os.path.join(directory, request['filename']),
+                                                        request['offset'], self.send_chunk)
+                    except (OSError, ValueError) as e:
+                        self.wfile.write(bytes(4))
+                        self.send(error=str(e))
+                    else:
+                        self.wfile.write(bytes(4))
+                        self.send(size=size, mtime=mtime, sha256=sha256)
+                else:
+                    self.send(error=f"bad request {line.decode(errors='replace').strip()}")
+                self.wfile.flush()
+
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    with socketserver.ThreadingTCPServer(('localhost', port), Handler) as server:
+        server.daemon_threads = True
+        print(f"Serving {directory} on localhost:{port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+def part_name(filename, size, mtime):
+    return f".{filename}.{size}.{mtime}.part"
+
+def plan(source, output_dir, files, checksum=False, workers=None):
+    """Return the files to fetch, JPEGs first, given the source's {filename: (size, mtime_ns)}."""
+    have = list_files(output_dir)
+    todo = []
+    compare = []  # the same size, so only a checksum can tell
+    for filename, (size, mtime) in files.items():
+        if filename not in have or have[filename][0] != size:
+            todo.append(filename)
+        elif checksum or have[filename][1] != mtime:
+            compare.append(filename)
+    if compare:
+        theirs = source.checksums(compare)
+        ours = file_checksums(output_dir, compare, workers)
+        for filename in compare:
+            if theirs.get(filename) != ours.get(filename):
+                todo.append(filename)
+            elif have[filename][1] != files[filename][1]:
+                # The same file, so take the source's modification time to save comparing it again.
+                os.utime(os.path.join(output_dir, filename), ns=(files[filename][1], files[filename][1]))
+    order = {'.jpg': 0, '.dng': 1}
+    return sorted(todo, key=lambda filename: (order.get(os.path.splitext(filename)[1].lower(), 2), filename))
+
+def fetch_file(source, output_dir, filename, size, mtime):
+    """Fetch one file into output_dir, carrying on from any part already fetched. Returns the number of bytes fetched."""
+    part_path = os.path.join(output_dir, part_name(filename, size, mtime))
+    ours = hashlib.sha256()
+    with open(part_path, 'a+b') as f:
+        f.seek(0)
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            ours.update(chunk)
+        offset = f.tell()
+
+        def write(chunk):
+            ours.update(chunk)
+            f.write(chunk)
+
+        size, mtime, sha256 = source.fetch(filename, offset, write)
+        fetched = f.tell() - offset
+    if ours.hexdigest() != sha256:
+        # Perhaps the original changed since the part was fetched, so start again next time.
+        os.remove(part_path)
+        raise ValueError("checksum does not match")
+    os.utime(part_path, ns=(mtime, mtime))
+    os.replace(part_path, os.path.join(output_dir, filename))
+    return fetched
+
+def remove_stale_parts(output_dir, files):
+    """Remove parts of files that have changed at the source, or gone from it, since they were started."""
+    wanted = {part_name(filename, *key) for filename, key in files.items()}
+    with os.scandir(output_dir) as it:
+        for entry in it:
+            if entry.name.startswith('.') and entry.name.endswith('.part') and entry.name not in wanted:
+                os.remove(entry.path)
+
+def sync(source, output_dir, checksum=False, dry_run=False, workers=None, progress=True):
+    """Fetch everything new or changed from source into output_dir, returning (files fetched, bytes, problems)."""
+    os.makedirs(output_dir, exist_ok=True)
+    files = source.list_files()
+    todo = plan(source, output_dir, files, checksum, workers)
+    if progress:
+        total = sum(files[filename][0] for filename in todo)
+        print(f"{len(files) - len(todo)} files up to date, {len(todo)} to fetch ({total / 1e6:.1f}MB)", file=sys.stderr)
+    if dry_run:
+        for filename in todo:
+            print(filename)
+        return 0, 0, []
+    remove_stale_parts(output_dir, files)
+    fetched_bytes = 0
+    problems = []
+    for i, filename in enumerate(todo):
+        try:
+            fetched_bytes += fetch_file(source, output_dir, filename, *files[filename])
+        except (OSError, ValueError) as e:
+            problems.append(f"{filename}: {e}")
+            if isinstance(e, ConnectionError):
+                break
+            continue
+        if progress:
+            print(f"Fetched {filename} ({i + 1} of {len(todo)})", file=sys.stderr)
+    return len(todo) - len(problems), fetched_bytes, problems
+
+def open_source(name, workers=None):
+    """A folder, or HOST:PORT of a syncer running with --serve."""
+    if os.path.isdir(name):
+        return LocalSource(name, workers)
+    if ':' not in name:
+        raise ValueError("no such folder")
+    host, port = name.rsplit(':', 1)
+    return RemoteSource(host or 'localhost', int(port))
+
+if __name__ == '__main__':
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='AWB capture syncer')
+    parser.add_argument('--input-dir', type=str, default=INPUT_DIR,
+                        help=f'Folder to copy from, or HOST:PORT of a syncer running with --serve (default: {INPUT_DIR})')
+    parser.add_argument('-o', '--output-dir', type=str, default=OUTPUT_DIR,
+                        help=f'Folder to copy to (default: {OUTPUT_DIR})')
+    parser.add_argument('--serve', type=int, nargs='?', const=PORT, default=None, metavar='PORT',
+                        help=f'Serve the input folder to syncers elsewhere, on this port (default: {PORT})')
+    parser.add_argument('--checksum', action='store_true',
+                        help='Compare the checksums of all files, not just those whose modification times differ')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='Just list the files that would be fetched')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Number of worker threads for checksums (default: chosen by Python)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Do not report progress')
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        serve(args.input_dir, args.serve, workers=args.workers)
+        sys.exit(0)
+    if os.path.isdir(args.input_dir) and os.path.realpath(args.input_dir) == os.path.realpath(args.output_dir):
+        parser.error("the input and output folders are the same")
+
+    start = time.monotonic()
+    try:
+        source = open_source(args.input_dir, workers=args.workers)
+    except (OSError, ValueError) as e:
+        print(f"Could not connect to {args.input_dir}: {e}", file=sys.stderr)
+        sys.exit(1)
+    try:
+        fetched, fetched_bytes, problems = sync(source, args.output_dir, checksum=args.checksum,
+                                                dry_run=args.dry_run, workers=args.workers,
+                                                progress=not args.quiet)
+    finally:
+        source.close()
+    for problem in problems:
+        print(problem)
+    if not args.quiet and not args.dry_run:
+        elapsed = time.monotonic() - start
+        print(f"Fetched {fetched} files ({fetched_bytes / 1e6:.1f}MB) in {elapsed:.1f}s", file=sys.stderr)
+    sys.exit(1 if problems else 0)
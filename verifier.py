@@ -0,0 +1,261 @@
+#! /usr/bin/env python3
+
+# Check a folder of captures for missing, truncated or corrupted files.
+#
+# Every JPEG must have a matching DNG (and vice versa). Each file's structure is checked
+# without decoding it: JPEGs must have a frame header and end with an end-of-image marker, and
+# DNGs must have a valid TIFF header with all their image data inside the file. Files are
+# read on a pool of threads, computing a SHA-256 checksum as they go, which can be written to
+# a manifest (in the format used by "sha256sum -c") or checked against one, for example after
+# copying a dataset off the Pi. Results are cached alongside the files, keyed on their sizes
+# and modification times, so re-runs only read new or changed files.
+
+import sys
+import os
+import argparse
+import hashlib
+import json
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataset_index import DatasetIndex
+
+# You can override these here, if you wish, or on the command line.
+INPUT_DIR = os.path.join(os.path.expanduser("~"), "awb-images")
+MANIFEST_NAME = "SHA256SUMS"
+CACHE_NAME = ".verifier-cache.json"
+CHUNK_SIZE = 1 << 20
+
+# TIFF tags giving the locations of image data, as (offsets tag, byte counts tag).
+DATA_TAGS = ((273, 279), (324, 325))  # strips, tiles
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4, 16: 8}
+
+def check_jpeg(f, size):
+    """Raise ValueError if the JPEG's structure is broken."""
+    if f.read(2) != b'\xff\xd8':
+        raise ValueError("no JPEG start of image marker")
+    have_frame = False
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            raise ValueError("corrupt JPEG marker segment")
+        m = marker[1]
+        if m == 0xd9:
+            raise ValueError("no image data")
+        length = f.read(2)
+        if len(length) < 2:
+            raise ValueError("truncated JPEG header")
+        if 0xc0 <= m <= 0xcf and m not in (0xc4, 0xc8, 0xcc):
+            have_frame = True
+        if m == 0xda:
+            break
+        f.seek(int.from_bytes(length, 'big') - 2, 1)
+    if not have_frame:
+        raise ValueError("no JPEG frame header")
+    f.seek(max(0, size - 2))
+    if f.read(2) != b'\xff\xd9':
+        raise ValueError("truncated JPEG (no end of image marker)")
+
+def check_dng(f, size):
+    """Raise ValueError if the DNG's TIFF structure is broken or its image data runs past the end of the file."""
+    header = f.read(8)
+    if header[:4] == b'II*\x00':
+        order = '<'
+    elif header[:4] == b'MM\x00*':
+        order = '>'
+    else:
+        raise ValueError("no TIFF header")
+    ifds = [struct.unpack(order + 'I', header[4:])[0]]
+    seen = set()
+    have_data = False
+    while ifds:
+        offset = ifds.pop()
+        if offset == 0 or offset in seen:
+            continue
+        seen.add(offset)
+        if offset + 2 > size:
+            raise ValueError("IFD beyond the end of the file")
+        f.seek(offset)
+        count = struct.unpack(order + 'H', f.read(2))[0]
+        entries = f.read(12 * count)
+        next_ifd = f.read(4)
+        if len(entries) < 12 * count or len(next_ifd) < 4:
+            raise ValueError("truncated IFD")
+        ifds.append(struct.unpack(order + 'I', next_ifd)[0])
+        tags = {}
+        for i in range(count):
+            tag, type_, n, value = struct.unpack(order + 'HHI4s', entries[12 * i:12 * i + 12])
+            tags[tag] = (type_, n, value)
+        if 330 in tags:  # SubIFDs
+            ifds += read_values(f, order, size, *tags[330])
+        for offsets_tag, counts_tag in DATA_TAGS:
+            if offsets_tag in tags and counts_tag in tags:
+                offsets = read_values(f, order, size, *tags[offsets_tag])
+                counts = read_values(f, order, size, *tags[counts_tag])
+                if any(o + c > size for o, c in zip(offsets, counts)):
+                    raise ValueError("image data runs past the end of the file")
+                have_data = True
+    if not have_data:
+        raise ValueError("no image data")
+
+def read_values(f, order, size, type_, n, value):
+    """Read the integer values of a TIFF entry."""
+    formats = {3: 'H', 4: 'I', 13: 'I', 16: 'Q'}
+    if type_ not in formats:
+        raise ValueError(f"unexpected TIFF field type {type_}")
+    nbytes = TIFF_TYPE_SIZES[type_] * n
+    if nbytes <= 4:
+        data = value[:nbytes]
+    else:
+        offset = struct.unpack(order + 'I', value)[0]
+        if offset + nbytes > size:
+            raise ValueError("TIFF entry beyond the end of the file")
+        f.seek(offset)
+        data = f.read(nbytes)
+    return list(struct.unpack(order + formats[type_] * n, data))
+
+def verify_file(path):
+    """Check one file's structure and checksum it. Runs in a worker thread."""
+    st = os.stat(path)
+    result = {'key': [st.st_size, st.st_mtime_ns], 'sha256': None, 'error': None}
+    try:
+        with open(path, 'rb') as f:
+            try:
+                (check_jpeg if path.lower().endswith('.jpg') else check_dng)(f, st.st_size)
+            except (ValueError, struct.error) as e:
+                result['error'] = str(e)
+            f.seek(0)
+            sha256 = hashlib.sha256()
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha256.update(chunk)
+            result['sha256'] = sha256.hexdigest()
+    except OSError as e:
+        result['error'] = str(e)
+    return result
+
+def load_cache(cache_path):
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(cache_path, cache):
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, cache_path)
+
+def load_manifest(manifest_path):
+    manifest = {}
+    with open(manifest_path) as f:
+        for line in f:
+            if line.strip():
+                checksum, name = line.rstrip('\n').split(None, 1)
+                manifest[name.lstrip('*')] = checksum
+    return manifest
+
+def write_manifest(manifest_path, checksums):
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        for name in sorted(checksums):
+            f.write(f"{checksums[name]}  {name}\n")
+    os.replace(tmp_path, manifest_path)
+
+def verify_directory(input_dir, workers=None, full=False, progress=True):
+    """Verify every capture in input_dir, returning ({filename: sha256}, [problems])."""
+    problems = []
+    files = []  # (name, key)
+    index = DatasetIndex(input_dir, full=True)
+    for row in range(len(index)):
+        jpg_file, dng_file = str(index.jpg_files[row]), str(index.dng_files[row])
+        if not jpg_file:
+            problems.append(f"{dng_file}: no matching JPEG")
+        else:
+            files.append((jpg_file, [int(index.jpg_sizes[row]), int(index.jpg_mtimes[row])]))
+        if not dng_file:
+            problems.append(f"{jpg_file}: no matching DNG")
+        else:
+            files.append((dng_file, [int(index.dng_sizes[row]), int(index.dng_mtimes[row])]))
+
+    cache_path = os.path.join(input_dir, CACHE_NAME)
+    cache = {} if full else load_cache(cache_path)
+    results = {}
+    todo = []
+    for name, key in files:
+        cached = cache.get(name)
+        if cached and cached['key'] == key:
+            results[name] = cached
+        else:
+            todo.append(name)
+
+    if progress:
+        print(f"{input_dir}: {len(results)} files unchanged, {len(todo)} to verify", file=sys.stderr)
+    if todo:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            verified = pool.map(verify_file, [os.path.join(input_dir, name) for name in todo])
+            for i, (name, result) in enumerate(zip(todo, verified)):
+                results[name] = result
+                if progress and (i + 1) % 100 == 0:
+                    print(f"Verified {i + 1} of {len(todo)}", file=sys.stderr)
+        try:
+            save_cache(cache_path, results)
+        except OSError as e:
+            print(f"Could not save {cache_path}: {e}", file=sys.stderr)
+
+    problems += [f"{name}: {result['error']}" for name, result in sorted(results.items()) if result['error']]
+    return {name: result['sha256'] for name, result in results.items() if result['sha256']}, problems
+
+def check_manifest(manifest, checksums):
+    """Compare checksums against a manifest, returning a list of problems."""
+    problems = []
+    for name in sorted(manifest.keys() | checksums.keys()):
+        if name not in checksums:
+            problems.append(f"{name}: in the manifest but missing")
+        elif name not in manifest:
+            problems.append(f"{name}: not in the manifest")
+        elif manifest[name] != checksums[name]:
+            problems.append(f"{name}: checksum does not match the manifest")
+    return problems
+
+if __name__ == '__main__':
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='AWB dataset verifier')
+    parser.add_argument('--input-dir', type=str, action='append',
+                        help=f'Directory of captures to verify, may be given more than once (default: {INPUT_DIR})')
+    manifest_group = parser.add_mutually_exclusive_group()
+    manifest_group.add_argument('--write-manifest', action='store_true',
+                                help=f'Write the checksums to {MANIFEST_NAME} in each directory')
+    manifest_group.add_argument('--check-manifest', action='store_true',
+                                help=f'Check the files against {MANIFEST_NAME} in each directory')
+    parser.add_argument('--full', action='store_true', help='Re-read every file, even if it has not changed')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Number of worker threads (default: chosen by Python)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Do not report progress')
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    all_problems = []
+    for input_dir in args.input_dir or [INPUT_DIR]:
+        checksums, problems = verify_directory(input_dir, workers=args.workers, full=args.full,
+                                               progress=not args.quiet)
+        manifest_path = os.path.join(input_dir, MANIFEST_NAME)
+        if args.write_manifest:
+            write_manifest(manifest_path, checksums)
+            if not args.quiet:
+                print(f"Wrote {manifest_path}", file=sys.stderr)
+        elif args.check_manifest:
+            try:
+                problems += check_manifest(load_manifest(manifest_path), checksums)
+            except OSError as e:
+                problems.append(f"Could not read {manifest_path}: {e}")
+        for problem in problems:
+            print(f"{input_dir}: {problem}")
+        all_problems += problems
+
+    if not args.quiet:
+        print(f"Found {len(all_problems)} problems in {time.monotonic() - start:.1f}s", file=sys.stderr)
+    sys.exit(1 if all_problems else 0)
@@ -0,0 +1,145 @@
+#! /usr/bin/env python3
+
+# Export per-zone raw statistics of an annotated dataset, for simulating AWB algorithms.
+#
+# For every annotated capture we compute the same kind of statistics as the ISP gives its AWB
+# algorithm: a grid of zones (32x32 by default) each with its raw R, G and B means and a count
+# of the pixels that aren't clipped. The DNGs are read on a pool of worker processes. The zone
+# grids are saved in one .npz file, along with each capture's name fields, rectangle, and the
+# raw means of its grey rectangle as the ground truth, and the camera's own AWB results from
+# the folder's metadata log where there are any, so that experiments can load a whole
+# dataset at once. Captures whose files haven't changed since the last export are copied over
+# from the existing file rather than read again.
+
+import sys
+import os
+import argparse
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from dataset_index import DatasetIndex
+from capture_metadata import load_metadata
+from rawstats import read_bayer, jpeg_size
+
+# You can override these here, if you wish, or on the command line.
+INPUT_DIR = os.path.join(os.path.expanduser("~"), "awb-images")
+OUTPUT_FILE = "zonestats.npz"
+GRID = (32, 32)
+
+def measure(job):
+    """Compute the zone grid and ground truth for one capture. Runs in a worker process."""
+    jpg_path, dng_path, rect, grid = job
+    try:
+        bayer = read_bayer(dng_path)
+        zones, counts = bayer.zone_stats(grid)
+        truth, clipped = bayer.rect_means(rect, jpeg_size(jpg_path))
+        return zones, counts, np.array(truth, dtype=np.float32), clipped, None
+    except Exception as e:
+        return None, None, None, None, str(e)
+
+def load_zonestats(path):
+    """Load an export into a dict of arrays (see export for what they are)."""
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+def export(input_dir, output, grid=GRID, workers=None, progress=True):
+    """Write the zone statistics of every annotated capture in input_dir to the .npz file output.
+
+    The arrays, with one entry per capture, are:
+        names, users, sensors, scene_ids    the capture's basename and its fields
+        rects (N, 4)                        the grey rectangle, x0, y0, x1, y1 in JPEG pixels
+        truth (N, 3)                        raw R, G, B means of the grey rectangle
+        truth_clipped (N,)                  fraction of clipped pixels in the rectangle
+        zones (N, rows, cols, 3)            raw R, G, B means of each zone's unclipped pixels
+        counts (N, rows, cols)              number of unclipped Bayer quads in each zone
+        colour_gains (N, 2)                 the camera's AWB red and blue gains, or NaN if not known
+        colour_temperatures (N,)            the camera's colour temperature estimate, or NaN if not known
+        keys (N, 4)                         sizes and modification times of the JPEG and DNG files"""
+    index = DatasetIndex(input_dir, full=True)
+    captures = [(str(index.names[row]), index.fields(row), index.key(row), index.path(row, 'jpg'), index.path(row, 'dng'))
+                for row in index.select(annotated=True, complete=True)]
+
+    # Re-use anything from the last export whose files haven't changed.
+    previous = {}
+    if os.path.exists(output):
+        try:
+            old = load_zonestats(output)
+            if old['zones'].shape[1:3] == tuple(grid):
+                keys = {basename: key for basename, _, key, _, _ in captures}
+                previous = {name: i for i, name in enumerate(old['names']) if list(old['keys'][i]) == keys.get(name)}
+        except Exception as e:
+            print(f"Could not use {output}: {e}", file=sys.stderr)
+
+    n = len(captures)
+    zones = np.zeros((n,) + tuple(grid) + (3,), dtype=np.float32)
+    counts = np.zeros((n,) + tuple(grid), dtype=np.uint32)
+    truth = np.zeros((n, 3), dtype=np.float32)
+    truth_clipped = np.zeros(n, dtype=np.float32)
+    ok = np.ones(n, dtype=bool)
+    todo = []
+    for i, (basename, fields, key, jpg_path, dng_path) in enumerate(captures):
+        if basename in previous:
+            j = previous[basename]
+            zones[i], counts[i], truth[i], truth_clipped[i] = \
+                old['zones'][j], old['counts'][j], old['truth'][j], old['truth_clipped'][j]
+        else:
+            todo.append((i, (jpg_path, dng_path, fields['rect'], tuple(grid))))
+
+    if progress:
+        print(f"{n - len(todo)} captures unchanged, {len(todo)} to process", file=sys.stderr)
+    if todo:
+        # LibRaw uses OpenMP, which isn't safe in forked workers.
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            results = pool.map(measure, [job for _, job in todo], chunksize=4)
+            for k, ((i, _), (z, c, t, clipped, error)) in enumerate(zip(todo, results)):
+                if error:
+                    print(f"Failed to process {captures[i][0]}: {error}", file=sys.stderr)
+                    ok[i] = False
+                else:
+                    zones[i], counts[i], truth[i], truth_clipped[i] = z, c, t, clipped
+                if progress and (k + 1) % 100 == 0:
+                    print(f"Processed {k + 1} of {len(todo)}", file=sys.stderr)
+
+    captures = [capture for capture, good in zip(captures, ok) if good]
+    metadata = load_metadata(input_dir)
+    records = [metadata.get((c[1]['user'], c[1]['sensor'], c[1]['scene_id']), {}) for c in captures]
+    arrays = {
+        'names': np.array([c[0] for c in captures], dtype=str),
+        'users': np.array([c[1]['user'] for c in captures], dtype=str),
+        'sensors': np.array([c[1]['sensor'] for c in captures], dtype=str),
+        'scene_ids': np.array([c[1]['scene_id'] for c in captures], dtype=str),
+        'rects': np.array([c[1]['rect'] for c in captures], dtype=np.int32).reshape(-1, 4),
+        'truth': truth[ok], 'truth_clipped': truth_clipped[ok], 'zones': zones[ok], 'counts': counts[ok],
+        'keys': np.array([c[2] for c in captures], dtype=np.int64).reshape(-1, 4),
+        'colour_gains': np.array([r.get('ColourGains') or (np.nan, np.nan) for r in records],
+                                 dtype=np.float32).reshape(-1, 2),
+        'colour_temperatures': np.array([r.get('ColourTemperature') or np.nan for r in records], dtype=np.float32),
+    }
+    # Write to a temporary file first, so a failed export doesn't lose the last one.
+    tmp_output = output + ".tmp.npz"
+    np.savez(tmp_output, **arrays)
+    os.replace(tmp_output, output)
+    return arrays
+
+if __name__ == '__main__':
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='AWB zone statistics exporter')
+    parser.add_argument('--input-dir', type=str, default=INPUT_DIR,
+                        help=f'Directory of annotated captures (default: {INPUT_DIR})')
+    parser.add_argument('-o', '--output', type=str, default=OUTPUT_FILE,
+                        help=f'Output .npz file (default: {OUTPUT_FILE})')
+    parser.add_argument('--grid', type=int, nargs=2, default=GRID, metavar=('ROWS', 'COLS'),
+                        help=f'Number of zones down and across (default: {GRID[0]} {GRID[1]})')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Number of worker processes (default: one per CPU)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Do not report progress')
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    arrays = export(args.input_dir, args.output, grid=tuple(args.grid), workers=args.workers,
+                    progress=not args.quiet)
+    if not args.quiet:
+        print(f"Wrote {len(arrays['names'])} captures to {args.output} in {time.monotonic() - start:.1f}s",
+              file=sys.stderr)